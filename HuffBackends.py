@@ -0,0 +1,434 @@
+# ---------------------------------------------------------------------------
+# HuffBackends.py
+# Usage: I/O backends for the Huff model: the ArcGIS geoprocessor, and a
+#        local backend reading/writing CSV, GeoJSON and shapefiles
+# ---------------------------------------------------------------------------
+
+# Import system modules (heavier modules are imported where they are used)
+import os, sys
+
+
+# Text field values (str and unicode on Python 2)
+try:
+    STRING_TYPES = basestring
+except NameError:
+    STRING_TYPES = str
+
+
+class BackendError(Exception):
+    pass
+
+
+def AreaCentroid(rings):
+    # Area-weighted centroid of a polygon given as a list of rings (outer
+    # rings and holes, each a list of (x, y)); falls back to the vertex mean
+    area = 0.0
+    cx = 0.0
+    cy = 0.0
+    for ring in rings:
+        for k in range(len(ring) - 1):
+            x0, y0 = ring[k][:2]
+            x1, y1 = ring[k + 1][:2]
+            cross = x0 * y1 - x1 * y0
+            area += cross
+            cx += (x0 + x1) * cross
+            cy += (y0 + y1) * cross
+    if area == 0:
+        points = [p for ring in rings for p in ring]
+        return (sum([p[0] for p in points]) / float(len(points)),
+                sum([p[1] for p in points]) / float(len(points)))
+    return cx / (3.0 * area), cy / (3.0 * area)
+
+
+def _CounterclockwiseRings(rings):
+    # GeoJSON (RFC 7946) wants outer rings counterclockwise and holes
+    # clockwise, the reverse of the shapefile/geoprocessor order: rings whose
+    # outer rings run clockwise (negative net area) are all reversed
+    area = 0.0
+    for ring in rings:
+        for k in range(len(ring) - 1):
+            area += ring[k][0] * ring[k + 1][1] - ring[k + 1][0] * ring[k][1]
+    if area < 0:
+        return [list(ring)[::-1] for ring in rings]
+    return rings
+
+
+def _InsidePoints(xy, rings):
+    # Moves polygon centroids that fall outside their polygon (concave
+    # shapes) to a point inside it, like FeatureToPoint INSIDE
+    import HuffOrigins
+    polygons = [i for i in range(len(rings)) if rings[i] is not None]
+    if not polygons:
+        return xy
+    inside = HuffOrigins.LabelPoints([rings[i] for i in polygons], [xy[i] for i in polygons])
+    xy = list(xy)
+    for k, i in enumerate(polygons):
+        xy[i] = (float(inside[k][0]), float(inside[k][1]))
+    return xy
+
+
+class PointTable(object):
+    # Columnar point data: ids, x, y and a dictionary of attribute columns
+    # (lists), plus the source polygon rings when read from polygons
+
+    def __init__(self, ids, xy, fields=None, rings=None):
+        self.ids = list(ids)
+        self.xy = list(xy)
+        self.fields = fields or {}
+        self.rings = rings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def Field(self, name):
+        if name not in self.fields:
+            raise BackendError("Field '" + str(name) + "' was not found.")
+        return self.fields[name]
+
+
+class Backend(object):
+    # Messages and progress go to stdout; subclasses implement the I/O
+
+    def AddMessage(self, msg):
+        sys.stdout.write(str(msg) + "\n")
+
+    def AddWarning(self, msg):
+        sys.stdout.write("WARNING: " + str(msg) + "\n")
+
+    def AddError(self, msg):
+        sys.stderr.write("ERROR: " + str(msg) + "\n")
+
+    def SetProgressor(self, kind, msg, minimum=0, maximum=100, step=1):
+        self.AddMessage(msg)
+
+    def SetProgressorPosition(self):
+        pass
+
+    def ReadPoints(self, path, fields=()):
+        raise NotImplementedError
+
+    def WritePoints(self, path, table, fieldorder=None):
+        raise NotImplementedError
+
+
+class GeoprocessorBackend(Backend):
+    # ArcGIS 9.3 geoprocessor; arcgisscripting is only imported (and the
+    # geoprocessor only created) the first time it is needed
+
+    def __init__(self, gp=None):
+        self._gp = gp
+
+    def _GetGP(self):
+        if self._gp is None:
+            import arcgisscripting
+            self._gp = arcgisscripting.create(9.3)
+            self._gp.overwriteoutput = 1
+        return self._gp
+    gp = property(_GetGP)
+
+    def AddMessage(self, msg):
+        self.gp.AddMessage(msg)
+
+    def AddWarning(self, msg):
+        self.gp.AddWarning(msg)
+
+    def AddError(self, msg):
+        self.gp.AddError(msg)
+
+    def SetProgressor(self, kind, msg, minimum=0, maximum=100, step=1):
+        self.gp.SetProgressor(kind, msg, minimum, maximum, step)
+
+    def SetProgressorPosition(self):
+        self.gp.SetProgressorPosition()
+
+    def ReadPoints(self, path, fields=()):
+        gp = self.gp
+        desc = gp.describe(path)
+        ids = []
+        xy = []
+        values = dict([(name, []) for name in fields])
+        rings = None
+        if desc.ShapeType == "Polygon":
+            rings = []
+        cur = gp.SearchCursor(path)
+        row = cur.Next()
+        while row:
+            ids.append(row.GetValue(desc.OIDFieldName))
+            feat = row.shape
+            if rings is None:
+                pnt = feat.getpart()
+                xy.append((pnt.x, pnt.y))
+            else:
+                # Label point lies inside the polygon, like FeatureToPoint INSIDE
+                pnt = feat.labelPoint
+                xy.append((pnt.x, pnt.y))
+                rings.append(self._Rings(feat))
+            for name in fields:
+                values[name].append(row.GetValue(name))
+            row = cur.Next()
+        del cur
+        return PointTable(ids, xy, values, rings)
+
+    def _Rings(self, feat):
+        rings = []
+        for p in range(feat.partCount):
+            part = feat.getpart(p)
+            ring = []
+            pnt = part.next()
+            while pnt:
+                ring.append((pnt.x, pnt.y))
+                pnt = part.next()
+                if not pnt:
+                    # A null point separates interior rings
+                    pnt = part.next()
+                    if pnt:
+                        rings.append(ring)
+                        ring = []
+            rings.append(ring)
+        return rings
+
+    def WritePoints(self, path, table, fieldorder=None, spatialreference=""):
+        # Tables with rings are written as polygons (each ring one part;
+        # clockwise rings are outer rings, counterclockwise rings holes)
+        gp = self.gp
+        if table.rings is None:
+            gp.CreateFeatureclass_management(os.path.dirname(path), os.path.basename(path), "POINT", "", "", "", spatialreference)
+        else:
+            gp.CreateFeatureclass_management(os.path.dirname(path), os.path.basename(path), "POLYGON", "", "", "", spatialreference)
+        fieldorder = fieldorder or sorted(table.fields)
+        gp.AddField_management(path, "SOURCE_ID", "LONG")
+        for name in fieldorder:
+            sample = [v for v in table.fields[name] if v is not None][:1]
+            if sample and isinstance(sample[0], STRING_TYPES):
+                length = max([len(v or "") for v in table.fields[name]] + [1])
+                gp.AddField_management(path, name, "TEXT", "", "", length)
+            else:
+                gp.AddField_management(path, name, "DOUBLE")
+        cur = gp.InsertCursor(path)
+        pnt = gp.CreateObject("Point")
+        for i in range(len(table)):
+            row = cur.NewRow()
+            if table.rings is None:
+                pnt.x, pnt.y = table.xy[i]
+                row.shape = pnt
+            else:
+                parts = gp.CreateObject("Array")
+                for ring in table.rings[i]:
+                    part = gp.CreateObject("Array")
+                    for x, y in ring:
+                        pnt.x, pnt.y = x, y
+                        part.add(pnt)
+                    parts.add(part)
+                row.shape = parts
+            row.SetValue("SOURCE_ID", table.ids[i])
+            for name in fieldorder:
+                if table.fields[name][i] is not None:
+                    row.SetValue(name, table.fields[name][i])
+            cur.InsertRow(row)
+        del cur
+
+
+class LocalBackend(Backend):
+    # Points or polygons from .csv (x and y columns), .geojson/.json or .shp
+    # (the last needs the pyshp package). Polygons are represented by their
+    # area centroid. Tables with rings are written as polygons to .geojson
+    # and .shp, and as their points to .csv.
+
+    def __init__(self, xfield="x", yfield="y", idfield="id"):
+        self.xfield = xfield
+        self.yfield = yfield
+        self.idfield = idfield
+
+    def _Format(self, path):
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".csv":
+            return "csv"
+        if ext in (".geojson", ".json"):
+            return "geojson"
+        if ext == ".shp":
+            return "shp"
+        raise BackendError("Unsupported file type '" + ext + "'. Use .csv, .geojson or .shp.")
+
+    def ReadPoints(self, path, fields=()):
+        return getattr(self, "_Read_" + self._Format(path))(path, fields)
+
+    def WritePoints(self, path, table, fieldorder=None):
+        fieldorder = fieldorder or sorted(table.fields)
+        return getattr(self, "_Write_" + self._Format(path))(path, table, fieldorder)
+
+    # -- CSV -----------------------------------------------------------------
+
+    def _Read_csv(self, path, fields):
+        import csv
+        handle = open(path, "r")
+        try:
+            reader = csv.DictReader(handle)
+            ids = []
+            xy = []
+            values = dict([(name, []) for name in fields])
+            for n, row in enumerate(reader):
+                ids.append(_Number(row.get(self.idfield, n + 1)))
+                xy.append((float(row[self.xfield]), float(row[self.yfield])))
+                for name in fields:
+                    if name not in row:
+                        raise BackendError("Field '" + name + "' was not found in " + path + ".")
+                    values[name].append(_Number(row[name]))
+        finally:
+            handle.close()
+        return PointTable(ids, xy, values)
+
+    def _Write_csv(self, path, table, fieldorder):
+        import csv
+        handle = open(path, "w")
+        try:
+            writer = csv.writer(handle, lineterminator="\n")
+            writer.writerow([self.idfield, self.xfield, self.yfield] + list(fieldorder))
+            for i in range(len(table)):
+                writer.writerow([table.ids[i], table.xy[i][0], table.xy[i][1]] +
+                                [_Text(table.fields[name][i]) for name in fieldorder])
+        finally:
+            handle.close()
+
+    # -- GeoJSON -------------------------------------------------------------
+
+    def _Read_geojson(self, path, fields):
+        import json
+        handle = open(path, "r")
+        try:
+            data = json.load(handle)
+        finally:
+            handle.close()
+        features = data.get("features", [data] if data.get("type") == "Feature" else [])
+        ids = []
+        xy = []
+        rings = []
+        values = dict([(name, []) for name in fields])
+        polygons = False
+        for n, feature in enumerate(features):
+            geometry = feature.get("geometry") or {}
+            properties = feature.get("properties") or {}
+            kind = geometry.get("type")
+            coords = geometry.get("coordinates")
+            if kind == "Point":
+                xy.append(tuple(coords[:2]))
+                rings.append(None)
+            elif kind == "Polygon":
+                polygons = True
+                xy.append(AreaCentroid(coords))
+                rings.append(coords)
+            elif kind == "MultiPolygon":
+                polygons = True
+                allrings = [ring for polygon in coords for ring in polygon]
+                xy.append(AreaCentroid(allrings))
+                rings.append(allrings)
+            else:
+                raise BackendError("Unsupported geometry type '" + str(kind) + "' in " + path + ".")
+            ids.append(feature.get("id", properties.get(self.idfield, n + 1)))
+            for name in fields:
+                if name not in properties:
+                    raise BackendError("Field '" + name + "' was not found in " + path + ".")
+                values[name].append(properties[name])
+        if polygons:
+            xy = _InsidePoints(xy, rings)
+        return PointTable(ids, xy, values, rings if polygons else None)
+
+    def _Write_geojson(self, path, table, fieldorder):
+        import json
+        features = []
+        for i in range(len(table)):
+            properties = dict([(name, _Text(table.fields[name][i])) for name in fieldorder])
+            if table.rings is None:
+                geometry = {"type": "Point", "coordinates": [table.xy[i][0], table.xy[i][1]]}
+            else:
+                geometry = {"type": "Polygon", "coordinates": [[list(p) for p in ring] for ring in _CounterclockwiseRings(table.rings[i])]}
+            features.append({"type": "Feature", "id": table.ids[i], "geometry": geometry, "properties": properties})
+        handle = open(path, "w")
+        try:
+            json.dump({"type": "FeatureCollection", "features": features}, handle)
+        finally:
+            handle.close()
+
+    # -- Shapefile -----------------------------------------------------------
+
+    def _Shapefile(self):
+        try:
+            import shapefile
+        except ImportError:
+            raise BackendError("Reading and writing shapefiles needs the pyshp package (import shapefile).")
+        return shapefile
+
+    def _Read_shp(self, path, fields):
+        shapefile = self._Shapefile()
+        reader = shapefile.Reader(path)
+        names = [f[0] for f in reader.fields[1:]]
+        ids = []
+        xy = []
+        rings = []
+        values = dict([(name, []) for name in fields])
+        polygons = False
+        for n, record in enumerate(reader.shapeRecords()):
+            shape = record.shape
+            if shape.shapeType in (shapefile.POINT, shapefile.POINTZ, shapefile.POINTM):
+                xy.append(tuple(shape.points[0][:2]))
+                rings.append(None)
+            else:
+                polygons = True
+                parts = list(shape.parts) + [len(shape.points)]
+                shaperings = [shape.points[parts[p]:parts[p + 1]] for p in range(len(parts) - 1)]
+                xy.append(AreaCentroid(shaperings))
+                rings.append(shaperings)
+            ids.append(n + 1)
+            row = dict(zip(names, record.record))
+            for name in fields:
+                if name not in row:
+                    raise BackendError("Field '" + name + "' was not found in " + path + ".")
+                values[name].append(row[name])
+        if polygons:
+            xy = _InsidePoints(xy, rings)
+        return PointTable(ids, xy, values, rings if polygons else None)
+
+    def _Write_shp(self, path, table, fieldorder):
+        shapefile = self._Shapefile()
+        if table.rings is None:
+            writer = shapefile.Writer(os.path.splitext(path)[0], shapeType=shapefile.POINT)
+        else:
+            writer = shapefile.Writer(os.path.splitext(path)[0], shapeType=shapefile.POLYGON)
+        writer.field("SOURCE_ID", "N", 18, 0)
+        for name in fieldorder:
+            sample = [v for v in table.fields[name] if v is not None][:1]
+            if sample and isinstance(sample[0], STRING_TYPES):
+                writer.field(name[:10], "C", max([len(v or "") for v in table.fields[name]] + [1]))
+            else:
+                writer.field(name[:10], "N", 24, 10)
+        for i in range(len(table)):
+            if table.rings is None:
+                writer.point(table.xy[i][0], table.xy[i][1])
+            else:
+                writer.poly([list(ring) for ring in table.rings[i]])
+            writer.record(table.ids[i], *[table.fields[name][i] for name in fieldorder])
+        writer.close()
+
+
+def _Number(value):
+    # CSV values arrive as text: keep numbers numeric
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+
+
+def _Text(value):
+    # numpy scalars are not JSON/CSV friendly
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def GetBackend(name=""):
+    # "gp" for the ArcGIS geoprocessor, anything else for the local backend
+    if name.lower() in ("gp", "arcgis", "geoprocessor"):
+        return GeoprocessorBackend()
+    return LocalBackend()
@@ -0,0 +1,224 @@
+# ---------------------------------------------------------------------------
+# HuffBenchmark.py
+# Usage: Synthetic-data benchmarks of the Huff pipeline stages, e.g.
+#        python HuffBenchmark.py -o 1000,10000 -s 10,100 -r results.json
+#        python HuffBenchmark.py -t thresholds.json   (exit 1 on regressions)
+#        python HuffBenchmark.py -j 4   (probabilities across 4 processes)
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import sys, os, json, shutil, tempfile, optparse, platform
+import numpy
+import HuffDistance, HuffEngine, HuffMarkets, HuffSurface, HuffInstrument
+
+STAGES = ("distance", "probability", "sales", "markets", "surfaces")
+
+# Allowed slowdown over the recorded time before a stage counts as a regression
+DEFAULT_TOLERANCE = 1.5
+
+# Stages faster than this (seconds) are not checked; timer noise dominates
+MIN_CHECKED_SECONDS = 0.05
+
+
+def StudyArea(numpolygons, size=20000.0, seed=0):
+    # Square study area of 'size' meters split into about numpolygons
+    # jittered block groups. Returns (extent, list of polygon rings,
+    # population per polygon).
+    rng = numpy.random.RandomState(seed)
+    side = max(1, int(round(numpy.sqrt(numpolygons))))
+    step = size / side
+    # Interior grid corners are jittered so polygons are irregular quadrilaterals
+    corners = numpy.mgrid[0:side + 1, 0:side + 1].astype(numpy.float64) * step
+    jitter = rng.uniform(-0.3, 0.3, corners.shape) * step
+    jitter[:, [0, -1], :] = 0
+    jitter[:, :, [0, -1]] = 0
+    corners += jitter
+    polygons = []
+    for i in range(side):
+        for j in range(side):
+            ring = [(corners[0, i, j], corners[1, i, j]), (corners[0, i + 1, j], corners[1, i + 1, j]),
+                    (corners[0, i + 1, j + 1], corners[1, i + 1, j + 1]), (corners[0, i, j + 1], corners[1, i, j + 1]),
+                    (corners[0, i, j], corners[1, i, j])]
+            polygons.append([ring])
+    population = numpy.round(rng.lognormal(7, 0.6, len(polygons)))
+    return (0.0, 0.0, size, size), polygons, population
+
+
+def RandomOrigins(extent, numorigins, seed=0):
+    # Origins as in the tool's random-points mode: uniform points in the study area
+    rng = numpy.random.RandomState(seed + 1)
+    xmin, ymin, xmax, ymax = extent
+    return numpy.column_stack((rng.uniform(xmin, xmax, numorigins), rng.uniform(ymin, ymax, numorigins)))
+
+
+def CentroidOrigins(polygons):
+    # Origins as in the tool's block group mode: one centroid per polygon
+    import HuffBackends
+    return numpy.array([HuffBackends.AreaCentroid(rings) for rings in polygons])
+
+
+def RandomStores(extent, numstores, seed=0):
+    # Stores clustered around a few centres (like shopping districts), with
+    # square-footage-like attractiveness
+    rng = numpy.random.RandomState(seed + 2)
+    xmin, ymin, xmax, ymax = extent
+    centres = numpy.column_stack((rng.uniform(xmin, xmax, 5), rng.uniform(ymin, ymax, 5)))
+    xy = centres[rng.randint(0, 5, numstores)] + rng.normal(0, (xmax - xmin) / 10.0, (numstores, 2))
+    xy[:, 0] = numpy.clip(xy[:, 0], xmin, xmax)
+    xy[:, 1] = numpy.clip(xy[:, 1], ymin, ymax)
+    attractiveness = numpy.round(rng.lognormal(10, 0.8, numstores))
+    return xy, attractiveness
+
+
+def RunCase(numorigins, numstores, mode="random", seed=0, workfolder=None, stages=STAGES, processes=1):
+    # One benchmark case; returns a list of records, one per stage. With
+    # processes > 1 the probability stage runs HuffParallel.ParallelHuff over
+    # the distance stage's matrix (saved to a .npy file off the clock).
+    extent, polygons, population = StudyArea(numorigins if mode == "centroids" else 400, seed=seed)
+    if mode == "centroids":
+        originxy = CentroidOrigins(polygons)
+        sales = population
+    else:
+        originxy = RandomOrigins(extent, numorigins, seed)
+        sales = numpy.random.RandomState(seed + 3).lognormal(7, 0.6, numorigins)
+    storexy, attractiveness = RandomStores(extent, numstores, seed)
+    case = {"origins": len(originxy), "stores": numstores, "mode": mode}
+    if processes > 1:
+        case["processes"] = processes
+    recorder = HuffInstrument.StageRecorder(memory=True)
+    state = {}
+
+    def Record(stage, function, pairs):
+        recorder.Begin(stage)
+        result = function()
+        recorder.End(pairs=pairs, **case)
+        return result
+
+    pairs = len(originxy) * numstores
+    state["impedance"] = Record("distance", lambda: HuffDistance.DistanceMatrix(originxy, storexy), pairs)
+    if "probability" in stages and processes > 1:
+        import HuffParallel
+        handle, path = tempfile.mkstemp(".npy", "huffbench")
+        os.close(handle)
+        try:
+            numpy.save(path, state["impedance"])
+            state["prob"] = Record("probability", lambda: HuffParallel.ParallelHuff(attractiveness, impedancepath=path, processes=processes)[0], pairs)
+        finally:
+            os.remove(path)
+    elif "probability" in stages:
+        state["prob"] = Record("probability", lambda: HuffEngine.HuffProbabilities(state["impedance"], attractiveness)[2], pairs)
+    if "sales" in stages and "prob" in state:
+        # Only the sales step, from the probability stage's matrix
+        state["sales"] = Record("sales", lambda: state["prob"] * sales[:, numpy.newaxis], pairs)
+    if "markets" in stages and "prob" in state:
+        Record("markets", lambda: (HuffMarkets.DominantStores(state["prob"]), HuffMarkets.ConcentrationIndex(state["prob"])), pairs)
+    if "surfaces" in stages and "prob" in state:
+        folder = workfolder or tempfile.mkdtemp(prefix="huffbench")
+        try:
+            grid = HuffSurface.RasterGrid(*extent)
+            path = os.path.join(folder, "surfaces.bsq")
+            Record("surfaces", lambda: HuffSurface.IDWSurfaces(originxy, state["prob"], grid, path),
+                   grid.nrows * grid.ncols * numstores)
+        finally:
+            if workfolder is None:
+                shutil.rmtree(folder, ignore_errors=True)
+    return recorder.records
+
+
+def RunGrid(originsizes, storesizes, modes=("random",), seed=0, stages=STAGES, processes=1):
+    records = []
+    for mode in modes:
+        for numorigins in originsizes:
+            for numstores in storesizes:
+                records += RunCase(numorigins, numstores, mode, seed, stages=stages, processes=processes)
+    return records
+
+
+def _Key(record):
+    key = "%s/%d/%d/%s" % (record["mode"], record["origins"], record["stores"], record["stage"])
+    if record.get("processes", 1) > 1:
+        key += "/%dp" % record["processes"]
+    return key
+
+
+def MakeThresholds(records, tolerance=DEFAULT_TOLERANCE):
+    # Regression thresholds: allowed wall seconds (and peak bytes) per case and stage
+    thresholds = {}
+    for record in records:
+        limit = {"wall": max(record["wall"], MIN_CHECKED_SECONDS) * tolerance}
+        if "peak_bytes" in record:
+            limit["peak_bytes"] = int(record["peak_bytes"] * tolerance)
+        thresholds[_Key(record)] = limit
+    return thresholds
+
+
+def CheckThresholds(records, thresholds):
+    # Returns a list of messages, one per measurement over its threshold
+    failures = []
+    for record in records:
+        limit = thresholds.get(_Key(record))
+        if limit is None:
+            continue
+        for measure in ("wall", "peak_bytes"):
+            if measure not in limit or measure not in record:
+                continue
+            if measure == "wall" and record["wall"] < MIN_CHECKED_SECONDS:
+                continue
+            if record[measure] > limit[measure]:
+                failures.append("%s: %s %.4g exceeds threshold %.4g" % (_Key(record), measure, record[measure], limit[measure]))
+    return failures
+
+
+def _Sizes(text):
+    return [int(v) for v in text.split(",") if v.strip()]
+
+
+def Main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-o", "--origins", default="1000,10000", help="comma-separated origin counts")
+    parser.add_option("-s", "--stores", default="10,50", help="comma-separated store counts")
+    parser.add_option("-m", "--modes", default="random,centroids", help="origin modes: random, centroids")
+    parser.add_option("-g", "--stages", default=",".join(STAGES), help="stages to run")
+    parser.add_option("-r", "--results", default="", help="write results as JSON lines to this file")
+    parser.add_option("-t", "--thresholds", default="", help="check against (or, with -w, write) this thresholds file")
+    parser.add_option("-w", "--write-thresholds", action="store_true", default=False, help="record thresholds from this run")
+    parser.add_option("--tolerance", type="float", default=DEFAULT_TOLERANCE, help="allowed slowdown when writing thresholds")
+    parser.add_option("-j", "--processes", type="int", default=1, help="worker processes for the probability stage")
+    parser.add_option("--seed", type="int", default=0)
+    options, args = parser.parse_args(argv)
+
+    records = RunGrid(_Sizes(options.origins), _Sizes(options.stores), options.modes.split(","),
+                      options.seed, options.stages.split(","), options.processes)
+    info = {"python": platform.python_version(), "numpy": numpy.__version__, "machine": platform.machine()}
+    lines = [json.dumps(dict(record, **info), sort_keys=True) for record in records]
+    if options.results:
+        handle = open(options.results, "w")
+        try:
+            handle.write("\n".join(lines) + "\n")
+        finally:
+            handle.close()
+    else:
+        sys.stdout.write("\n".join(lines) + "\n")
+
+    if options.thresholds and options.write_thresholds:
+        handle = open(options.thresholds, "w")
+        try:
+            json.dump(MakeThresholds(records, options.tolerance), handle, indent=1, sort_keys=True)
+        finally:
+            handle.close()
+    elif options.thresholds:
+        handle = open(options.thresholds, "r")
+        try:
+            thresholds = json.load(handle)
+        finally:
+            handle.close()
+        failures = CheckThresholds(records, thresholds)
+        for failure in failures:
+            sys.stderr.write("REGRESSION: " + failure + "\n")
+        if failures:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
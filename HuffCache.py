@@ -0,0 +1,112 @@
+# ---------------------------------------------------------------------------
+# HuffCache.py
+# Usage: On-disk, memory-mapped cache of origin x store impedance matrices,
+#        keyed by a hash of the inputs that determine them
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import os, hashlib, tempfile
+import numpy
+
+# Default size limit of a cache folder (bytes)
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+def ImpedanceKey(origin_xy, store_xy, cost="", restrictions="", network="", extra=""):
+    # Hash of the origin and store geometries, the cost attribute, the
+    # restrictions and the network used; any change gives a new key
+    sha = hashlib.sha1()
+    for xy in (origin_xy, store_xy):
+        xy = numpy.ascontiguousarray(xy, dtype=numpy.float64)
+        sha.update(str(xy.shape).encode("utf-8"))
+        sha.update(xy.tobytes())
+    for text in (cost, restrictions, network, extra):
+        sha.update(b"\0")
+        sha.update(str(text).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class ImpedanceCache(object):
+    # Folder of <key>.npy files. Hits are memory-mapped read-only (no copy)
+    # and touched, and the least recently used files are evicted once the
+    # folder grows past maxbytes.
+
+    def __init__(self, folder, maxbytes=DEFAULT_MAX_BYTES):
+        self.folder = folder
+        self.maxbytes = int(maxbytes)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def _Path(self, key):
+        return os.path.join(self.folder, key + ".npy")
+
+    def Get(self, key):
+        path = self._Path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            matrix = numpy.load(path, mmap_mode="r")
+        except (IOError, ValueError):
+            # Partly written or damaged file: drop it and recompute
+            self._Remove(path)
+            return None
+        os.utime(path, None)
+        return matrix
+
+    def Put(self, key, matrix):
+        # Writes to a temporary file first so a reader never maps a partial matrix
+        matrix = numpy.asarray(matrix, dtype=numpy.float64)
+        handle, temp = tempfile.mkstemp(".tmp", key, self.folder)
+        try:
+            fileobj = os.fdopen(handle, "wb")
+            try:
+                numpy.save(fileobj, matrix)
+            finally:
+                fileobj.close()
+            path = self._Path(key)
+            if os.path.exists(path):
+                self._Remove(path)
+            os.rename(temp, path)
+        except:
+            self._Remove(temp)
+            raise
+        self.Evict(keep=key)
+
+    def GetOrCompute(self, key, function):
+        # Returns (matrix, True) on a hit; otherwise computes, stores and
+        # returns (matrix, False)
+        matrix = self.Get(key)
+        if matrix is not None:
+            return matrix, True
+        matrix = function()
+        self.Put(key, matrix)
+        return matrix, False
+
+    def Evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.folder):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.folder, name)
+            stat = os.stat(path)
+            total += stat.st_size
+            if name != str(keep) + ".npy":
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxbytes:
+                break
+            self._Remove(path)
+            total -= size
+
+    def Clear(self):
+        for name in os.listdir(self.folder):
+            if name.endswith(".npy"):
+                self._Remove(os.path.join(self.folder, name))
+
+    def _Remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,273 @@
+# ---------------------------------------------------------------------------
+# HuffCalibrate.py
+# Usage: Fitting the distance-decay exponent x (and optionally an
+#        attractiveness exponent) to observed origin -> store patronage, e.g.
+#        python HuffCalibrate.py stores.csv NAME SQFT origins.csv trips.csv --cache cache
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import sys, csv, optparse, multiprocessing
+import numpy
+import HuffBackends, HuffDistance
+
+# Number of origin x store cells evaluated per block
+BLOCK_CELLS = 1 << 22
+
+# Default starting values of x for the multi-start search
+DEFAULT_STARTS = (0.5, 1.0, 2.0, 3.0)
+
+# Data shared with pool workers (set once per worker by _InitWorker)
+_shared = {}
+
+
+def _Prepare(impedance, attractiveness, observed):
+    # Precomputes log-impedance and log-attractiveness; unreachable pairs and
+    # stores without attractiveness are masked out of the likelihood
+    impedance = numpy.asarray(impedance, dtype=numpy.float64)
+    observed = numpy.asarray(observed, dtype=numpy.float64)
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    if impedance.ndim != 2 or observed.shape != impedance.shape:
+        raise ValueError("Impedance and observed patronage must both be origins x stores matrices.")
+    if attractiveness.shape != (impedance.shape[1],):
+        raise ValueError("There must be one attractiveness value per store.")
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        logimp = numpy.log(impedance)
+        logattr = numpy.log(attractiveness)
+    finally:
+        numpy.seterr(**old)
+    valid = numpy.isfinite(logimp) & numpy.isfinite(logattr)
+    logimp[~valid] = 0.0
+    logattr[~numpy.isfinite(logattr)] = 0.0
+    observed = numpy.where(valid, observed, 0.0)
+    return logimp, logattr, valid, observed
+
+
+def _Evaluate(params, logimp, logattr, valid, observed, fitattr, blockcells=BLOCK_CELLS):
+    # Log-likelihood sum(O_ij * log P_ij), its gradient and its Hessian with
+    # respect to (x) or (x, attractiveness exponent), accumulated over row blocks
+    x = params[0]
+    a = params[1] if fitattr else 1.0
+    nparams = 2 if fitattr else 1
+    ll = 0.0
+    grad = numpy.zeros(nparams)
+    hess = numpy.zeros((nparams, nparams))
+    rows = max(1, int(blockcells) // max(1, logimp.shape[1]))
+    for start in range(0, logimp.shape[0], rows):
+        L = logimp[start:start + rows]
+        V = valid[start:start + rows]
+        O = observed[start:start + rows]
+        n = O.sum(axis=1)
+        if not n.any():
+            continue
+
+        # Row-wise softmax of a*log(A) - x*log(d) (stable for any x)
+        U = numpy.where(V, a * logattr - x * L, -numpy.inf)
+        top = U.max(axis=1)
+        top[~numpy.isfinite(top)] = 0.0
+        E = numpy.exp(U - top[:, numpy.newaxis])
+        Z = E.sum(axis=1)
+        Z[Z == 0] = 1.0
+        P = E / Z[:, numpy.newaxis]
+        logP = numpy.where(V, U - (top + numpy.log(Z))[:, numpy.newaxis], 0.0)
+        ll += (O * logP).sum()
+
+        # Features of the multinomial logit: -log(d) and log(A)
+        features = [-L]
+        if fitattr:
+            features.append(numpy.where(V, logattr, 0.0))
+        means = [(P * f).sum(axis=1) for f in features]
+        for p in range(nparams):
+            grad[p] += (O * features[p]).sum() - (n * means[p]).sum()
+            for q in range(p, nparams):
+                cov = (P * features[p] * features[q]).sum(axis=1) - means[p] * means[q]
+                hess[p, q] -= (n * cov).sum()
+                hess[q, p] = hess[p, q]
+    return ll, grad, hess
+
+
+def _ShareRMSE(x, a, logimp, logattr, valid, observed, blockcells=BLOCK_CELLS):
+    # Root mean square difference between modelled and observed shares over
+    # the origins with observed patronage
+    sse = 0.0
+    count = 0
+    rows = max(1, int(blockcells) // max(1, logimp.shape[1]))
+    for start in range(0, logimp.shape[0], rows):
+        O = observed[start:start + rows]
+        n = O.sum(axis=1)
+        used = n > 0
+        if not used.any():
+            continue
+        U = numpy.where(valid[start:start + rows], a * logattr - x * logimp[start:start + rows], -numpy.inf)[used]
+        top = U.max(axis=1)
+        top[~numpy.isfinite(top)] = 0.0
+        E = numpy.exp(U - top[:, numpy.newaxis])
+        P = E / numpy.maximum(E.sum(axis=1), 1e-300)[:, numpy.newaxis]
+        sse += ((P - O[used] / n[used][:, numpy.newaxis]) ** 2).sum()
+        count += P.size
+    return float(numpy.sqrt(sse / max(1, count)))
+
+
+def _Newton(start, logimp, logattr, valid, observed, fitattr, maxiter=50, tolerance=1e-8):
+    # Newton ascent with step halving; the multinomial logit likelihood is
+    # concave, so each start climbs to the same optimum unless it stalls
+    params = numpy.array(start[:2 if fitattr else 1], dtype=numpy.float64)
+    ll, grad, hess = _Evaluate(params, logimp, logattr, valid, observed, fitattr)
+    iterations = 0
+    for iterations in range(1, maxiter + 1):
+        try:
+            step = -numpy.linalg.solve(hess, grad)
+        except numpy.linalg.LinAlgError:
+            step = grad * 1e-3
+        if numpy.dot(step, grad) <= 0:
+            step = grad * 1e-3
+        scale = 1.0
+        while scale > 1e-6:
+            trial = params + scale * step
+            tll, tgrad, thess = _Evaluate(trial, logimp, logattr, valid, observed, fitattr)
+            if tll >= ll:
+                break
+            scale *= 0.5
+        else:
+            break
+        improvement = tll - ll
+        params, ll, grad, hess = trial, tll, tgrad, thess
+        if improvement <= tolerance * max(1.0, abs(ll)):
+            break
+    return params, ll, hess, iterations
+
+
+def _InitWorker(logimp, logattr, valid, observed, fitattr):
+    _shared["args"] = (logimp, logattr, valid, observed, fitattr)
+
+
+def _FitStart(start):
+    return _Newton(start, *_shared["args"])
+
+
+def Calibrate(impedance, attractiveness, observed, fitattractiveness=False, starts=DEFAULT_STARTS, processes=None):
+    # impedance         - origins x stores impedance (may be a cached memmap)
+    # attractiveness    - one attractiveness value per store
+    # observed          - origins x stores observed trips or shares
+    # fitattractiveness - also fit an exponent on attractiveness
+    # starts            - starting x values (or (x, exponent) pairs),
+    #                     searched in parallel across a process pool
+    #
+    # Returns a dictionary with the fitted 'x', 'attractiveness_exponent',
+    # 'loglikelihood', 'null_loglikelihood', 'pseudo_r2' (McFadden, against
+    # equal shares among reachable stores), 'standard_errors', 'share_rmse'
+    # and 'iterations'.
+    logimp, logattr, valid, observed = _Prepare(impedance, attractiveness, observed)
+    if not observed.any():
+        raise ValueError("There is no observed patronage to calibrate against.")
+    startlist = []
+    for start in starts:
+        start = numpy.atleast_1d(numpy.asarray(start, dtype=numpy.float64))
+        if len(start) == 1:
+            start = numpy.array([start[0], 1.0])
+        startlist.append(start)
+    args = (logimp, logattr, valid, observed, fitattractiveness)
+
+    # Process: Run the multi-start search, one start per worker...
+    if processes == 1 or len(startlist) == 1:
+        results = [_Newton(start, *args) for start in startlist]
+    else:
+        pool = multiprocessing.Pool(processes, _InitWorker, args)
+        try:
+            results = pool.map(_FitStart, startlist)
+        finally:
+            pool.close()
+            pool.join()
+    params, ll, hess, iterations = max(results, key=lambda result: result[1])
+
+    # Process: Goodness of fit...
+    llnull, grad, h = _Evaluate(numpy.array([0.0, 0.0]), logimp, logattr, valid, observed, True)
+    try:
+        errors = numpy.sqrt(numpy.diag(numpy.linalg.inv(-hess)))
+    except numpy.linalg.LinAlgError:
+        errors = numpy.zeros(len(params)) + numpy.nan
+    x = float(params[0])
+    exponent = float(params[1]) if fitattractiveness else 1.0
+    rmse = _ShareRMSE(x, exponent, logimp, logattr, valid, observed)
+    return {
+        "x": x,
+        "attractiveness_exponent": exponent,
+        "loglikelihood": float(ll),
+        "null_loglikelihood": float(llnull),
+        "pseudo_r2": 1.0 - float(ll) / float(llnull) if llnull != 0 else 0.0,
+        "standard_errors": [float(e) for e in errors],
+        "share_rmse": rmse,
+        "iterations": iterations,
+    }
+
+
+def ReadObserved(path, origin_ids, store_names, originfield="ORIGIN_ID", storefield="STORE", valuefield="TRIPS"):
+    # Origins x stores matrix of observed trips (or shares) from a CSV table
+    # with one row per origin and store; pairs not listed count as 0
+    originpos = dict([(str(oid), i) for i, oid in enumerate(origin_ids)])
+    storepos = dict([(str(name), k) for k, name in enumerate(store_names)])
+    observed = numpy.zeros((len(originpos), len(storepos)))
+    handle = open(path, "r")
+    try:
+        reader = csv.DictReader(handle)
+        for row in reader:
+            for name in (originfield, storefield, valuefield):
+                if name not in row:
+                    raise ValueError("Field '" + name + "' was not found in " + path + ".")
+            origin = row[originfield]
+            if origin not in originpos:
+                raise ValueError("Origin '" + origin + "' in " + path + " is not in the origins.")
+            if row[storefield] not in storepos:
+                raise ValueError("Store '" + row[storefield] + "' in " + path + " is not in the stores.")
+            observed[originpos[origin], storepos[row[storefield]]] += float(row[valuefield] or 0)
+    finally:
+        handle.close()
+    return observed
+
+
+def Main(argv=None):
+    parser = optparse.OptionParser(usage="%prog stores store_name store_attr origins observed [options]")
+    parser.add_option("--origin-field", default="ORIGIN_ID", help="origin id field of the observed table (default ORIGIN_ID)")
+    parser.add_option("--store-field", default="STORE", help="store name field of the observed table (default STORE)")
+    parser.add_option("--value-field", default="TRIPS", help="trips or shares field of the observed table (default TRIPS)")
+    parser.add_option("-a", "--fit-attractiveness", action="store_true", default=False, help="also fit an attractiveness exponent")
+    parser.add_option("--cache", default="", help="folder caching the straight-line impedance matrix between runs")
+    parser.add_option("-j", "--processes", type="int", default=None, help="worker processes for the multi-start search")
+    parser.add_option("-b", "--backend", default="local", help="'local' (default) or 'gp'")
+    options, args = parser.parse_args(argv)
+    if len(args) != 5:
+        parser.error("stores, store_name, store_attr, origins and observed are required")
+    backend = HuffBackends.GetBackend(options.backend)
+    try:
+        st = backend.ReadPoints(args[0], (args[1], args[2]))
+        bg = backend.ReadPoints(args[3])
+        storexy = numpy.array(st.xy, dtype=numpy.float64)
+        originxy = numpy.array(bg.xy, dtype=numpy.float64)
+        observed = ReadObserved(args[4], bg.ids, st.Field(args[1]), options.origin_field, options.store_field, options.value_field)
+
+        # Process: Straight-line distances (minimum distance 0.1), from the cache when given...
+        if options.cache:
+            import HuffCache
+            impedance, hit = HuffCache.ImpedanceCache(options.cache).GetOrCompute(
+                HuffCache.ImpedanceKey(originxy, storexy, "NEAR_DIST"), lambda: HuffDistance.DistanceMatrix(originxy, storexy))
+        else:
+            impedance = HuffDistance.DistanceMatrix(originxy, storexy)
+        result = Calibrate(impedance, [v or 0 for v in st.Field(args[2])], observed, options.fit_attractiveness,
+                           processes=options.processes)
+    except (HuffBackends.BackendError, ValueError):
+        backend.AddError(str(sys.exc_info()[1]))
+        return 1
+
+    errors = result["standard_errors"]
+    backend.AddMessage("x: %.6g (standard error %.4g)" % (result["x"], errors[0]))
+    if options.fit_attractiveness:
+        backend.AddMessage("Attractiveness exponent: %.6g (standard error %.4g)" % (result["attractiveness_exponent"], errors[1]))
+    else:
+        backend.AddMessage("Attractiveness exponent: 1 (fixed)")
+    backend.AddMessage("Pseudo-R2: %.4f" % result["pseudo_r2"])
+    backend.AddMessage("Share RMSE: %.4g" % result["share_rmse"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
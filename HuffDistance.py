@@ -0,0 +1,136 @@
+# ---------------------------------------------------------------------------
+# HuffDistance.py
+# Usage: Straight-line distance matrices between origin and store coordinates
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+
+# Minimum distance used in place of 0 (for calculation)
+MIN_DISTANCE = 0.1
+
+# Number of origin x store cells computed per block
+BLOCK_CELLS = 1 << 20
+
+
+def _Coordinates(xy):
+    xy = numpy.asarray(xy, dtype=numpy.float64)
+    if xy.ndim != 2 or xy.shape[1] != 2:
+        raise ValueError("Coordinates must be an n x 2 array of x, y values.")
+    return xy
+
+
+def _BlockRows(numstores, blockcells):
+    return max(1, int(blockcells) // max(1, numstores))
+
+
+def IterDistanceBlocks(origin_xy, store_xy, mindist=MIN_DISTANCE, blockcells=BLOCK_CELLS):
+    # Yields (first origin row, origins x stores distance block) so that at
+    # most 'blockcells' distances are held in memory at once
+    origin_xy = _Coordinates(origin_xy)
+    store_xy = _Coordinates(store_xy)
+    rows = _BlockRows(len(store_xy), blockcells)
+    sx = store_xy[:, 0]
+    sy = store_xy[:, 1]
+    for start in range(0, len(origin_xy), rows):
+        block = origin_xy[start:start + rows]
+        dx = block[:, 0][:, numpy.newaxis] - sx
+        dy = block[:, 1][:, numpy.newaxis] - sy
+        dist = numpy.hypot(dx, dy)
+        numpy.maximum(dist, mindist, dist)
+        yield start, dist
+
+
+def DistanceMatrix(origin_xy, store_xy, mindist=MIN_DISTANCE, blockcells=BLOCK_CELLS):
+    # Full origins x stores straight-line distance matrix, computed in blocks
+    origin_xy = _Coordinates(origin_xy)
+    store_xy = _Coordinates(store_xy)
+    dist = numpy.empty((len(origin_xy), len(store_xy)))
+    for start, block in IterDistanceBlocks(origin_xy, store_xy, mindist, blockcells):
+        dist[start:start + len(block)] = block
+    return dist
+
+
+class GridIndex(object):
+    # Uniform grid over store points, with cells the size of the search radius,
+    # so every store within the radius of a point lies in the 3 x 3 cells
+    # around that point's cell
+
+    def __init__(self, store_xy, cellsize):
+        store_xy = _Coordinates(store_xy)
+        if cellsize <= 0:
+            raise ValueError("The grid cell size must be greater than zero.")
+        self.cellsize = float(cellsize)
+        self.xmin = store_xy[:, 0].min() if len(store_xy) else 0.0
+        self.ymin = store_xy[:, 1].min() if len(store_xy) else 0.0
+        cx, cy = self._Cells(store_xy)
+        self.ncols = int(cx.max()) + 1 if len(store_xy) else 1
+        self.nrows = int(cy.max()) + 1 if len(store_xy) else 1
+        keys = cx * self.nrows + cy
+        self.order = numpy.argsort(keys, kind="mergesort")
+        self.keys = keys[self.order]
+        self.store_xy = store_xy
+
+    def _Cells(self, xy):
+        cx = numpy.floor((xy[:, 0] - self.xmin) / self.cellsize).astype(numpy.int64)
+        cy = numpy.floor((xy[:, 1] - self.ymin) / self.cellsize).astype(numpy.int64)
+        return cx, cy
+
+    def Candidates(self, xy):
+        # Returns (point index, store index) for every store in the 3 x 3
+        # neighbourhood of each point
+        xy = _Coordinates(xy)
+        cx, cy = self._Cells(xy)
+        points = []
+        stores = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nx = cx + dx
+                ny = cy + dy
+                valid = (nx >= 0) & (nx < self.ncols) & (ny >= 0) & (ny < self.nrows)
+                keys = nx * self.nrows + ny
+                first = numpy.searchsorted(self.keys, keys, "left")
+                last = numpy.searchsorted(self.keys, keys, "right")
+                counts = numpy.where(valid, last - first, 0)
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                pointidx = numpy.repeat(numpy.arange(len(xy)), counts)
+                offsets = numpy.cumsum(counts) - counts
+                position = numpy.arange(total) - numpy.repeat(offsets, counts) + numpy.repeat(first, counts)
+                points.append(pointidx)
+                stores.append(self.order[position])
+        if not points:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty, empty
+        return numpy.concatenate(points), numpy.concatenate(stores)
+
+
+def DistancePairs(origin_xy, store_xy, radius, mindist=MIN_DISTANCE, blockcells=BLOCK_CELLS):
+    # Origin-store pairs no further apart than 'radius', as three arrays
+    # (origin index, store index, distance) sorted by origin then distance
+    origin_xy = _Coordinates(origin_xy)
+    store_xy = _Coordinates(store_xy)
+    radius = float(radius)
+    index = GridIndex(store_xy, radius)
+    percell = int(numpy.ceil(len(store_xy) / float(index.ncols * index.nrows)))
+    rows = _BlockRows(9 * max(1, percell), blockcells)
+    origins = []
+    stores = []
+    dists = []
+    for start in range(0, len(origin_xy), rows):
+        block = origin_xy[start:start + rows]
+        o, s = index.Candidates(block)
+        d = numpy.hypot(block[o, 0] - store_xy[s, 0], block[o, 1] - store_xy[s, 1])
+        keep = d <= radius
+        origins.append(o[keep] + start)
+        stores.append(s[keep])
+        dists.append(numpy.maximum(d[keep], mindist))
+    if not origins:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty, numpy.zeros(0)
+    origins = numpy.concatenate(origins)
+    stores = numpy.concatenate(stores)
+    dists = numpy.concatenate(dists)
+    order = numpy.lexsort((dists, origins))
+    return origins[order], stores[order], dists[order]
@@ -0,0 +1,76 @@
+# ---------------------------------------------------------------------------
+# HuffEngine.py
+# Usage: Batched Huff probability calculations on origin x store matrices
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+import HuffKernels
+
+# Default distance-decay exponent (used when the 'x' parameter is left blank)
+DEFAULT_EXPONENT = 2.0
+
+
+def HuffProbabilities(impedance, attractiveness, x=DEFAULT_EXPONENT, sales=None, kernel=None):
+    # impedance      - origins x stores array of travel cost or distance;
+    #                  unreachable pairs may be numpy.inf
+    # attractiveness - store attractiveness values, one per store column
+    # x              - distance-decay exponent
+    # sales          - optional sales/demand value, one per origin row
+    # kernel         - optional HuffKernels kernel (e.g. "tanner:2,0.0005")
+    #                  used in place of the power decay with exponent x
+    #
+    # Returns (tt_x_att, SUM_tt_x_att, prob, sales) where the last item is
+    # None when no sales vector is given.
+    impedance = numpy.asarray(impedance, dtype=numpy.float64)
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    if impedance.ndim != 2:
+        raise ValueError("Impedance must be an origins x stores matrix.")
+    if attractiveness.shape != (impedance.shape[1],):
+        raise ValueError("There must be one attractiveness value per store.")
+    if kernel is None or kernel == "":
+        if x is None or x == "":
+            x = DEFAULT_EXPONENT
+        kernel = ("power", (float(x),))
+
+    # tt_x_att = (1 / (impedance ^ x)) * attractiveness, as exp(-x * log(impedance)) * attractiveness
+    return HuffKernels.KernelProbabilities(kernel, HuffKernels.LogImpedance(impedance), attractiveness, sales)
+
+
+# Number of origin rows per block in the scenario sales products
+BLOCK_ROWS = 1 << 14
+
+
+def _Demand(demand, numorigins):
+    demand = numpy.asarray(demand, dtype=numpy.float64)
+    if demand.ndim == 1:
+        demand = demand[:, numpy.newaxis]
+    if demand.ndim != 2 or demand.shape[0] != numorigins:
+        raise ValueError("Demand must be an origins x scenarios matrix.")
+    return demand
+
+
+def ScenarioSales(prob, demand, blockrows=BLOCK_ROWS):
+    # prob   - origins x stores probabilities (computed once)
+    # demand - origins x scenarios sales/demand values (e.g. 12 months or
+    #          several growth projections)
+    #
+    # Returns the stores x scenarios expected sales totals, prob.T x demand,
+    # accumulated over blocks of origin rows so that prob may be memory-mapped.
+    numorigins = prob.shape[0]
+    demand = _Demand(demand, numorigins)
+    totals = numpy.zeros((prob.shape[1], demand.shape[1]))
+    for start in range(0, numorigins, blockrows):
+        block = numpy.asarray(prob[start:start + blockrows], dtype=numpy.float64)
+        totals += numpy.dot(block.T, demand[start:start + blockrows])
+    return totals
+
+
+def IterScenarioSales(prob, demand, scenarios=None):
+    # Per-origin breakdown: yields (scenario, origins x stores expected
+    # sales) for each requested scenario column, one at a time
+    demand = _Demand(demand, prob.shape[0])
+    if scenarios is None:
+        scenarios = range(demand.shape[1])
+    for s in scenarios:
+        yield s, prob * demand[:, s][:, numpy.newaxis]
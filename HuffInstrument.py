@@ -0,0 +1,238 @@
+# ---------------------------------------------------------------------------
+# HuffInstrument.py
+# Usage: Stage timing for Huff model runs: wall/CPU time, peak memory and
+#        row/pair counts per stage, sent to a sink (e.g. a JSON lines file)
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import os, sys, time, json, gc, threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Seconds between resident memory samples taken during a stage
+SAMPLE_INTERVAL = 0.02
+
+_clock = getattr(time, "process_time", None) or time.clock
+
+
+class JSONLinesSink(object):
+    # Appends one JSON object per stage record to a file
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        handle = open(self.path, "a")
+        try:
+            handle.write(json.dumps(record, sort_keys=True) + "\n")
+        finally:
+            handle.close()
+
+
+class ListSink(object):
+    # Keeps the records in memory (self.records)
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+def _WindowsRSS():
+    # Working set of the process from GetProcessMemoryInfo
+    import ctypes
+    from ctypes import wintypes
+
+    class Counters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + \
+                   [(name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize",
+                    "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                    "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+    counters = Counters()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+        return None
+    return counters.WorkingSetSize
+
+
+def _RSS():
+    # Current resident memory (working set) of the process in bytes, where
+    # the platform reports it
+    try:
+        if psutil is not None:
+            return psutil.Process().memory_info().rss
+        if sys.platform == "win32":
+            return _WindowsRSS()
+        if os.path.exists("/proc/self/statm"):
+            handle = open("/proc/self/statm")
+            try:
+                return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            finally:
+                handle.close()
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+class _PeakSampler(object):
+    # Highest resident memory seen while it runs, sampled on a thread (the
+    # process peak the OS keeps covers the whole run, not one stage)
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = _RSS()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._Run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _Run(self):
+        while not self._stop.wait(self.interval):
+            self._Sample()
+
+    def _Sample(self):
+        rss = _RSS()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+    def Stop(self):
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._Sample()
+        return self.peak
+
+
+class StageRecorder(object):
+    # sink     - callable taking one record (dict) per finished stage, or a
+    #            list of them; None keeps records only in self.records
+    # backend  - optional HuffBackends backend (or geoprocessor) whose
+    #            progressor is set at the start of every stage
+    # memory   - trace peak memory allocated in each stage (tracemalloc,
+    #            left running when the caller already traces); otherwise
+    #            the stage's peak resident size is sampled
+    # profile  - path of a .prof file (pstats format) that receives the
+    #            cProfile of the slowest stage when the recorder is closed
+    #
+    # Stages are run with Begin(name, ...) ... End(rows=..., pairs=...), or
+    # with the Stage() context manager.
+
+    def __init__(self, sink=None, backend=None, memory=False, profile=None, run=None):
+        if sink is None:
+            sinks = []
+        elif isinstance(sink, (list, tuple)):
+            sinks = list(sink)
+        else:
+            sinks = [sink]
+        self.sinks = sinks
+        self.backend = backend
+        self.memory = memory and tracemalloc is not None
+        self.profile = profile
+        self.run = run or time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.records = []
+        self._current = None
+        self._hottest = None
+
+    def Begin(self, name, message=None, kind="default", minimum=0, maximum=1, step=1):
+        # Starts a stage (ending any open one); with a message, also sets the progressor
+        if self._current is not None:
+            self.End()
+        if message is not None and self.backend is not None:
+            self.backend.SetProgressor(kind, message, minimum, maximum, step)
+        stage = {"name": name}
+        if self.profile:
+            import cProfile
+            stage["profiler"] = cProfile.Profile()
+        if self.memory:
+            gc.collect()
+            stage["tracing"] = tracemalloc.is_tracing()
+            if not stage["tracing"]:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            stage["traced"] = tracemalloc.get_traced_memory()[0]
+        else:
+            stage["sampler"] = _PeakSampler()
+        stage["wall"] = time.time()
+        stage["cpu"] = _clock()
+        self._current = stage
+        if "profiler" in stage:
+            stage["profiler"].enable()
+
+    def End(self, **counts):
+        # Ends the open stage and sends its record; keyword arguments (rows,
+        # pairs, ...) are stored with it
+        stage = self._current
+        if stage is None:
+            return None
+        if "profiler" in stage:
+            stage["profiler"].disable()
+        record = {"run": self.run, "stage": stage["name"],
+                  "wall": time.time() - stage["wall"], "cpu": _clock() - stage["cpu"]}
+        if self.memory:
+            record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - stage["traced"]
+            if not stage["tracing"]:
+                tracemalloc.stop()
+            elif not hasattr(tracemalloc, "reset_peak"):
+                # The peak then covers the caller's whole trace, not this stage
+                record["peak_bytes"] = None
+        else:
+            record["peak_rss"] = stage["sampler"].Stop()
+        record.update(counts)
+        self._current = None
+        if "profiler" in stage and (self._hottest is None or record["wall"] > self._hottest[0]):
+            self._hottest = (record["wall"], stage["name"], stage["profiler"])
+        self.records.append(record)
+        for sink in self.sinks:
+            sink(record)
+        return record
+
+    def Stage(self, name, message=None, kind="default", minimum=0, maximum=1, step=1):
+        return _Stage(self, name, (message, kind, minimum, maximum, step))
+
+    def Close(self):
+        # Ends any open stage and writes the slowest stage's profile; returns
+        # that stage's name (None without profiling)
+        self.End()
+        if self._hottest is None:
+            return None
+        wall, name, profiler = self._hottest
+        profiler.dump_stats(self.profile)
+        self._hottest = None
+        return name
+
+
+class _Stage(object):
+
+    def __init__(self, recorder, name, progress):
+        self.recorder = recorder
+        self.name = name
+        self.progress = progress
+        self.counts = {}
+
+    def Count(self, **counts):
+        # Sets row/pair counts recorded when the stage ends
+        self.counts.update(counts)
+
+    def __enter__(self):
+        self.recorder.Begin(self.name, *self.progress)
+        return self
+
+    def __exit__(self, kind, value, tb):
+        if kind is not None:
+            self.counts["error"] = str(value)
+        self.recorder.End(**self.counts)
+        return False
@@ -0,0 +1,146 @@
+# ---------------------------------------------------------------------------
+# HuffKernels.py
+# Usage: Distance-decay kernels evaluated over a cached log-impedance array:
+#        power, exponential, Box-Cox, Tanner and power with an
+#        attractiveness exponent
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+
+# Kernel names, their parameters and their log decay, with L = log(impedance):
+#   power       x            -x * L
+#   exponential beta         -beta * impedance
+#   boxcox      beta, lambda -beta * (impedance^lambda - 1) / lambda
+#                            (-beta * L when lambda is 0)
+#   tanner      x, beta      -x * L - beta * impedance
+#   powerattr   x, alpha     -x * L, attractiveness raised to alpha
+KERNELS = {"power": 1, "exponential": 1, "boxcox": 2, "tanner": 2, "powerattr": 2}
+
+# Rows whose largest log weight is beyond this are rescaled before exp()
+# (exp overflows past 709 and underflows to 0 below -745)
+LOG_SAFE = 700.0
+
+
+def ParseKernel(text):
+    # "power:2", "exponential:0.001", "boxcox:2,0.5", "tanner:2,0.0005",
+    # "powerattr:2,1.2" or a plain number (power with that x). Returns
+    # (name, parameters).
+    if isinstance(text, tuple):
+        return text
+    text = str(text).strip()
+    try:
+        return ("power", (float(text),))
+    except ValueError:
+        pass
+    kind, sep, params = text.partition(":")
+    kind = kind.strip().lower()
+    if kind not in KERNELS:
+        raise ValueError("Unknown kernel '" + kind + "'. Use one of " + ", ".join(sorted(KERNELS)) + ".")
+    try:
+        params = tuple([float(v) for v in params.split(",")])
+    except ValueError:
+        raise ValueError("Kernel parameters must be numbers: '" + text + "'.")
+    if len(params) != KERNELS[kind]:
+        raise ValueError("The " + kind + " kernel takes " + str(KERNELS[kind]) + " parameters.")
+    return kind, params
+
+
+def LogImpedance(impedance):
+    # log(impedance), computed once and shared by every kernel and parameter
+    # value; unreachable pairs (inf, nan, 0 or less) are +inf
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        logimp = numpy.log(numpy.asarray(impedance, dtype=numpy.float64))
+    finally:
+        numpy.seterr(**old)
+    logimp[~numpy.isfinite(logimp)] = numpy.inf
+    return logimp
+
+
+def LogAttractiveness(attractiveness, kernel="power:2"):
+    # log of the kernel's attractiveness term (-inf for stores with none)
+    kind, params = ParseKernel(kernel)
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        logattr = numpy.log(numpy.asarray(attractiveness, dtype=numpy.float64))
+    finally:
+        numpy.seterr(**old)
+    logattr[~numpy.isfinite(logattr)] = -numpy.inf
+    if kind == "powerattr":
+        logattr[numpy.isfinite(logattr)] *= params[1]
+    return logattr
+
+
+def LogDecay(kernel, logimp, out=None):
+    # Log of the kernel's decay for every pair of a log-impedance array, in
+    # place in 'out' when given; unreachable pairs are -inf
+    kind, params = ParseKernel(kernel)
+    unreachable = numpy.isinf(logimp)
+    if out is None:
+        out = numpy.empty(logimp.shape)
+    numpy.copyto(out, logimp)
+    out[unreachable] = 0.0
+    if kind in ("power", "powerattr"):
+        out *= -params[0]
+    elif kind == "exponential":
+        numpy.exp(out, out=out)
+        out *= -params[0]
+    elif kind == "tanner":
+        distance = numpy.exp(out)
+        out *= -params[0]
+        distance *= params[1]
+        out -= distance
+    elif params[1] == 0:
+        out *= -params[0]
+    else:
+        out *= params[1]
+        numpy.expm1(out, out=out)
+        out *= -params[0] / params[1]
+    out[unreachable] = -numpy.inf
+    return out
+
+
+def KernelWeights(kernel, logimp, logattr):
+    # tt_x_att = decay * attractiveness term for every pair, as exp(log
+    # decay + log attractiveness). Rows whose largest value would overflow,
+    # or underflow to all zeros, are divided by that value first, which leaves
+    # their probabilities unchanged. Returns (tt_x_att, log of the row scale).
+    out = LogDecay(kernel, logimp)
+    out += logattr
+    old = numpy.seterr(invalid="ignore", under="ignore")
+    try:
+        top = out.max(axis=1)
+        scale = numpy.where(numpy.isfinite(top) & (numpy.abs(top) > LOG_SAFE), top, 0.0)
+        if scale.any():
+            out -= scale[:, numpy.newaxis]
+        numpy.exp(out, out=out)
+    finally:
+        numpy.seterr(**old)
+    return out, scale
+
+
+def KernelProbabilities(kernel, logimp, attractiveness, sales=None):
+    # Huff probabilities with any kernel over a cached log-impedance array.
+    # Returns (tt_x_att, SUM_tt_x_att, prob, sales) like
+    # HuffEngine.HuffProbabilities; tt_x_att and SUM_tt_x_att of rescaled
+    # rows are relative to their largest pair.
+    logattr = LogAttractiveness(attractiveness, kernel)
+    if logimp.ndim != 2:
+        raise ValueError("Impedance must be an origins x stores matrix.")
+    if logattr.shape != (logimp.shape[1],):
+        raise ValueError("There must be one attractiveness value per store.")
+    tt_x_att, scale = KernelWeights(kernel, logimp, logattr)
+    sum_tt_x_att = tt_x_att.sum(axis=1)
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        prob = tt_x_att / sum_tt_x_att[:, numpy.newaxis]
+        prob[~numpy.isfinite(prob)] = 0.0
+    finally:
+        numpy.seterr(**old)
+    if sales is None:
+        return tt_x_att, sum_tt_x_att, prob, None
+    sales = numpy.asarray(sales, dtype=numpy.float64)
+    if sales.shape != (logimp.shape[0],):
+        raise ValueError("There must be one sales value per origin.")
+    return tt_x_att, sum_tt_x_att, prob, prob * sales[:, numpy.newaxis]
@@ -0,0 +1,299 @@
+# ---------------------------------------------------------------------------
+# HuffMarketAreas.py
+# Usage: Market-area polygons from multi-band probability surfaces: the
+#        dominant store of every cell, connected regions and their outlines,
+#        with store, area and captured demand per polygon
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+import HuffBackends, HuffSurface
+
+# Largest number of band x cell values read at once
+BLOCK_CELLS = 1 << 22
+
+
+def DominantRuns(surfaces, numstores, blockcells=BLOCK_CELLS, nodata=HuffSurface.NODATA):
+    # surfaces  - (bands, rows, cols) array (e.g. the memory map written by
+    #             HuffSurface); the first 'numstores' bands are probabilities
+    #
+    # Reads strips of rows, takes the store with the highest probability in
+    # every cell and run-length encodes each row. Returns (row, start column,
+    # end column, store) arrays, one entry per run of equal cells, with store
+    # numbers 1-based and 0 for NODATA cells. Runs are ordered row by row.
+    bands, nrows, ncols = surfaces.shape
+    strip = max(1, int(blockcells) // max(1, numstores * ncols))
+    runs = []
+    for row0 in range(0, nrows, strip):
+        row1 = min(nrows, row0 + strip)
+        values = numpy.asarray(surfaces[:numstores, row0:row1, :])
+        dominant = numpy.argmax(values, axis=0).astype(numpy.int32) + 1
+        dominant[values[0] == nodata] = 0
+        change = numpy.ones(dominant.shape, dtype=bool)
+        change[:, 1:] = dominant[:, 1:] != dominant[:, :-1]
+        rows, starts = numpy.nonzero(change)
+        ends = numpy.append(starts[1:], ncols)
+        ends[numpy.append(rows[1:] != rows[:-1], True)] = ncols
+        runs.append((rows + row0, starts, ends, dominant[rows, starts]))
+    return tuple([numpy.concatenate([run[k] for run in runs]) for k in range(4)])
+
+
+def _RunAt(keys, rows, cols, ncols):
+    # Index of the run holding each (row, col) cell; keys are run start
+    # positions row * ncols + start column
+    return numpy.searchsorted(keys, rows * ncols + cols, "right") - 1
+
+
+def _Groups(first, count):
+    # For ranges [first, first + count): (range number, value) of every member
+    owner = numpy.repeat(numpy.arange(len(count)), count)
+    offset = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count) - count, count)
+    return owner, first[owner] + offset
+
+
+def _Components(numnodes, u, v):
+    # Connected components of an undirected graph: every node ends up
+    # labelled with the smallest node of its component (hooking and pointer
+    # jumping, so it runs in a handful of array passes)
+    labels = numpy.arange(numnodes)
+    while True:
+        lu = labels[u]
+        lv = labels[v]
+        differ = lu != lv
+        if not differ.any():
+            return labels
+        lu = lu[differ]
+        lv = lv[differ]
+        low = numpy.minimum(lu, lv)
+        numpy.minimum.at(labels, lu, low)
+        numpy.minimum.at(labels, lv, low)
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+
+
+def LabelRuns(rows, starts, ends, stores, ncols):
+    # Connected regions (4-connected) of cells with the same dominant store.
+    # Returns the region of every run (-1 for NODATA runs), numbered from 0
+    # in the order of their first run.
+    keys = rows * ncols + starts
+    nrows = int(rows.max()) + 1 if len(rows) else 0
+    # Runs of the next row that overlap each run
+    upper = numpy.nonzero(rows < nrows - 1)[0]
+    first = _RunAt(keys, rows[upper] + 1, starts[upper], ncols)
+    last = _RunAt(keys, rows[upper] + 1, ends[upper] - 1, ncols)
+    owner, other = _Groups(first, last - first + 1)
+    u = upper[owner]
+    same = (stores[u] == stores[other]) & (stores[u] > 0)
+    labels = _Components(len(rows), u[same], other[same])
+    region = numpy.zeros(len(rows), dtype=numpy.int64) - 1
+    valid = stores > 0
+    uniques, firsts, inverse = numpy.unique(labels[valid], return_index=True, return_inverse=True)
+    # Number regions by their first run (top to bottom, left to right)
+    order = numpy.argsort(numpy.argsort(firsts, kind="mergesort"), kind="mergesort")
+    region[valid] = order[inverse.ravel()]
+    return region
+
+
+def _Edges(rows, starts, ends, region, nrows, ncols):
+    # Boundary edges of every region on the cell corner lattice (x = column,
+    # y = row, both counted from the top left), directed with the region on
+    # their right in lattice terms, which is on their left on the map (outer
+    # rings run counterclockwise there until MarketAreas reverses them)
+    keys = rows * ncols + starts
+    valid = region >= 0
+    r = rows[valid]
+    g = region[valid]
+    # Vertical edges: down the left end of every run, up the right end
+    x0 = [starts[valid], ends[valid]]
+    y0 = [r, r + 1]
+    x1 = [starts[valid], ends[valid]]
+    y1 = [r + 1, r]
+    owner = [g, g]
+
+    # Horizontal edges: on each line between rows, split at every run start
+    # of the rows above and below, and keep the pieces whose regions differ
+    line = numpy.concatenate((rows, rows + 1))
+    col = numpy.concatenate((starts, starts))
+    points = numpy.unique(line * (ncols + 1) + col)
+    line = points // (ncols + 1)
+    col0 = points % (ncols + 1)
+    col1 = numpy.append(col0[1:], ncols)
+    col1[numpy.append(line[1:] != line[:-1], True)] = ncols
+    up = numpy.zeros(len(line), dtype=numpy.int64) - 1
+    down = numpy.zeros(len(line), dtype=numpy.int64) - 1
+    has = line > 0
+    up[has] = region[_RunAt(keys, line[has] - 1, col0[has], ncols)]
+    has = line < nrows
+    down[has] = region[_RunAt(keys, line[has], col0[has], ncols)]
+    differ = up != down
+    # Top edges of the region below run right to left, bottom edges of the region above left to right
+    top = differ & (down >= 0)
+    x0.append(col1[top])
+    y0.append(line[top])
+    x1.append(col0[top])
+    y1.append(line[top])
+    owner.append(down[top])
+    bottom = differ & (up >= 0)
+    x0.append(col0[bottom])
+    y0.append(line[bottom])
+    x1.append(col1[bottom])
+    y1.append(line[bottom])
+    owner.append(up[bottom])
+    return tuple([numpy.concatenate(part) for part in (x0, y0, x1, y1, owner)])
+
+
+def _Rings(x0, y0, x1, y1, owner, ncols):
+    # Chains directed edges into closed rings. Returns (ring of every edge,
+    # edge order along the rings); rings are numbered by their first edge.
+    count = len(x0)
+    width = ncols + 1
+    vertices = (numpy.max(numpy.concatenate((y0, y1))) + 1) * width if count else 1
+    startkey = owner * vertices + y0 * width + x0
+    endkey = owner * vertices + y1 * width + x1
+    order = numpy.argsort(startkey, kind="mergesort")
+    sortedkeys = startkey[order]
+    first = numpy.searchsorted(sortedkeys, endkey, "left")
+    last = numpy.searchsorted(sortedkeys, endkey, "right")
+    following = order[first]
+    # Where a region touches itself at a corner, turn towards the region
+    # (clockwise in lattice terms) so cells joined only diagonally stay apart
+    pinch = numpy.nonzero(last - first > 1)[0]
+    if len(pinch):
+        dx = numpy.sign(x1[pinch] - x0[pinch])
+        dy = numpy.sign(y1[pinch] - y0[pinch])
+        candidate = order[first[pinch] + 1]
+        left = (numpy.sign(x1[candidate] - x0[candidate]) == dy) & (numpy.sign(y1[candidate] - y0[candidate]) == -dx)
+        following[pinch[left]] = candidate[left]
+
+    # Process: Ring of every edge (smallest edge in its cycle), by pointer doubling...
+    ring = numpy.arange(count)
+    jump = following.copy()
+    span = 1
+    while span < count:
+        ring = numpy.minimum(ring, ring[jump])
+        jump = jump[jump]
+        span *= 2
+
+    # Process: Position of every edge along its ring (list ranking from the ring's first edge)...
+    previous = numpy.empty(count, dtype=numpy.int64)
+    previous[following] = numpy.arange(count)
+    heads = ring == numpy.arange(count)
+    pointer = numpy.where(heads, numpy.arange(count), previous)
+    rank = numpy.where(heads, 0, 1)
+    while (pointer[pointer] != pointer).any():
+        rank = rank + rank[pointer]
+        pointer = pointer[pointer]
+    return ring, numpy.lexsort((rank, ring))
+
+
+def MarketAreas(surfaces, grid, numstores, storenames=None, storeids=None, origin_xy=None, prob=None, sales=None,
+                blockcells=BLOCK_CELLS):
+    # surfaces   - (bands, rows, cols) probability surfaces on 'grid' (the
+    #              first 'numstores' bands), e.g. from HuffSurface
+    # storenames - store names (default: store numbers), storeids - their ids
+    # origin_xy  - optional origins with their origins x stores 'prob' and
+    #              'sales', for the demand inside every market area
+    #
+    # Returns a HuffBackends.PointTable of market-area polygons (rings, with
+    # a cell inside each as its point) with the fields Market (store name),
+    # STORE_ID, CELLS, AREA, and with origins DEMAND (sales of the origins
+    # inside, 1 each without sales) and CAPTURED (their expected sales at
+    # the market's store).
+    bands, nrows, ncols = surfaces.shape
+    if storenames is None:
+        storenames = [str(j + 1) for j in range(numstores)]
+    if storeids is None:
+        storeids = range(1, numstores + 1)
+    storenames = list(storenames)
+    storeids = list(storeids)
+
+    # Process: Dominant store of every cell, strip by strip, as runs...
+    rows, starts, ends, stores = DominantRuns(surfaces, numstores, blockcells)
+
+    # Process: Connected regions of runs with the same store...
+    region = LabelRuns(rows, starts, ends, stores, ncols)
+    numregions = int(region.max()) + 1 if len(region) else 0
+    if numregions == 0:
+        # Every cell is NODATA (outside the study area): no market areas
+        fields = {"Market": [], "STORE_ID": [], "CELLS": [], "AREA": []}
+        if origin_xy is not None:
+            fields["DEMAND"] = []
+            if prob is not None:
+                fields["CAPTURED"] = []
+        return HuffBackends.PointTable([], [], fields, [])
+    valid = region >= 0
+    regionstore = numpy.zeros(numregions, dtype=numpy.int64)
+    regionstore[region[valid]] = stores[valid] - 1
+    cells = numpy.bincount(region[valid], ends[valid] - starts[valid], minlength=numregions).astype(numpy.int64)
+    firstrun = numpy.nonzero(valid)[0][numpy.unique(region[valid], return_index=True)[1]]
+
+    # Process: Outlines, with runs of edges in the same direction merged into one segment...
+    x0, y0, x1, y1, owner = _Edges(rows, starts, ends, region, nrows, ncols)
+    ring, order = _Rings(x0, y0, x1, y1, owner, ncols)
+    x0 = x0[order]
+    y0 = y0[order]
+    dx = numpy.sign(x1[order] - x0)
+    dy = numpy.sign(y1[order] - y0)
+    ring = ring[order]
+    owner = owner[order]
+    ringstart = numpy.append(True, ring[1:] != ring[:-1])
+    ringfirst = numpy.nonzero(ringstart)[0]
+    ringlast = numpy.append(ringfirst[1:], len(ring)) - 1
+    before = numpy.arange(len(ring)) - 1
+    before[ringfirst] = ringlast
+    corner = (dx != dx[before]) | (dy != dy[before])
+    px = grid.xmin + x0[corner] * grid.cellsize
+    py = grid.ymax - y0[corner] * grid.cellsize
+    pring = numpy.cumsum(ringstart)[corner] - 1
+    pringstart = numpy.searchsorted(pring, numpy.arange(len(ringfirst)))
+    pringend = numpy.append(pringstart[1:], len(pring))
+    # Signed area of every ring as traced: outer rings run counterclockwise
+    # on the map (positive), holes clockwise (negative)
+    nextpoint = numpy.arange(len(px)) + 1
+    nextpoint[pringend - 1] = pringstart
+    signed = numpy.bincount(pring, px * py[nextpoint] - px[nextpoint] * py, minlength=len(ringfirst)) / 2.0
+    ringregion = owner[ringfirst]
+    # Every region's rings must enclose exactly its cells
+    enclosed = numpy.bincount(ringregion, signed, minlength=numregions)
+    if not numpy.allclose(enclosed, cells * grid.cellsize ** 2):
+        raise ValueError("Market-area outlines do not match their cells.")
+
+    # Process: Demand inside every market area, from the origins' cells...
+    demand = None
+    captured = None
+    if origin_xy is not None:
+        origin_xy = numpy.asarray(origin_xy, dtype=numpy.float64).reshape(-1, 2)
+        col = numpy.floor((origin_xy[:, 0] - grid.xmin) / grid.cellsize).astype(numpy.int64)
+        row = numpy.floor((grid.ymax - origin_xy[:, 1]) / grid.cellsize).astype(numpy.int64)
+        ongrid = (col >= 0) & (col < ncols) & (row >= 0) & (row < nrows)
+        originregion = numpy.zeros(len(origin_xy), dtype=numpy.int64) - 1
+        originregion[ongrid] = region[_RunAt(rows * ncols + starts, row[ongrid], col[ongrid], ncols)]
+        inside = numpy.nonzero(originregion >= 0)[0]
+        weight = numpy.ones(len(origin_xy)) if sales is None else numpy.asarray(sales, dtype=numpy.float64)
+        demand = numpy.bincount(originregion[inside], weight[inside], minlength=numregions)
+        if prob is not None:
+            share = numpy.asarray(prob)[inside, regionstore[originregion[inside]]]
+            captured = numpy.bincount(originregion[inside], weight[inside] * share, minlength=numregions)
+
+    # Process: Assemble the polygons (outer ring first, then holes), reversing every ring so outer rings run
+    # clockwise and holes counterclockwise, as shapefiles and the geoprocessor expect...
+    polygons = [[] for g in range(numregions)]
+    for k in numpy.argsort(-signed, kind="mergesort"):
+        ring = list(zip(px[pringstart[k]:pringend[k]].tolist(), py[pringstart[k]:pringend[k]].tolist()))
+        ring.append(ring[0])
+        ring.reverse()
+        polygons[ringregion[k]].append(ring)
+    labelxy = numpy.column_stack((grid.xmin + (starts[firstrun] + 0.5) * grid.cellsize,
+                                  grid.ymax - (rows[firstrun] + 0.5) * grid.cellsize))
+    fields = {"Market": [storenames[j] for j in regionstore],
+              "STORE_ID": [storeids[j] for j in regionstore],
+              "CELLS": cells.tolist(),
+              "AREA": (cells * grid.cellsize ** 2).tolist()}
+    if demand is not None:
+        fields["DEMAND"] = demand.tolist()
+    if captured is not None:
+        fields["CAPTURED"] = captured.tolist()
+    return HuffBackends.PointTable(range(1, numregions + 1), labelxy.tolist(), fields, polygons)
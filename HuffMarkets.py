@@ -0,0 +1,93 @@
+# ---------------------------------------------------------------------------
+# HuffMarkets.py
+# Usage: Market-area and competitive-overlap analytics on the origin x store
+#        probability matrix
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+
+# Number of origin x store cells processed per block
+BLOCK_CELLS = 1 << 22
+
+
+def _BlockRows(numstores, blockcells):
+    return max(1, int(blockcells) // max(1, numstores))
+
+
+def DominantStores(prob):
+    # Returns (dominant store, runner-up store, winning margin) per origin;
+    # the runner-up is -1 and the margin the full probability when there is
+    # only one store. Origins without any probability get -1 for both.
+    prob = numpy.asarray(prob, dtype=numpy.float64)
+    numorigins, numstores = prob.shape
+    if numstores == 1:
+        dominant = numpy.zeros(numorigins, dtype=numpy.int64)
+        runnerup = numpy.zeros(numorigins, dtype=numpy.int64) - 1
+        margin = prob[:, 0].copy()
+    else:
+        # Ties go to the highest store index, like the tool's scan that
+        # keeps the last store with prob >= the best so far
+        rows = numpy.arange(numorigins)
+        dominant = numstores - 1 - numpy.argmax(prob[:, ::-1], axis=1)
+        rest = prob.copy()
+        rest[rows, dominant] = -numpy.inf
+        runnerup = numstores - 1 - numpy.argmax(rest[:, ::-1], axis=1)
+        margin = prob[rows, dominant] - prob[rows, runnerup]
+    empty = prob.sum(axis=1) <= 0
+    dominant[empty] = -1
+    runnerup[empty] = -1
+    return dominant, runnerup, margin
+
+
+def ConcentrationIndex(prob):
+    # Herfindahl-Hirschman index of every origin's store shares (1 = captive
+    # to one store, 1/stores = evenly split)
+    prob = numpy.asarray(prob, dtype=numpy.float64)
+    return numpy.einsum("ij,ij->i", prob, prob)
+
+
+def StoreSales(prob, sales):
+    # Expected sales of every store
+    return numpy.dot(numpy.asarray(sales, dtype=numpy.float64), numpy.asarray(prob, dtype=numpy.float64))
+
+
+def CannibalizationMatrix(prob, sales, blockcells=BLOCK_CELLS):
+    # Store x store matrix: entry [j, k] is the expected sales store k would
+    # gain if store j closed. Under the Huff model, store j's share of each
+    # origin is redistributed in proportion to the remaining stores' shares,
+    # so [j, k] = sum_i sales_i * p_ij * p_ik / (1 - p_ij).
+    prob = numpy.asarray(prob, dtype=numpy.float64)
+    sales = numpy.asarray(sales, dtype=numpy.float64)
+    numorigins, numstores = prob.shape
+    matrix = numpy.zeros((numstores, numstores))
+    rows = _BlockRows(numstores, blockcells)
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        for start in range(0, numorigins, rows):
+            P = prob[start:start + rows]
+            lost = P * sales[start:start + rows][:, numpy.newaxis] / (1.0 - P)
+            # A store with the whole origin leaves nothing to redistribute
+            lost[~numpy.isfinite(lost)] = 0.0
+            matrix += numpy.dot(lost.T, P)
+    finally:
+        numpy.seterr(**old)
+    numpy.fill_diagonal(matrix, 0.0)
+    return matrix
+
+
+def MarketSummary(prob, sales=None):
+    # All per-origin and per-store analytics in one call, as a dictionary of
+    # arrays: dominant, runnerup, margin, hhi, and (with sales) storesales
+    # and cannibalization
+    dominant, runnerup, margin = DominantStores(prob)
+    summary = {
+        "dominant": dominant,
+        "runnerup": runnerup,
+        "margin": margin,
+        "hhi": ConcentrationIndex(prob),
+    }
+    if sales is not None:
+        summary["storesales"] = StoreSales(prob, sales)
+        summary["cannibalization"] = CannibalizationMatrix(prob, sales)
+    return summary
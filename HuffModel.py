@@ -5,13 +5,13 @@
 # ---------------------------------------------------------------------------
 
 # Import system modules
-import sys, string, arcgisscripting, os, traceback, shutil, re
+import sys, string, os, traceback, shutil, re
+import numpy
+import HuffBackends, HuffEngine, HuffDistance, HuffCache, HuffMarkets, HuffInstrument, HuffStores
 
-# Create the Geoprocessor object
-gp = arcgisscripting.create(9.3)
-
-# Set overwrite 
-gp.overwriteoutput = 1
+# Create the Geoprocessor object (arcgisscripting is imported by the backend, which also sets overwrite)
+backend = HuffBackends.GeoprocessorBackend()
+gp = backend.gp
 
 def AddPrintMessage(msg, severity):
     print msg
@@ -36,14 +36,19 @@ try:
     marketareas = gp.getparameterastext(11)
     potential_st = gp.getparameterastext(12)
     surfaces = gp.getparameterastext(13)
+    # (parameters 14-16 are the derived outputs)
+    outputformat = gp.getparameterastext(17)
 
     # Make sure ArcInfo license is available
     if gp.productinfo().lower() not in ['arcinfo', 'arcserver']:
         gp.adderror("An ArcInfo or ArcServer license is required to run this tool.")
         sys.exit()
         
+    # Each stage's wall/CPU time, memory and row/pair counts are appended to HuffModel_stages.jsonl in the output folder
+    stages = HuffInstrument.StageRecorder(HuffInstrument.JSONLinesSink(outfolder + os.sep + "HuffModel_stages.jsonl"), backend)
+
     # Establish 'step' progressor settings
-    gp.SetProgressor("step", "Checking inputs against parameter requirements..." , 0, 9, 1) 
+    stages.Begin("inputs", "Checking inputs against parameter requirements...", "step", 0, 9, 1)
 
     # Process: Make output file gdb
     gp.createfilegdb(outfolder, "output.gdb")
@@ -54,6 +59,8 @@ try:
     outfc = outputgdb + fc_name
     outmarkets = outputgdb + "Surface_Markets"
     outpotential = outputgdb + "potential_stores"
+    outpairs = outfolder + os.sep + str(fc_name) + "_pairs.zip"
+    longoutput = outputformat.lower() == "long"
 
     # Check to make sure user has the necessary extensions...
     if distances.lower() == 'true':
@@ -78,6 +85,9 @@ try:
         except:
             gp.adderror("Spatial Analyst extension is not licensed. Surfaces cannot be interpolated. Uncheck the 'Generate Probability Surfaces' option to process the model without generating surfaces.")
             sys.exit()
+    elif marketareas.lower() == "surfaces" or marketareas.lower() == "both":
+        gp.adderror("Market areas from surfaces need the probability surfaces. Check the 'Generate Probability Surfaces' option or create market areas from origins.")
+        sys.exit()
 
     # Check to make sure there are a sufficient number of stores for modeling (>1)
     numstoresondisk = gp.getcount_management(stores).getoutput(0)
@@ -89,19 +99,30 @@ try:
         gp.adderror("There are an insufficient number of stores to perform modeling. There must be at least two total records between the Store Locations dataset and the Potential Stores feature set.")
         sys.exit()
 
-    # Check to make sure there are no duplicate field values in the Store Name Field
+    # Process: Read store IDs, names and attractiveness values in a single pass...
     desc = gp.describe(stores)
+    OIDfield = desc.OIDFieldName
+    sIDList = []
     sNameList = []
-    
+    sAttrList = []
     cur = gp.SearchCursor(stores)
     row = cur.Next()
     while row :
-        sName = row.GetValue(store_name)
-        if sName in sNameList:
-            gp.adderror("Field values in field '" + str(store_name) + "' are not unique. Use a different field.")
-            sys.exit()
-        sNameList.append(sName)
+        sIDList.append(row.GetValue(OIDfield))
+        sNameList.append(row.GetValue(store_name))
+        sAttrList.append(row.GetValue(store_attr))
         row = cur.Next()
+    del cur
+    storetable = HuffStores.StoreTable(sIDList, sNameList, sAttrList)
+
+    # Check to make sure there are no duplicate field values in the Store Name Field
+    if storetable.Duplicate() is not None:
+        gp.adderror("Field values in field '" + str(store_name) + "' are not unique. Use a different field.")
+        sys.exit()
+    collision = storetable.Collision()
+    if collision is not None:
+        gp.adderror("Store names '" + str(collision[0]) + "' and '" + str(collision[1]) + "' both become '" + collision[2] + "' in output field names. Rename one of them.")
+        sys.exit()
             
     # Check to make sure all input parameters are in a common projected coordinate system
     if blockgroups == "":
@@ -128,17 +149,8 @@ try:
             sys.exit()
 
     # Warn that stores with an attribute value of 0 or less will be dropped from analysis
-    desc = gp.describe(stores)
-    OIDfield = desc.OIDFieldName
-    
-    cur = gp.SearchCursor(stores)
-    row = cur.Next()
-    while row :
-        attr_val = row.GetValue(store_attr)
-        OID_val = row.GetValue(OIDfield)
-        if attr_val <= 0:
-            gp.addwarning("Feature " + str(OID_val) + " in dataset: " + str(stores) + " has an attractiveness value of less than or equal to zero. This store location will be excluded from modeling.")
-        row = cur.Next()
+    for k in storetable.Excluded():
+        gp.addwarning("Feature " + str(storetable.sourceids[k]) + " in dataset: " + str(stores) + " has an attractiveness value of less than or equal to zero. This store location will be excluded from modeling.")
 
     # Process: Convert Store locations to points and replace nonalphanumeric characters in store names with underscore...
     gp.select(stores, r"in_memory\st", store_attr + " > 0")
@@ -213,36 +225,11 @@ try:
         else:
             gp.addwarning("Your Potential Store Locations features class or layer does not have fields NAME and/or ATTRACTIVENESS. These features have been excluded from the model.")
 
-    # Truncate store names if they are too long (45 characters), or substiture underline for non-supported characters
+    # Store names are truncated (45 characters) and nonalphanumeric characters replaced when the stores are read for modeling
     fields = gp.listfields(r"in_memory\st")
     for field in fields:
         if field.name == store_name:
             maxlength = field.length
-            
-    cur = gp.updatecursor(r"in_memory\st", "", "", store_name)
-    row = cur.next()
-    while row:
-        name_orig = row.GetValue(store_name)
-        name_num = name_orig.rjust(1)[:1]
-        numlist = ['1','2','3','4','5','6','7','8','9','0']
-        if name_num in numlist:
-            name_orig = "_" + name_orig
-        name_new = re.sub('[^a-zA-Z_0-9]', '_', str(name_orig))
-        if len(name_new) > maxlength:
-            name_new = name_new.ljust(maxlength)[:maxlength]
-        name_trunc = name_new.ljust(45)[:45]
-        if len(name_new) >=45:
-            set_name = row.setvalue(store_name, name_trunc)
-        else:
-            set_name = row.setvalue(store_name, name_new)
-        try:
-            cur.Updaterow(row)
-        except:
-            gp.adderror("Rows in store layer contain bad records.  Problem may have occured if Potential stores were drawn with no NAME added.  Check the geoprocessing 'Results' tab to ensure that the Potential Stores feature set has values in both the NAME and ATTRACTIVENESS fields.")
-            sys.exit()
-        row = cur.next()
-    del cur
-    del row
     gp.SetProgressorPosition()
 
     # If study area contains more than one polygon, dissolve it
@@ -260,29 +247,23 @@ try:
     while row:
         feat = row.shape
         area = feat.Area
-        if sr.linearunitname == "Foot_US":
-            if area / 5318313.2 > 500: # max number of points
-                pointnum = 500
-            elif area / 5318313.2 < 100: # min number of points
-                pointnum = 100
-            else:
-                pointnum = area / 5318313.2
-                    
-        elif sr.linearunitname == "Meter":
-            if area / 494089.52 > 500: # max number of points
-                pointnum = 500
-            elif area / 494089.52 < 100: # min number of points
-                pointnum = 100
-            else:
-                pointnum = area / 494089.52
+        if sr.linearunitname in ["Foot_US", "Meter"]:
+            ""
         else:
             gp.adderror("Your study area feature class does not have a projected coordinate system.  Please project your data or use another data source.")
             sys.exit()
         row = cur.next()
 
-    # Process: Generate random origin points...
+    # Process: Generate quasi-random (Halton) origin points, as many as the store density calls for (100 to 100,000)...
     if blockgroups == "":      
-        gp.CreateRandomPoints_management("in_memory","bgrandom", studyarea,"", int(pointnum))
+        import HuffSampler
+        if numstudyarea > 1:
+            sa = backend.ReadPoints(r"in_memory\studyarea")
+        else:
+            sa = backend.ReadPoints(studyarea)
+        pointnum = HuffSampler.AdaptiveCount(backend.ReadPoints(r"in_memory\st").xy, area)
+        randomxy = HuffSampler.SampleOrigins(HuffSampler.PolygonIndex(sa.rings), pointnum)
+        backend.WritePoints(r"in_memory\bgrandom", HuffBackends.PointTable(range(1, pointnum + 1), randomxy.tolist()), [], sr)
         gp.SetProgressorPosition()
  
         gp.merge_management(r"in_memory\st;in_memory\bgrandom",r"in_memory\bg")
@@ -297,14 +278,17 @@ try:
 
     # Process: Create centroid points from input origin locations
     else:
-        gp.FeatureToPoint_management(blockgroups, r"in_memory\bg", "INSIDE")
+        # The points are made from the output copy of the origin features, so each point's ORIG_FID is the
+        # object ID of the copied feature its results are written back to
+        gp.copyfeatures(blockgroups, outputgdb + str(fc_name))
+        gp.FeatureToPoint_management(outputgdb + str(fc_name), r"in_memory\bg", "INSIDE")
         gp.SetProgressorPosition()
-        # Process: clear attributes in block group points layer by deleting
+        # Process: clear attributes in block group points layer by deleting (ORIG_FID keeps each point's output feature ID)
         fields = gp.listfields(r"in_memory\bg", "*")
         for field in fields:
             if field.required == True:
                 ""
-            elif field.name == sales:
+            elif field.name == sales or field.name == "ORIG_FID":
                 ""
             else:
                 gp.deletefield_management(r"in_memory\bg", field.name)
@@ -312,8 +296,8 @@ try:
         gp.SetProgressorPosition()
 
     # Process: Add ID field for stores and block groups
-    gp.AddField_management(r"in_memory\st", "SID", "SHORT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-    gp.AddField_management(r"in_memory\bg", "BID", "SHORT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
+    gp.AddField_management(r"in_memory\st", "SID", "LONG", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
+    gp.AddField_management(r"in_memory\bg", "BID", "LONG", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
     gp.SetProgressorPosition()
     
     # Process: Calculate ID field for block groups
@@ -332,8 +316,61 @@ try:
 ######################################################################################################################################################
 ######################################################################################################################################################
     
+    # Process: Read the modeled stores into columns with dense IDs (position k for store SID storeids[k])...
+    stages.Begin("read")
+    storeids = []
+    rawnames = []
+    storeattr = []
+    storexy = []
+    cur = gp.SearchCursor(r"in_memory\st")
+    row = cur.Next()
+    while row:
+        storeids.append(row.GetValue("SID"))
+        rawnames.append(row.GetValue(store_name))
+        storeattr.append(row.GetValue(store_attr))
+        pnt = row.shape.getpart()
+        storexy.append((pnt.x, pnt.y))
+        row = cur.Next()
+    del cur
+    if None in rawnames:
+        gp.adderror("Rows in store layer contain bad records.  Problem may have occured if Potential stores were drawn with no NAME added.  Check the geoprocessing 'Results' tab to ensure that the Potential Stores feature set has values in both the NAME and ATTRACTIVENESS fields.")
+        sys.exit()
+    storetable = HuffStores.StoreTable(storeids, rawnames, storeattr, storexy, maxlength)
+    # Potential stores and the name field's length can make names clash
+    if storetable.Duplicate() is not None:
+        gp.adderror("Field values in field '" + str(store_name) + "' are not unique, counting the Potential Stores. Use a different field or rename the Potential Stores.")
+        sys.exit()
+    collision = storetable.Collision()
+    if collision is not None:
+        gp.adderror("Store names '" + str(collision[0]) + "' and '" + str(collision[1]) + "' both become '" + collision[2] + "' in output field names. Rename one of them.")
+        sys.exit()
+    storenames = storetable.names
+
+    # Process: Read origin IDs, source feature IDs, sales values and locations (keyed by BID)...
+    originids = []
+    originsource = []
+    originsales = []
+    originxy = []
+    cur = gp.SearchCursor(r"in_memory\bg")
+    row = cur.Next()
+    while row:
+        originids.append(row.GetValue("BID"))
+        if blockgroups != "":
+            originsource.append(row.GetValue("ORIG_FID"))
+        if sales != "":
+            originsales.append(row.GetValue(sales) or 0)
+        pnt = row.shape.getpart()
+        originxy.append((pnt.x, pnt.y))
+        row = cur.Next()
+    del cur
+    originindex = dict([(bid, i) for i, bid in enumerate(originids)])
+    stages.End(stores=len(storeids), origins=len(originids))
+
+    # Impedance matrices are cached by a hash of the origins, stores and cost settings, so reruns with unchanged geometry skip the distance step
+    impedancecache = HuffCache.ImpedanceCache(outfolder + os.sep + "impedance_cache")
+
     if distances.lower() == 'true':
-        gp.SetProgressor("default", "Calculating travel impedance from Origin Locations to Store Destinations......", 0, 1, 1)
+        stages.Begin("impedance", "Calculating travel impedance from Origin Locations to Store Destinations......", "default", 0, 1, 1)
 
         # Figure out Network Dataset attributes for use in Making the OD Cost Matrix
         usetime = ""
@@ -364,221 +401,237 @@ try:
             cost = usetime            
         else:
             cost = uselength
-            
-        # Process: Make OD Cost Matrix Layer...
-        gp.MakeODCostMatrixLayer_na(streets, "OD", cost, "", "", cost, "ALLOW_UTURNS", "OneWay;"+restrictions, useheirarchy, "", "NO_LINES")
 
-        # Add Origin Locations to OD Matrix
-        gp.addlocations_na("OD", "Origins", r"in_memory\bg", "Name Name #", "5000 Meters", "", "trline SHAPE;nd_Junctions NONE", "MATCH_TO_CLOSEST", "APPEND", "NO_SNAP", "5 Meters")
-       
-        # Add Destination Locations to OD Matrix
-        gp.addlocations_na("OD", "Destinations", r"in_memory\st", "Name Name #;CurbApproach # 0", "5000 Meters", "", "trline SHAPE;nd_Junctions NONE", "MATCH_TO_CLOSEST", "APPEND", "NO_SNAP", "5 Meters")
+        impedancekey = HuffCache.ImpedanceKey(originxy, storexy, cost, restrictions, streets, blockgroups == "")
+        impedance = impedancecache.Get(impedancekey)
+        if impedance is None:
+            # Process: Make OD Cost Matrix Layer...
+            gp.MakeODCostMatrixLayer_na(streets, "OD", cost, "", "", cost, "ALLOW_UTURNS", "OneWay;"+restrictions, useheirarchy, "", "NO_LINES")
 
-        # Process: Solve Origin Destination matrix... 
-        gp.Solve_na("OD", "SKIP")
-        gp.addmessage("Finished calculating travel impedance ("+cost+") from origin locations to stores.")
-        gp.savetolayerfile_management("OD", outfolder + "\\ODafter.lyr")
+            # Add Origin Locations to OD Matrix
+            gp.addlocations_na("OD", "Origins", r"in_memory\bg", "Name Name #", "5000 Meters", "", "trline SHAPE;nd_Junctions NONE", "MATCH_TO_CLOSEST", "APPEND", "NO_SNAP", "5 Meters")
+           
+            # Add Destination Locations to OD Matrix
+            gp.addlocations_na("OD", "Destinations", r"in_memory\st", "Name Name #;CurbApproach # 0", "5000 Meters", "", "trline SHAPE;nd_Junctions NONE", "MATCH_TO_CLOSEST", "APPEND", "NO_SNAP", "5 Meters")
+
+            # Process: Solve Origin Destination matrix... 
+            gp.Solve_na("OD", "SKIP")
+            gp.addmessage("Finished calculating travel impedance ("+cost+") from origin locations to stores.")
+            gp.savetolayerfile_management("OD", outfolder + "\\ODafter.lyr")
+        else:
+            gp.addmessage("Using cached travel impedance ("+cost+") from origin locations to stores.")
 
     # If Network Analyst is not available, calculate distances that are straight line
     else:
-        gp.SetProgressor("default", "Calculating straight-line distance from input locations to store destinations...", 0, 1, 1)
-        gp.generateneartable(r"in_memory\bg", r"in_memory\st", r"in_memory\tbl", "", "", "", "ALL")
+        stages.Begin("impedance", "Calculating straight-line distance from input locations to store destinations...", "default", 0, 1, 1)
+        impedancekey = HuffCache.ImpedanceKey(originxy, storexy, "NEAR_DIST")
+        impedance = impedancecache.Get(impedancekey)
+        if impedance is None:
+            impedance = HuffDistance.DistanceMatrix(numpy.array(originxy), numpy.array(storexy))
+            impedancecache.Put(impedancekey, impedance)
+            gp.addmessage("Finished calculating straight-line distances from origin locations to stores.")
+        else:
+            gp.addmessage("Using cached straight-line distances from origin locations to stores.")
         gp.SetProgressorposition()
-        gp.addmessage("Finished calculating straight-line distances from origin locations to stores.")
+    stages.End(pairs=len(originids) * len(storeids))
         
 #############################################################################################################################################
 #############################################################################################################################################
     
     # Set progressor for stage of process
     numst = gp.getcount_management(r"in_memory\st").getoutput(0)
-    count = (7*int(numst)) + 5    
+    if surfaces.lower() == 'true':
+        count = (2*int(numst)) + 6
+        gp.SetProgressor("step", "Calculating probabilities and generating surfaces..." , 0, count, 1)
+    else:
+        count = 6
+        gp.SetProgressor("step", "Calculating probabilities..." , 0, count, 1)
 
-    # If Network Analyst is available, calculate model based on travel time
-    if distances.lower() == 'true':
-        if surfaces.lower() == 'true':
-            gp.SetProgressor("step", "Calculating probabilities and generating surfaces..." , 0, count, 1)
-        else:
-            gp.SetProgressor("step", "Calculating probabilities..." , 0, count, 1)
+    # Process: Delete store points (all store values have been read)
+    gp.delete_management(r"in_memory\st")
 
+    # If Network Analyst is available, calculate model based on travel time
+    if distances.lower() == 'true' and impedance is None:
         # Process: Make Table from OD lines...
+        stages.Begin("od_table")
         gp.CopyRows_management("OD\\Lines", outputgdb + "tbl")
         # Process: Delete fields
         gp.deletefield(outputgdb + "tbl", "Name;DestinationRank")
         gp.CopyRows(outputgdb + "tbl", r"in_memory\tbl")
         gp.delete(outputgdb + "tbl")
-        gp.SetProgressorPosition() 
 
         # Process: Delete in-memory OD matrix
         try: 
             gp.delete_management("OD")
         except:
             pass
+        gp.SetProgressorPosition()
+
+        # Process: Read OD table into an origins x stores matrix (unreachable pairs stay infinite)...
+        impedance = numpy.empty((len(originids), len(storeids)))
+        impedance.fill(numpy.inf)
+        odorigins = []
+        oddestinations = []
+        odcosts = []
+        cur = gp.SearchCursor(r"in_memory\tbl")
+        row = cur.Next()
+        while row:
+            odorigins.append(originindex[row.GetValue("OriginID")])
+            oddestinations.append(row.GetValue("DestinationID"))
+            odcosts.append(row.GetValue("Total_" + cost))
+            row = cur.Next()
+        del cur
+        impedance[odorigins, storetable.Index(oddestinations)] = odcosts
+        gp.delete_management(r"in_memory\tbl")
 
         # Make minimum travel time 0.1 minutes instead of 0 minutes (for calculation)
         if blockgroups == "":
-            cur = gp.updatecursor(r"in_memory\tbl", "Total_" + cost + " = 0")
-            row = cur.next()
-            while row:
-                row.SetValue("Total_" + cost, row.GetValue("Total_" + cost) + .1)
-                cur.Updaterow(row)
-                row = cur.next()
-            del cur
-            del row
-
-        # Process: Join store and origin attributes to OD table...
-        gp.JoinField(r"in_memory\tbl", "OriginID", r"in_memory\bg", "BID", "BID;" + str(sales))
-        gp.SetProgressorPosition() 
-        gp.JoinField(r"in_memory\tbl", "DestinationID", r"in_memory\st", "SID", "SID;" + str(store_attr) + ";" + str(store_name))
-        gp.delete_management(r"in_memory\st")
-        gp.SetProgressorPosition() 
-
-        # Process: Add and Calculate tt_x_att Field ...
-        gp.AddField_management(r"in_memory\tbl", "tt_x_att", "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        if x == "":
-            x = 2
-        gp.CalculateField_management(r"in_memory\tbl", "tt_x_att","(1/ ([Total_" + cost + "]^" + str(x) + ")) * [" + str(store_attr) + "]")
+            impedance[impedance == 0] = .1
+        impedancecache.Put(impedancekey, impedance)
         gp.SetProgressorPosition()
-
-    # If Network Analyst is not available, calculate model based on straight line distance
+        stages.End(pairs=int(numpy.isfinite(impedance).sum()))
+
+    # Process: Calculate tt_x_att, SUM_tt_x_att, probabilities and sales for every origin and store at once...
+    stages.Begin("probabilities")
+    if x == "":
+        x = 2
+    if sales == "":
+        tt_x_att, sum_tt_x_att, prob, storesales = HuffEngine.HuffProbabilities(impedance, storeattr, x)
     else:
-        if surfaces.lower() == 'true':
-            gp.SetProgressor("step", "Calculating probabilities and generating surfaces..." , 0, count, 1)
-        else:
-            gp.SetProgressor("step", "Calculating probabilities..." , 0, count, 1)
+        tt_x_att, sum_tt_x_att, prob, storesales = HuffEngine.HuffProbabilities(impedance, storeattr, x, originsales)
+    gp.SetProgressorPosition()
+    stages.End(pairs=prob.size)
 
-        # Make minimum distance 0.1 instead of 0 (for calculation)
+    # Process: Add probability (and sales and travel impedance) fields for each store to the origins,
+    # or write them as one (origin_id, store_id, impedance, prob, sales) row per pair to the long table...
+    stages.Begin("write_origins")
+    if longoutput:
+        import HuffOutput
         if blockgroups == "":
-            cur = gp.updatecursor(r"in_memory\tbl", "NEAR_DIST = 0")
-            row = cur.next()
-            while row:
-                row.NEAR_DIST = row.NEAR_DIST + .1
-                cur.Updaterow(row)
-                row = cur.next()
-            del cur
-            del row
-        gp.SetProgressorPosition()
-
-        # Process: Join origin attributes to near_table...
-        desc = gp.describe(r"in_memory\bg")
-        gp.JoinField(r"in_memory\tbl", "IN_FID", r"in_memory\bg", desc.OIDFieldName, "BID;" + str(sales))
-        gp.SetProgressorPosition()
-                    
-        # Process: Join store attributes to near_table...
-        desc = gp.describe(r"in_memory\st")
-        gp.JoinField(r"in_memory\tbl", "NEAR_FID", r"in_memory\st", desc.OIDFieldName, "SID;" + str(store_name) + ";" + str(store_attr))
-        gp.delete_management(r"in_memory\st")
-        gp.SetProgressorPosition()        
-
-        # Process: Add and Calculate tt_x_att Field ...
-        gp.AddField_management(r"in_memory\tbl", "tt_x_att", "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        if x == "":
-            x = 2
-        gp.CalculateField_management(r"in_memory\tbl", "tt_x_att","(1/ ([NEAR_DIST]^" + str(x) + ")) * [" + str(store_attr) + "]")
-        gp.SetProgressorPosition()
-
-#RESUME model calculations with tbl from EITHER OD Matrix or Near_Table 
-
-    # Process: Summary Statistics (SUM of tt_x_att grouped by unique bg_stfid)...
-    gp.Statistics_analysis(r"in_memory\tbl", r"in_memory\sumstats_tbl", "tt_x_att SUM", "BID")
-    gp.SetProgressorPosition() 
-       
-    # Process: Summary Statistics(make list of store names)
-    gp.Statistics_analysis(r"in_memory\tbl", r"in_memory\st_names", str(store_name) + " FIRST", str(store_name))
+            pairorigins = originids
+        else:
+            pairorigins = originsource
+        HuffOutput.WriteLongTable(outpairs, pairorigins, storeids, prob, impedance, storesales)
+        gp.addmessage("Wrote the origin-store results to the long table '" + outpairs + "'.")
+    # Random origins get their results on the points; origin locations get them straight on the output copy
+    # of the source features, matched by its object IDs (the points' ORIG_FID, no spatial join)
+    if blockgroups == "":
+        target = r"in_memory\bg"
+    else:
+        target = outputgdb + str(fc_name)
+        sourceindex = dict([(fid, i) for i, fid in enumerate(originsource)])
+        targetOID = gp.describe(target).OIDFieldName
+    fieldstores = storenames
+    if longoutput:
+        fieldstores = []
+    for storename in fieldstores:
+        gp.AddField_management(target, storename + "_prob" , "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
+        if sales != "":
+            gp.AddField_management(target, storename + "_sales" , "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
+        if distances.lower() == 'true':
+            gp.AddField_management(target, storename + "_Total_" + cost , "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
+
+    # Process: Find the dominant store, runner-up, winning margin and HHI of every origin from the probability matrix...
+    originmarkets = marketareas.lower() == "origins" or marketareas.lower() == "both"
+    if originmarkets:
+        dominant, runnerup, margin = HuffMarkets.DominantStores(prob)
+        hhi = HuffMarkets.ConcentrationIndex(prob)
+        nameLength = max([len(storename) for storename in storenames])
+        gp.AddField_management(target, "Market", "TEXT", "", "", nameLength, "", "NULLABLE", "NON_REQUIRED", "")
+        gp.AddField_management(target, "Runner_Up", "TEXT", "", "", nameLength, "", "NULLABLE", "NON_REQUIRED", "")
+        gp.AddField_management(target, "Margin", "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
+        gp.AddField_management(target, "HHI", "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
     gp.SetProgressorPosition()
 
-    # Create search cursor to export and perform operations on tables with separate store names
-    cur = gp.SearchCursor(r"in_memory\st_names")
-    row = cur.Next()
-    
-    while row :
-        storename = row.GetValue(store_name)
-        whereclause = str(store_name) + " = '" + storename + "'"
-        tblname = storename + "_tbl"
-
-        # Process: Make Table View of unique store names...
-        gp.tabletotable(r"in_memory\tbl", "in_memory", tblname, whereclause)
-        gp.SetProgressorPosition()
-
-        # Process: Join separate store tables to summary stats table
-        gp.joinfield("in_memory" + os.sep + tblname, "BID", r"in_memory\sumstats_tbl", "BID", "SUM_tt_x_att")
-        gp.SetProgressorPosition()
-            
-        # Process: Add and calculate probabilities in each store table (probability of each block group going to store x) ...
-        gp.AddField_management("in_memory" + os.sep + tblname, str(storename) + "_prob" , "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-        gp.CalculateField_management("in_memory" + os.sep + tblname, str(storename) + "_prob", "[tt_x_att] / [SUM_tt_x_att]")
-        gp.SetProgressorPosition()
+    # Process: Write every store's results to the origins in a single cursor pass...
+    if fieldstores or originmarkets:
+        cur = gp.UpdateCursor(target)
+        row = cur.Next()
+        while row:
+            if blockgroups == "":
+                i = originindex[row.GetValue("BID")]
+            else:
+                i = sourceindex.get(row.GetValue(targetOID))
+                if i is None:
+                    cur.UpdateRow(row)
+                    row = cur.Next()
+                    continue
+            for j in range(len(fieldstores)):
+                row.SetValue(storenames[j] + "_prob", float(prob[i, j]))
+                if sales != "":
+                    row.SetValue(storenames[j] + "_sales", float(storesales[i, j]))
+                if distances.lower() == 'true' and impedance[i, j] != numpy.inf:
+                    row.SetValue(storenames[j] + "_Total_" + cost, float(impedance[i, j]))
+            if originmarkets:
+                if dominant[i] >= 0:
+                    row.SetValue("Market", storenames[dominant[i]])
+                if runnerup[i] >= 0:
+                    row.SetValue("Runner_Up", storenames[runnerup[i]])
+                row.SetValue("Margin", float(margin[i]))
+                row.SetValue("HHI", float(hhi[i]))
+            cur.UpdateRow(row)
+            row = cur.Next()
+        del cur
+        del row
+    gp.SetProgressorPosition()
+    stages.End(rows=len(originids), fields=len(storenames))
 
-        # Process: if sales projections are to be calculated, do so
-        if sales == "":
-            gp.joinfield(r"in_memory\bg", "BID", "in_memory" + os.sep + tblname, "BID", str(storename) + "_prob")
-            gp.SetProgressorPosition()
+    # Generate surfaces if user desires
+    if surfaces.lower() == 'true':
+        stages.Begin("surfaces")
+        import HuffSurface
+        gp.addmessage("Generating probability surfaces for all stores")
+        desc = gp.describe(studyarea)
+        extent = desc.Extent
+        gp.extent = extent
+        defcell = HuffSurface.DefaultCellSize(extent.xmin, extent.ymin, extent.xmax, extent.ymax)
+        if gp.cellsize == "":
+            gp.cellsize = defcell
+        try:
+            cellsize = float(gp.cellsize)
+        except ValueError:
+            cellsize = defcell
+        gp.mask = studyarea
+        grid = HuffSurface.RasterGrid(extent.xmin, extent.ymin, extent.xmax, extent.ymax, cellsize)
+
+        surfacefile = outfolder + os.sep + "surfaces.bsq"
+        salesfile = surfacefile
+        salesband = len(storenames)
+        if distances.lower() != 'true':
+            # Process: Evaluate every store's probability directly at every cell inside the study area, tile by tile...
+            import HuffSampler
+            if numstudyarea > 1:
+                sa = backend.ReadPoints(r"in_memory\studyarea")
+            else:
+                sa = backend.ReadPoints(studyarea)
+            surfacebands = HuffSurface.HuffSurfaces(storetable.xy, storetable.attractiveness, grid, surfacefile, x,
+                                     mask=HuffSampler.PolygonIndex(sa.rings).Contains)
+            if sales != "":
+                # Sales need demand between the origins, so they are still interpolated (IDW)
+                salesfile = outfolder + os.sep + "sales_surfaces.bsq"
+                salesband = 0
+                HuffSurface.IDWSurfaces(numpy.array(originxy), storesales, grid, salesfile)
         else:
-            gp.AddField_management("in_memory" + os.sep + tblname, str(storename) + "_sales" , "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-            gp.CalculateField_management("in_memory" + os.sep + tblname, str(storename) + "_sales", "[" + str(storename) + "_prob] * [" + str(sales) +"]")
-            gp.SetProgressorPosition()
-            gp.joinfield(r"in_memory\bg", "BID", "in_memory" + os.sep + tblname, "BID", str(storename) + "_prob;" + str(storename) + "_sales")
-            gp.SetProgressorPosition()
-
-        # Add distance to stores	
-        if distances.lower() == 'true':
-            gp.AddField_management("in_memory" + os.sep + tblname, str(storename) + "_Total_" + cost , "FLOAT", "", "", "", "", "NULLABLE", "NON_REQUIRED", "")
-            gp.CalculateField_management("in_memory" + os.sep + tblname, str(storename) + "_Total_" + cost, "[Total_" + cost + "]")
-            gp.joinfield(r"in_memory\bg", "BID", "in_memory" + os.sep + tblname, "BID", str(storename) + "_Total_" + cost)
-
-        # Delete in memory table to free up memory
-        gp.delete_management(r"in_memory" + os.sep + tblname)
-        
-        # Determine the expected mean distance between input origin locations
-        num1 = gp.getcount_management(r"in_memory\bg")
-        num = int(num1.getoutput(0))
-        expectedMeanDist = 1.0 / (2.0 * ((num / float(area))**0.5))
-        
-        # Generate surfaces if user desires
-        if surfaces.lower() == 'true':
-            gp.addmessage("Generating " + str(storename) + " Probability Surface")
-            desc = gp.describe(studyarea)
-            extent = desc.Extent
-            gp.extent = extent
-            if extent.xmax - extent.xmin > extent.ymax - extent.ymin:
-                if (extent.ymax - extent.ymin)/250 > 400:
-                    defcell = 400
-                else:
-                    defcell = (extent.ymax - extent.ymin)/250
+            # Process: Interpolate every store's probability (and sales) values onto the grid in one tiled pass (IDW)...
+            if sales == "":
+                bands = prob
             else:
-                if (extent.xmax - extent.xmin)/250 > 400:
-                    defcell = 400
-                else:
-                    defcell = (extent.xmax - extent.xmin)/250
-
-            if gp.cellsize == "":
-                gp.cellsize = defcell
-
-            gp.mask = studyarea
-            # Process: Create surface from store probability values (interpolate with Kriging)
-            field = str(storename) + "_prob"
-            output = outputgdb + "kriging_" + str(storename)
-            props = "Spherical " + str(expectedMeanDist)
-            gp.kriging_sa(r"in_memory\bg", field, output, props)
-            gp.SingleOutputMapAlgebra_sa("Int([" + outputgdb + "kriging_" + str(storename) + "] * 100)",outputgdb + str(storename) + "_ProbSurface","#")
-            gp.delete(outputgdb + "kriging_" + str(storename))
-            gp.SetProgressorPosition()
-           
-            # Process: Create surface from store sales values (interpolate with Kriging)
-            field = str(storename) + "_sales"
-            output = outputgdb + "sales_kriging_" + str(storename)
-            props = "Spherical " + str(expectedMeanDist)
-            gp.kriging_sa(r"in_memory\bg", field, output, props)
-            gp.SingleOutputMapAlgebra_sa("Int([" + outputgdb + "sales_kriging_" + str(storename) + "])",outputgdb + str(storename) + "_SalesSurface","#")
-            gp.delete(outputgdb + "sales_kriging_" + str(storename))
+                bands = numpy.hstack((prob, storesales))
+            surfacebands = HuffSurface.IDWSurfaces(numpy.array(originxy), bands, grid, surfacefile)
+            del bands
+        gp.SetProgressorPosition()
+
+        # Process: Create each store's surfaces from its bands (clipped to the study area mask)
+        for j in range(len(storenames)):
+            storename = storenames[j]
+            gp.SingleOutputMapAlgebra_sa("Int([" + surfacefile + os.sep + "Band_" + str(j + 1) + "] * 100)",outputgdb + storename + "_ProbSurface","#")
             gp.SetProgressorPosition()
+            if sales != "":
+                gp.SingleOutputMapAlgebra_sa("Int([" + salesfile + os.sep + "Band_" + str(salesband + j + 1) + "])",outputgdb + storename + "_SalesSurface","#")
+                gp.SetProgressorPosition()
 
         gp.extent = ""
-        
-        # Exit the while loop
-        row = cur.Next()
-        
-    # Delete in memory table to free up memory
-    gp.delete_management(r"in_memory\tbl")
+        stages.End(cells=grid.nrows * grid.ncols, rasters=len(storenames))
         
     if surfaces.lower() == 'true':
         gp.addmessage("Finished calculating probabilities and generating surfaces.")
@@ -589,20 +642,12 @@ try:
 ############################################################################################################################################
 
     # setting progress bar for creating output feature class
-    gp.SetProgressor("default", "Creating output feature class '" + fc_name + "'...")
+    stages.Begin("output", "Creating output feature class '" + fc_name + "'...")
 
+    # (results for origin locations were written to the copy of the source features already)
     if blockgroups == "":
         gp.copyfeatures(r"in_memory\bg", outputgdb + str(fc_name))
-        gp.delete_management(r"in_memory\bg")
-    else:
-        gp.featureclasstofeatureclass(blockgroups, "in_memory", "origins")
-        desc = gp.describe(blockgroups)
-        shapetype = desc.Shapetype
-        if shapetype == "Polygon":
-            gp.spatialjoin(r"in_memory\origins", r"in_memory\bg", outputgdb + str(fc_name), "", "", "", "CONTAINS")
-        else:
-            gp.spatialjoin(r"in_memory\origins", r"in_memory\bg", outputgdb + str(fc_name), "", "", "", "INTERSECTS")
-        gp.delete_management(r"in_memory\bg")
+    gp.delete_management(r"in_memory\bg")
 
     # Process: delete fields in fc_name
     deletefields = gp.listfields(outputgdb + str(fc_name), "*")
@@ -617,90 +662,33 @@ try:
         gp.delete_management(fc)
         
     gp.addmessage("Finished creating output feature class '" + fc_name + "'.")    
+    stages.End(rows=len(originids))
 
 ############################################################################################################################################
 ############################################################################################################################################
    
     if marketareas.lower() == "surfaces" or marketareas.lower() == "both":
         # setting progress bar for creating market areas
-        gp.SetProgressor("default", "Creating market areas from probability surfaces...")
-
-        # set workspace to retrieve all probability surfaces
-        gp.workspace = outfolder + "\\output.gdb"
+        stages.Begin("surface_markets", "Creating market areas from probability surfaces...")
 
-        # Create list of all probability surface rasters
-        rasterList = gp.listrasters("*ProbSurface")
-
-        rasterNames = ""
-        rasterNameLength = -1
-
-        # Length of the longest store name needed for length of Highest_Prob field
-        for raster in rasterList:
-            rasterNames = rasterNames + raster + ";"
-            length = len(str(raster))
-            if length >= rasterNameLength:
-                rasterNameLength = length
-
-        newRasterNames = rasterNames.ljust(-1)[:-1]
-
-        #Perform Highest Position tool to determine which store has the highest probability at each cell
-        gp.highestposition(newRasterNames, outputgdb + "Surface_Markets")
-
-        newRasterList = newRasterNames.split(";")
-
-        #add field for indicating the store with the highest probability
-        gp.addfield(outputgdb + "Surface_Markets", "Market" , "TEXT", "", "", rasterNameLength - 12)
-
-        rows = gp.UpdateCursor(outputgdb + "Surface_Markets")
-        row = rows.Next()
-
-        while row:
-            highestGrid = row.getvalue("VALUE")
-            highestText = str(newRasterList[(int(highestGrid) - 1)])
-            highestTextName = highestText.ljust(-12)[:-12]
-            # Update Highest_Prob field with the name of the store
-            row.SetValue("Market", highestTextName)
-            rows.UpdateRow(row)
-            row = rows.Next()
-        del rows
+        # Process: Dominant store of every cell from the probability bands, connected regions and their polygons...
+        import HuffMarketAreas
+        if sales == "":
+            marketsales = None
+        else:
+            marketsales = originsales
+        markets = HuffMarketAreas.MarketAreas(surfacebands, grid, len(storenames), storenames, storeids,
+                                              numpy.array(originxy), prob, marketsales)
+        backend.WritePoints(outmarkets, markets, ["Market", "STORE_ID", "CELLS", "AREA", "DEMAND", "CAPTURED"], sr)
+        gp.addmessage("Created " + str(len(markets)) + " market areas in '" + outmarkets + "'.")
+        stages.End(rows=len(markets), cells=grid.nrows * grid.ncols)
 
     if marketareas.lower() == "origins" or marketareas.lower() == "both":
         # setting progress bar for creating market areas
         gp.SetProgressor("default", "Creating market areas from origins...")
 
-        # set workspace to retrieve all probability surfaces
-        gp.workspace = outfolder + os.sep + "output.gdb"
-
-        # to determine the highest probability value
-        fieldlist = gp.listfields(outputgdb + str(fc_name), "*prob")
-        fieldNameLength = -1
-
-        # Get the length of the longest store name
-        for field in fieldlist:
-            length = len(str(field))
-            if length >= fieldNameLength:
-                fieldNameLength = length
-
-        #add field for indicating the store with the highest sales value
-        gp.addfield(fc_name, "Market" , "TEXT", "", "", fieldNameLength - 5)
-            
-        rows = gp.UpdateCursor(fc_name)
-        row = rows.Next()
-
-        while row:
-            probValue = -9999.0
-            probName = "NULL"
-            # find the field with the highest probability value at that origin location
-            for field in fieldlist:
-                prob = row.getvalue(field.name)
-                if prob >= probValue:
-                    probValue = prob
-                    probName = field.name
-            #update the Highest_Prob field with the store name that has the highest probability at that origin location
-            row.SetValue("Market", probName.ljust(-5)[:-5])
-            rows.UpdateRow(row)
-            row = rows.Next()
-        del rows
+        # Market, Runner_Up, Margin and HHI fields were written to the origins with the store probabilities
+        gp.addmessage("Origin market areas are in the Market field of '" + fc_name + "'.")
 
     if marketareas.lower() != "none":
         gp.addmessage("Finished creating market areas.")
@@ -713,6 +701,7 @@ try:
     gp.setparameterastext(15,outmarkets)
     gp.setparameterastext(16,outpotential)
     
+    stages.Close()
     gp.addmessage(" -- Process Complete -- ")
 
 # Finish traceback Try-Except statement:
@@ -0,0 +1,332 @@
+# ---------------------------------------------------------------------------
+# HuffNetwork.py
+# Usage: Local street-network travel costs (replacing the Network Analyst OD
+#        cost matrix): a CSR graph and bounded Dijkstra searches from stores
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import csv, heapq, multiprocessing
+import numpy
+import HuffParallel
+
+TIME_UNITS = ["Days", "Hours", "Minutes", "Seconds"]
+LENGTH_UNITS = ["Meters", "Kilometers", "Feet", "Miles", "Yards", "NauticalMiles", "Inches", "Centimeters", "Millimeters", "Decimeters"]
+
+# Decimal places endpoint coordinates are rounded to when matching them into nodes
+NODE_PRECISION = 6
+
+# Graphs and locations of the current worker (set once per worker by _InitWorker)
+_shared = {}
+
+
+def ChooseCost(attributes):
+    # attributes - (name, usage type, units) of every network attribute
+    #
+    # Same choice as the tool: a time cost attribute is preferred over a
+    # length one; every restriction attribute is used. Returns
+    # (cost attribute, list of restriction attributes).
+    usetime = ""
+    uselength = ""
+    restrictions = []
+    for name, usagetype, units in attributes:
+        if usagetype == "Cost":
+            if units in TIME_UNITS:
+                usetime = name
+            else:
+                uselength = name
+        if usagetype == "Restriction":
+            restrictions.append(name)
+    if usetime != "":
+        return usetime, restrictions
+    return uselength, restrictions
+
+
+def InferAttributes(fieldnames):
+    # Network attributes of an edge table from its column names: columns
+    # named after a unit (Minutes, Meters, ...) are costs in that unit, and
+    # columns starting with 'Restrict' are restrictions
+    units = dict([(unit.lower(), unit) for unit in TIME_UNITS + LENGTH_UNITS])
+    attributes = []
+    for name in fieldnames:
+        if name.lower() in units:
+            attributes.append((name, "Cost", units[name.lower()]))
+        elif name.lower().startswith("restrict"):
+            attributes.append((name, "Restriction", ""))
+    return attributes
+
+
+class NetworkGraph(object):
+    # Directed graph in compressed sparse row form: the arcs leaving node n
+    # are heads[indptr[n]:indptr[n+1]] with costs in costs[...]. reverse is
+    # the same graph with every arc flipped (searches from stores on the
+    # reverse graph give origin -> store costs).
+
+    def __init__(self, node_xy, tails, heads, costs, edges=None):
+        self.node_xy = numpy.asarray(node_xy, dtype=numpy.float64)
+        numnodes = len(self.node_xy)
+        tails = numpy.asarray(tails, dtype=numpy.int64)
+        heads = numpy.asarray(heads, dtype=numpy.int64)
+        costs = numpy.asarray(costs, dtype=numpy.float64)
+        order = numpy.argsort(tails, kind="mergesort")
+        self.indptr = numpy.zeros(numnodes + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(tails, minlength=numnodes), out=self.indptr[1:])
+        self.heads = heads[order]
+        self.costs = costs[order]
+        self.tails = tails[order]
+        # Edge table (from node, to node, cost per edge) used for snapping
+        self.edges = edges
+        self._reverse = None
+
+    def NumNodes(self):
+        return len(self.node_xy)
+
+    def Reverse(self):
+        if self._reverse is None:
+            self._reverse = NetworkGraph(self.node_xy, self.heads, self.tails, self.costs)
+        return self._reverse
+
+
+def BuildGraph(from_xy, to_xy, cost, oneway=None, restricted=None):
+    # from_xy, to_xy - edge end point coordinates (edges meeting at the same
+    #                  rounded coordinates are connected, like end point
+    #                  connectivity in a network dataset)
+    # cost           - cost of traversing each edge
+    # oneway         - optional per-edge "FT" (from -> to only), "TF"
+    #                  (to -> from only), "N" (closed) or anything else (both)
+    # restricted     - optional boolean per edge; restricted edges are left out
+    from_xy = numpy.asarray(from_xy, dtype=numpy.float64)
+    to_xy = numpy.asarray(to_xy, dtype=numpy.float64)
+    cost = numpy.asarray(cost, dtype=numpy.float64)
+    numedges = len(cost)
+    ends = numpy.round(numpy.vstack((from_xy, to_xy)), NODE_PRECISION)
+    keys = numpy.ascontiguousarray(ends).view([("x", numpy.float64), ("y", numpy.float64)]).ravel()
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    node_xy = numpy.column_stack((unique["x"], unique["y"]))
+    fromnode = inverse[:numedges]
+    tonode = inverse[numedges:]
+
+    usable = numpy.isfinite(cost) & (cost >= 0)
+    if restricted is not None:
+        usable &= ~numpy.asarray(restricted, dtype=bool)
+    forward = usable.copy()
+    backward = usable.copy()
+    if oneway is not None:
+        oneway = numpy.array([str(v).upper() for v in oneway])
+        forward &= (oneway != "TF") & (oneway != "N")
+        backward &= (oneway != "FT") & (oneway != "N")
+    tails = numpy.concatenate((fromnode[forward], tonode[backward]))
+    heads = numpy.concatenate((tonode[forward], fromnode[backward]))
+    costs = numpy.concatenate((cost[forward], cost[backward]))
+    edges = {"from": fromnode, "to": tonode, "cost": cost, "forward": forward, "backward": backward}
+    return NetworkGraph(node_xy, tails, heads, costs, edges)
+
+
+def ReadEdgesCSV(path, attributes=None, onewayfield="Oneway"):
+    # Edge list with from_x, from_y, to_x, to_y columns, one column per cost
+    # attribute, optional restriction columns (nonzero = restricted) and an
+    # optional one-way column. Returns (graph, cost attribute, restrictions).
+    handle = open(path, "r")
+    try:
+        reader = csv.DictReader(handle)
+        rows = list(reader)
+        fieldnames = reader.fieldnames
+    finally:
+        handle.close()
+    if attributes is None:
+        attributes = InferAttributes(fieldnames)
+    cost, restrictions = ChooseCost(attributes)
+    if cost == "":
+        raise ValueError("The edge table has no cost attribute.")
+
+    def Column(name):
+        return numpy.array([float(row[name] or 0) for row in rows])
+    from_xy = numpy.column_stack((Column("from_x"), Column("from_y")))
+    to_xy = numpy.column_stack((Column("to_x"), Column("to_y")))
+    restricted = numpy.zeros(len(rows), dtype=bool)
+    for name in restrictions:
+        restricted |= Column(name) != 0
+    oneway = None
+    if onewayfield in fieldnames:
+        oneway = [row[onewayfield] for row in rows]
+    return BuildGraph(from_xy, to_xy, Column(cost), oneway, restricted), cost, restrictions
+
+
+class NetworkLocations(object):
+    # Points located on the network: each point can be reached through up to
+    # two nodes, node_a at cost_a and node_b at cost_b (node_b is -1 when the
+    # point sits on a node). Points located along edges also keep the edge
+    # (-1 for none) and their position on it (0 at the from node, 1 at the to).
+
+    def __init__(self, node_a, cost_a, node_b=None, cost_b=None, edge=None, position=None):
+        self.node_a = numpy.asarray(node_a, dtype=numpy.int64)
+        self.cost_a = numpy.asarray(cost_a, dtype=numpy.float64)
+        if node_b is None:
+            node_b = numpy.zeros(len(self.node_a), dtype=numpy.int64) - 1
+            cost_b = numpy.zeros(len(self.node_a))
+        self.node_b = numpy.asarray(node_b, dtype=numpy.int64)
+        self.cost_b = numpy.asarray(cost_b, dtype=numpy.float64)
+        self.edge = None
+        self.position = None
+        if edge is not None:
+            self.edge = numpy.asarray(edge, dtype=numpy.int64)
+            self.position = numpy.asarray(position, dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.node_a)
+
+    def Sources(self, k):
+        sources = [(int(self.node_a[k]), float(self.cost_a[k]))]
+        if self.node_b[k] >= 0:
+            sources.append((int(self.node_b[k]), float(self.cost_b[k])))
+        return sources
+
+    def Costs(self, nodecost):
+        # Cost of every point given a cost per node
+        cost = nodecost[numpy.maximum(self.node_a, 0)] + self.cost_a
+        cost[self.node_a < 0] = numpy.inf
+        onb = self.node_b >= 0
+        cost[onb] = numpy.minimum(cost[onb], nodecost[self.node_b[onb]] + self.cost_b[onb])
+        return cost
+
+
+def SnapToNodes(graph, xy, tolerance=5000.0):
+    # Each point is located at its nearest node within 'tolerance' (node -1
+    # when there is none); see HuffSnap for locating points along edges
+    import HuffDistance
+    xy = numpy.asarray(xy, dtype=numpy.float64)
+    o, n, d = HuffDistance.DistancePairs(xy, graph.node_xy, tolerance, 0.0)
+    node = numpy.zeros(len(xy), dtype=numpy.int64) - 1
+    # Pairs are sorted by point then distance, so the first of each point is nearest
+    first = numpy.ones(len(o), dtype=bool)
+    first[1:] = o[1:] != o[:-1]
+    node[o[first]] = n[first]
+    return NetworkLocations(node, numpy.zeros(len(xy)))
+
+
+def BoundedDijkstra(graph, sources, cutoff=numpy.inf):
+    # Multi-source Dijkstra: sources is a list of (node, starting cost).
+    # Nodes costing more than 'cutoff' are not expanded (left at inf).
+    dist = numpy.empty(graph.NumNodes())
+    dist.fill(numpy.inf)
+    indptr = graph.indptr
+    heads = graph.heads
+    costs = graph.costs
+    heap = []
+    for node, cost in sources:
+        if node >= 0 and cost < dist[node] and cost <= cutoff:
+            dist[node] = cost
+            heap.append((cost, node))
+    heapq.heapify(heap)
+    done = numpy.zeros(graph.NumNodes(), dtype=bool)
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if done[node]:
+            continue
+        done[node] = True
+        for arc in range(indptr[node], indptr[node + 1]):
+            head = heads[arc]
+            newcost = cost + costs[arc]
+            if newcost < dist[head] and newcost <= cutoff:
+                dist[head] = newcost
+                heapq.heappush(heap, (newcost, head))
+    return dist
+
+
+def _StoreNodeCosts(graph, sources, cutoff):
+    # Uses scipy's compiled Dijkstra when it is installed: one search per
+    # source node, combined with the starting costs
+    try:
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import dijkstra
+    except ImportError:
+        return BoundedDijkstra(graph, sources, cutoff)
+    matrix = _shared.get("csr")
+    if matrix is None or _shared.get("csrgraph") is not graph:
+        # Sparse matrices add up duplicate entries, so keep only the cheapest
+        # of parallel arcs
+        order = numpy.lexsort((graph.costs, graph.heads, graph.tails))
+        keep = numpy.ones(len(order), dtype=bool)
+        keep[1:] = (graph.tails[order][1:] != graph.tails[order][:-1]) | (graph.heads[order][1:] != graph.heads[order][:-1])
+        order = order[keep]
+        matrix = csr_matrix((graph.costs[order], (graph.tails[order], graph.heads[order])), shape=(graph.NumNodes(), graph.NumNodes()))
+        _shared["csr"] = matrix
+        _shared["csrgraph"] = graph
+    nodes = [node for node, cost in sources if node >= 0]
+    if not nodes:
+        result = numpy.empty(graph.NumNodes())
+        result.fill(numpy.inf)
+        return result
+    found = numpy.atleast_2d(dijkstra(matrix, directed=True, indices=nodes, limit=cutoff))
+    starts = numpy.array([cost for node, cost in sources if node >= 0])[:, numpy.newaxis]
+    result = (found + starts).min(axis=0)
+    result[result > cutoff] = numpy.inf
+    return result
+
+
+def _InitWorker(reverse, origins, stores, cutoff, raw, shape):
+    _shared["reverse"] = reverse
+    _shared["origins"] = origins
+    _shared["stores"] = stores
+    _shared["cutoff"] = cutoff
+    _shared["matrix"] = HuffParallel._View(raw, shape)
+
+
+def _SolveStore(j):
+    nodecost = _StoreNodeCosts(_shared["reverse"], _shared["stores"].Sources(j), _shared["cutoff"])
+    column = _shared["origins"].Costs(nodecost)
+    column[column > _shared["cutoff"]] = numpy.inf
+    _shared["matrix"][:, j] = column
+    return j
+
+
+def _SameEdgeCosts(graph, origins, stores, matrix, cutoff):
+    # Origins and stores on the same edge can travel along it without going
+    # through an end node: forward when the store lies further along the
+    # edge, backward when it lies before the origin
+    edges = graph.edges
+    order = numpy.argsort(stores.edge, kind="mergesort")
+    sortededges = stores.edge[order]
+    first = numpy.searchsorted(sortededges, origins.edge, "left")
+    count = numpy.searchsorted(sortededges, origins.edge, "right") - first
+    count[origins.edge < 0] = 0
+    o = numpy.repeat(numpy.arange(len(origins)), count)
+    if not len(o):
+        return
+    s = order[numpy.repeat(first, count) + numpy.arange(len(o)) - numpy.repeat(numpy.cumsum(count) - count, count)]
+    e = origins.edge[o]
+    delta = stores.position[s] - origins.position[o]
+    usable = (delta == 0) | numpy.where(delta > 0, edges["forward"][e], edges["backward"][e])
+    cost = numpy.abs(delta) * edges["cost"][e]
+    usable &= cost <= cutoff
+    o = o[usable]
+    s = s[usable]
+    matrix[o, s] = numpy.minimum(matrix[o, s], cost[usable])
+
+
+def TravelCostMatrix(graph, origins, stores, cutoff=numpy.inf, processes=None):
+    # origins, stores - NetworkLocations
+    # cutoff          - largest travel cost searched (pairs beyond stay inf)
+    #
+    # One bounded Dijkstra per store on the reverse graph, spread across a
+    # process pool, gives the origins x stores travel-cost matrix directly.
+    # Pairs located on the same edge (see HuffSnap) also get the cost along it.
+    reverse = graph.Reverse()
+    shape = (len(origins), len(stores))
+    raw, matrix = HuffParallel.SharedArray(shape)
+    if processes == 1 or len(stores) < 2:
+        _InitWorker(reverse, origins, stores, cutoff, raw, shape)
+        for j in range(len(stores)):
+            _SolveStore(j)
+        _shared.clear()
+    else:
+        pool = multiprocessing.Pool(processes, _InitWorker, (reverse, origins, stores, cutoff, raw, shape))
+        try:
+            pool.map(_SolveStore, range(len(stores)))
+        finally:
+            pool.close()
+            pool.join()
+    if origins.edge is not None and stores.edge is not None:
+        _SameEdgeCosts(graph, origins, stores, matrix, cutoff)
+    # The shared buffer is returned as is (its view keeps it alive), not copied
+    return matrix
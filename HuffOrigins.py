@@ -0,0 +1,151 @@
+# ---------------------------------------------------------------------------
+# HuffOrigins.py
+# Usage: Polygon origins represented by several weighted points each, and
+#        results aggregated back to the polygons by their IDs
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+import HuffSampler
+
+# Candidate points tried per representative point wanted
+OVERSAMPLE = 4
+
+# Number of point x edge crossing tests per batch
+BLOCK_PAIRS = 1 << 22
+
+
+def _PolygonEdges(polygons):
+    # Edges of every polygon grouped in CSR form: the edges of polygon i are
+    # edges[edgeptr[i]:edgeptr[i+1]] (x0, y0, x1, y1 rows)
+    edges = []
+    counts = numpy.zeros(len(polygons), dtype=numpy.int64)
+    for i, rings in enumerate(polygons):
+        polygonedges = HuffSampler._Edges([rings])
+        edges.append(polygonedges)
+        counts[i] = len(polygonedges)
+    edgeptr = numpy.zeros(len(polygons) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=edgeptr[1:])
+    return numpy.vstack(edges), edgeptr
+
+
+def _InsideOwn(xy, owner, edges, edgeptr, blockpairs=BLOCK_PAIRS):
+    # Even-odd test of each point against its own polygon's edges only
+    inside = numpy.zeros(len(xy), dtype=bool)
+    counts = edgeptr[owner + 1] - edgeptr[owner]
+    batch = max(1, int(blockpairs // max(1, counts.max()))) if len(xy) else 1
+    for start in range(0, len(xy), batch):
+        stop = min(len(xy), start + batch)
+        c = counts[start:stop]
+        point = numpy.repeat(numpy.arange(start, stop), c)
+        edge = numpy.repeat(edgeptr[owner[start:stop]] - (numpy.cumsum(c) - c), c) + numpy.arange(c.sum())
+        crossed = HuffSampler._Crossings(xy[point, 0], xy[point, 1], edges[edge])
+        inside[start:stop] = numpy.bincount(point[crossed] - start, minlength=stop - start) % 2 == 1
+    return inside
+
+
+def RepresentativePoints(polygons, labelxy, perpolygon=4, weights=None, density=None):
+    # polygons   - list of polygons (each a list of rings of (x, y))
+    # labelxy    - one point inside each polygon (label point or centroid),
+    #              used when no sampled point lands inside a polygon
+    # perpolygon - representative points wanted per polygon
+    # weights    - optional weight (e.g. population) per polygon
+    # density    - optional function giving a relative population density
+    #              for an n x 2 array of points (e.g. from a population grid)
+    #
+    # Returns (xy, owner, weight): the points, the polygon each belongs to
+    # and the share of its polygon's weight it carries (shares of a polygon
+    # sum to the polygon's weight, or 1 without weights). Points are the
+    # first Halton points of each polygon's bounding box that fall inside it.
+    labelxy = numpy.asarray(labelxy, dtype=numpy.float64).reshape(-1, 2)
+    numpolygons = len(polygons)
+    if weights is None:
+        weights = numpy.ones(numpolygons)
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    if perpolygon <= 1:
+        return labelxy.copy(), numpy.arange(numpolygons), weights.copy()
+
+    edges, edgeptr = _PolygonEdges(polygons)
+    lo = numpy.empty((numpolygons, 2))
+    hi = numpy.empty((numpolygons, 2))
+    for d in (0, 1):
+        ends = numpy.minimum(edges[:, d], edges[:, d + 2])
+        lo[:, d] = numpy.minimum.reduceat(ends, edgeptr[:-1]) if len(edges) else 0
+        ends = numpy.maximum(edges[:, d], edges[:, d + 2])
+        hi[:, d] = numpy.maximum.reduceat(ends, edgeptr[:-1]) if len(edges) else 0
+
+    # Process: Place the same Halton pattern in every polygon's bounding box and keep the points inside...
+    tries = perpolygon * OVERSAMPLE
+    unit = HuffSampler.Halton(tries)
+    owner = numpy.repeat(numpy.arange(numpolygons), tries)
+    xy = lo[owner] + numpy.tile(unit, (numpolygons, 1)) * (hi - lo)[owner]
+    keep = _InsideOwn(xy, owner, edges, edgeptr)
+    # Only the first 'perpolygon' points inside each polygon are kept
+    rank = numpy.cumsum(keep.reshape(numpolygons, tries), axis=1).ravel()
+    keep &= rank <= perpolygon
+    xy = xy[keep]
+    owner = owner[keep]
+
+    # Polygons too thin for any point to land inside keep their label point
+    missing = numpy.nonzero(numpy.bincount(owner, minlength=numpolygons) == 0)[0]
+    if len(missing):
+        xy = numpy.vstack((xy, labelxy[missing]))
+        owner = numpy.concatenate((owner, missing))
+        order = numpy.argsort(owner, kind="mergesort")
+        xy = xy[order]
+        owner = owner[order]
+
+    # Process: Split each polygon's weight among its points...
+    share = numpy.ones(len(xy))
+    if density is not None:
+        share = numpy.maximum(numpy.asarray(density(xy), dtype=numpy.float64), 0)
+    total = numpy.bincount(owner, share, minlength=numpolygons)
+    # Polygons with no density anywhere split evenly
+    empty = total[owner] <= 0
+    share[empty] = 1.0
+    total = numpy.bincount(owner, share, minlength=numpolygons)
+    return xy, owner, weights[owner] * share / total[owner]
+
+
+def LabelPoints(polygons, centroids):
+    # One point inside every polygon, like FeatureToPoint INSIDE: its
+    # centroid when that falls inside, otherwise its first representative
+    # point (the centroid stays when no sampled point lands inside either)
+    centroids = numpy.asarray(centroids, dtype=numpy.float64).reshape(-1, 2)
+    edges, edgeptr = _PolygonEdges(polygons)
+    inside = _InsideOwn(centroids, numpy.arange(len(polygons)), edges, edgeptr)
+    outside = numpy.nonzero(~inside)[0]
+    labelxy = centroids.copy()
+    if len(outside):
+        xy, owner, share = RepresentativePoints([polygons[i] for i in outside], centroids[outside], 2)
+        labelxy[outside] = xy[numpy.searchsorted(owner, numpy.arange(len(outside)))]
+    return labelxy
+
+
+def Aggregate(owner, values, weights=None, numpolygons=None, mean=True):
+    # Per-polygon totals of per-point values (points x columns, or one
+    # column), or weighted means when 'mean' is set (probabilities). Points
+    # must be grouped by owner, as RepresentativePoints returns them.
+    owner = numpy.asarray(owner, dtype=numpy.int64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if numpolygons is None:
+        numpolygons = int(owner.max()) + 1 if len(owner) else 0
+    if weights is None:
+        weights = numpy.ones(len(owner))
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    starts = numpy.searchsorted(owner, numpy.arange(numpolygons))
+    present = numpy.bincount(owner, minlength=numpolygons) > 0
+    shape = (numpolygons,) + values.shape[1:]
+    result = numpy.zeros(shape)
+    if not len(owner):
+        return result
+    if mean:
+        weighted = values * weights.reshape((-1,) + (1,) * (values.ndim - 1))
+        totals = numpy.add.reduceat(weighted, starts[present], axis=0)
+        norms = numpy.add.reduceat(weights, starts[present])
+        norms[norms == 0] = 1.0
+        result[present] = totals / norms.reshape((-1,) + (1,) * (values.ndim - 1))
+    else:
+        result[present] = numpy.add.reduceat(values, starts[present], axis=0)
+    return result
+
@@ -0,0 +1,136 @@
+# ---------------------------------------------------------------------------
+# HuffOutput.py
+# Usage: Long-format (origin_id, store_id, impedance, prob, sales) output in
+#        a compressed columnar file, indexed by store and by origin
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import io, zipfile
+import numpy
+
+# Default number of origins per origin-index block
+DEFAULT_ORIGIN_BLOCK = 4096
+
+COLUMNS = ("origin_id", "store_id", "impedance", "prob", "sales")
+
+
+def _WriteArray(archive, name, array):
+    buf = io.BytesIO()
+    numpy.lib.format.write_array(buf, numpy.ascontiguousarray(array))
+    archive.writestr(name + ".npy", buf.getvalue())
+
+
+def WriteLongPairs(path, origin_ids, store_ids, origin_index, store_index, prob, impedance=None, sales=None, originblock=DEFAULT_ORIGIN_BLOCK):
+    # origin_ids, store_ids     - ids of all origins and stores
+    # origin_index, store_index - positions (into the id arrays) of each pair
+    # prob, impedance, sales    - one value per pair (impedance, sales optional)
+    #
+    # The file is a zip of separately compressed .npy columns:
+    #   store/<k>/<column>   pairs of store k, sorted by origin
+    #   origin/<b>/<column>  pairs of origins b*originblock up to the next
+    #                        block, sorted by origin then store
+    # so one store's trade area or one origin's stores is read without
+    # decompressing anything else.
+    origin_ids = numpy.asarray(origin_ids)
+    store_ids = numpy.asarray(store_ids)
+    origin_index = numpy.asarray(origin_index, dtype=numpy.int64)
+    store_index = numpy.asarray(store_index, dtype=numpy.int64)
+    columns = {"prob": numpy.asarray(prob, dtype=numpy.float64)}
+    if impedance is not None:
+        columns["impedance"] = numpy.asarray(impedance, dtype=numpy.float64)
+    if sales is not None:
+        columns["sales"] = numpy.asarray(sales, dtype=numpy.float64)
+    for name in columns:
+        if columns[name].shape != origin_index.shape:
+            raise ValueError("Column '" + name + "' must have one value per pair.")
+
+    archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        _WriteArray(archive, "origin_ids", origin_ids)
+        _WriteArray(archive, "store_ids", store_ids)
+        _WriteArray(archive, "originblock", numpy.array([originblock], dtype=numpy.int64))
+        _WriteArray(archive, "columns", numpy.array(sorted(columns)))
+
+        # Process: Group pairs by store...
+        order = numpy.lexsort((origin_index, store_index))
+        bounds = numpy.searchsorted(store_index[order], numpy.arange(len(store_ids) + 1))
+        _WriteArray(archive, "store_counts", numpy.diff(bounds))
+        for k in range(len(store_ids)):
+            rows = order[bounds[k]:bounds[k + 1]]
+            _WriteArray(archive, "store/" + str(k) + "/origin_index", origin_index[rows])
+            for name in columns:
+                _WriteArray(archive, "store/" + str(k) + "/" + name, columns[name][rows])
+
+        # Process: Group pairs by origin block...
+        order = numpy.lexsort((store_index, origin_index))
+        blocks = (len(origin_ids) + originblock - 1) // originblock
+        bounds = numpy.searchsorted(origin_index[order], numpy.arange(blocks + 1) * originblock)
+        for b in range(blocks):
+            rows = order[bounds[b]:bounds[b + 1]]
+            _WriteArray(archive, "origin/" + str(b) + "/origin_index", origin_index[rows])
+            _WriteArray(archive, "origin/" + str(b) + "/store_index", store_index[rows])
+            for name in columns:
+                _WriteArray(archive, "origin/" + str(b) + "/" + name, columns[name][rows])
+    finally:
+        archive.close()
+
+
+def WriteLongTable(path, origin_ids, store_ids, prob, impedance=None, sales=None, minprob=0.0, originblock=DEFAULT_ORIGIN_BLOCK):
+    # Dense origins x stores results; only pairs with prob > minprob are kept
+    prob = numpy.asarray(prob)
+    origin_index, store_index = numpy.nonzero(prob > minprob)
+    pairimpedance = None
+    pairsales = None
+    if impedance is not None:
+        pairimpedance = numpy.asarray(impedance)[origin_index, store_index]
+    if sales is not None:
+        pairsales = numpy.asarray(sales)[origin_index, store_index]
+    WriteLongPairs(path, origin_ids, store_ids, origin_index, store_index, prob[origin_index, store_index], pairimpedance, pairsales, originblock)
+
+
+class LongTable(object):
+    # Reader for files written by WriteLongPairs / WriteLongTable
+
+    def __init__(self, path):
+        self._archive = zipfile.ZipFile(path, "r")
+        self.origin_ids = self._Read("origin_ids")
+        self.store_ids = self._Read("store_ids")
+        self.columns = [str(name) for name in self._Read("columns")]
+        self._originblock = int(self._Read("originblock")[0])
+        self._storepos = dict([(sid, k) for k, sid in enumerate(self.store_ids.tolist())])
+        self._originpos = None
+
+    def _Read(self, name):
+        return numpy.lib.format.read_array(io.BytesIO(self._archive.read(name + ".npy")))
+
+    def StoreCounts(self):
+        # Number of pairs kept for every store
+        return self._Read("store_counts")
+
+    def TradeArea(self, store_id):
+        # Columns (origin_id, store_id, impedance, prob, sales) of one store
+        k = self._storepos[store_id]
+        origin_index = self._Read("store/" + str(k) + "/origin_index")
+        result = {"origin_id": self.origin_ids[origin_index],
+                  "store_id": numpy.repeat(self.store_ids[k:k + 1], len(origin_index))}
+        for name in self.columns:
+            result[name] = self._Read("store/" + str(k) + "/" + name)
+        return result
+
+    def Origin(self, origin_id):
+        # Columns (origin_id, store_id, impedance, prob, sales) of one origin
+        if self._originpos is None:
+            self._originpos = dict([(oid, i) for i, oid in enumerate(self.origin_ids.tolist())])
+        i = self._originpos[origin_id]
+        b = str(i // self._originblock)
+        origin_index = self._Read("origin/" + b + "/origin_index")
+        rows = numpy.nonzero(origin_index == i)[0]
+        store_index = self._Read("origin/" + b + "/store_index")[rows]
+        result = {"origin_id": self.origin_ids[origin_index[rows]],
+                  "store_id": self.store_ids[store_index]}
+        for name in self.columns:
+            result[name] = self._Read("origin/" + b + "/" + name)[rows]
+        return result
+
+    def Close(self):
+        self._archive.close()
@@ -0,0 +1,128 @@
+# ---------------------------------------------------------------------------
+# HuffParallel.py
+# Usage: Multi-core Huff evaluation: origins are sharded across a process
+#        pool, with inputs and outputs in shared memory
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import multiprocessing
+import numpy
+import HuffDistance, HuffEngine
+
+# Default number of origins per shard
+DEFAULT_SHARD = 2048
+
+# Shared arrays of the current worker (set once per worker by _InitWorker)
+_shared = {}
+
+
+def SharedArray(shape, values=None):
+    # Float64 array backed by unsynchronized shared memory; returns
+    # (raw buffer, numpy view). The raw buffer is what gets passed to workers.
+    size = int(numpy.prod(shape)) if len(shape) else 1
+    raw = multiprocessing.RawArray("d", max(1, size))
+    view = numpy.frombuffer(raw, dtype=numpy.float64)[:size].reshape(shape)
+    if values is not None:
+        view[...] = values
+    return raw, view
+
+
+def _View(raw, shape):
+    size = int(numpy.prod(shape))
+    return numpy.frombuffer(raw, dtype=numpy.float64)[:size].reshape(shape)
+
+
+def _InitWorker(arrays, shapes, impedancepath, x, hassales, outputs, kernel=None):
+    _shared["arrays"] = dict([(name, _View(arrays[name], shapes[name])) for name in arrays])
+    _shared["impedance"] = None
+    if impedancepath:
+        _shared["impedance"] = numpy.load(impedancepath, mmap_mode="r")
+    _shared["x"] = x
+    _shared["hassales"] = hassales
+    _shared["outputs"] = outputs
+    _shared["kernel"] = kernel
+
+
+def _RunShard(shard):
+    # Computes impedance, probabilities and sales for origins start:stop and
+    # writes them straight into the shared outputs; only the small per-store
+    # totals travel back through the pool
+    start, stop = shard
+    arrays = _shared["arrays"]
+    if _shared["impedance"] is not None:
+        impedance = numpy.asarray(_shared["impedance"][start:stop], dtype=numpy.float64)
+    else:
+        impedance = HuffDistance.DistanceMatrix(arrays["origin_xy"][start:stop], arrays["store_xy"])
+    sales = None
+    if _shared["hassales"]:
+        sales = arrays["sales"][start:stop]
+    tt_x_att, sum_tt_x_att, prob, storesales = HuffEngine.HuffProbabilities(impedance, arrays["attractiveness"], _shared["x"], sales, _shared["kernel"])
+    if _shared["outputs"]:
+        arrays["prob"][start:stop] = prob
+        if storesales is not None:
+            arrays["storesales"][start:stop] = storesales
+    if storesales is None:
+        return prob.sum(axis=0), None
+    return prob.sum(axis=0), storesales.sum(axis=0)
+
+
+def ParallelHuff(attractiveness, x=HuffEngine.DEFAULT_EXPONENT, origin_xy=None, store_xy=None, impedancepath=None, sales=None, processes=None, shardsize=DEFAULT_SHARD, outputs=True, kernel=None):
+    # attractiveness - one value per store
+    # origin_xy, store_xy - coordinates for straight-line distances, or
+    # impedancepath       - a .npy impedance matrix (such as a HuffCache
+    #                       entry) that every worker memory-maps
+    # outputs        - False keeps only the per-store totals, so nothing of
+    #                  size origins x stores is ever allocated
+    # kernel         - optional HuffKernels kernel used in place of the
+    #                  power decay with exponent x
+    #
+    # Returns (prob, storesales, expected origins per store, sales per store);
+    # prob and storesales are None when outputs is False or there are no sales.
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    numstores = len(attractiveness)
+    if impedancepath:
+        numorigins = numpy.load(impedancepath, mmap_mode="r").shape[0]
+    elif origin_xy is not None and store_xy is not None:
+        numorigins = len(origin_xy)
+    else:
+        raise ValueError("Either origin and store locations or an impedance matrix file is required.")
+    if x is None or x == "":
+        x = HuffEngine.DEFAULT_EXPONENT
+
+    # Process: Place inputs and outputs in shared memory once...
+    arrays = {}
+    shapes = {}
+    views = {}
+
+    def Share(name, shape, values=None):
+        arrays[name], views[name] = SharedArray(shape, values)
+        shapes[name] = shape
+
+    Share("attractiveness", (numstores,), attractiveness)
+    if not impedancepath:
+        Share("origin_xy", (numorigins, 2), numpy.asarray(origin_xy, dtype=numpy.float64))
+        Share("store_xy", (numstores, 2), numpy.asarray(store_xy, dtype=numpy.float64))
+    if sales is not None:
+        Share("sales", (numorigins,), numpy.asarray(sales, dtype=numpy.float64))
+    if outputs:
+        Share("prob", (numorigins, numstores))
+        if sales is not None:
+            Share("storesales", (numorigins, numstores))
+
+    # Process: Run the shards across the pool...
+    shards = [(start, min(numorigins, start + shardsize)) for start in range(0, numorigins, shardsize)]
+    initargs = (arrays, shapes, impedancepath, float(x), sales is not None, outputs, kernel or None)
+    pool = multiprocessing.Pool(processes, _InitWorker, initargs)
+    try:
+        results = pool.map(_RunShard, shards)
+    finally:
+        pool.close()
+        pool.join()
+
+    expectedorigins = numpy.zeros(numstores)
+    storetotals = numpy.zeros(numstores)
+    for probsum, salessum in results:
+        expectedorigins += probsum
+        if salessum is not None:
+            storetotals += salessum
+    return views.get("prob"), views.get("storesales"), expectedorigins, storetotals
@@ -0,0 +1,380 @@
+# ---------------------------------------------------------------------------
+# HuffRun.py
+# Usage: Headless Huff model run (no arcgisscripting needed), e.g.
+#        python HuffRun.py stores.csv NAME SQFT origins.geojson out.csv -s POP
+# ---------------------------------------------------------------------------
+
+# Import system modules (numpy and the model modules are imported in Run)
+import sys, optparse
+import HuffBackends, HuffStores
+
+
+def Run(backend, stores, store_name, store_attr, origins, outpath, sales="", x="", marketareas="none", potential_st="", network="", stages=None, sample="", points=1, scenarios=(), breakdown=False, uncertainty=None, kernel="", marketpath="", cellsize="", cache="", blocksize=0, processes=1, outputformat="wide"):
+    # Runs the Huff model with the given backend and returns a dictionary
+    # with the store names, attractiveness, origin ids, impedance,
+    # probabilities and (with sales) the expected sales matrix. Distances are
+    # straight-line, or travel costs over a street network edge table
+    # (see HuffNetwork.ReadEdgesCSV) when one is given. 'stages' is an
+    # optional HuffInstrument.StageRecorder timing each stage. With 'sample'
+    # (a count, or "auto" for one matching the store density) 'origins' is
+    # a study area whose origins are sampled quasi-randomly, as the tool
+    # does when no origin locations are given. With 'points' > 1, polygon
+    # origins are each represented by that many points (splitting their
+    # sales) and the results aggregated back to the polygons. 'scenarios'
+    # lists further demand fields of the origins: their store totals are
+    # computed from the same probabilities (returned as "scenario_sales",
+    # stores x scenarios), and with 'breakdown' each adds a
+    # <store>_<field> output field per store. 'uncertainty' is a dictionary
+    # of HuffUncertainty.MonteCarlo options ('realizations', 'x',
+    # 'attrdist', 'demanddist', ...); attractiveness then varies for the
+    # potential stores only (all stores without potential stores), and the
+    # percentile bands are returned as "uncertainty". 'kernel' replaces the
+    # power decay with a HuffKernels kernel such as "tanner:2,0.0005".
+    # Market areas "surfaces" (or "both") evaluates the probability surfaces
+    # on a grid of 'cellsize' (straight-line distances only) and writes
+    # their market-area polygons to 'marketpath'. 'cache' is a HuffCache
+    # folder keeping network snaps between runs. With a 'blocksize' the
+    # origins are streamed through the model that many at a time (see
+    # HuffStream) and each block is appended to the CSV 'outpath' as it is
+    # done; only the store totals ("totals", a HuffStream.StoreTotals) are
+    # returned, with no impedance or probability matrices. With 'processes'
+    # > 1 the probabilities are computed by that many worker processes over
+    # shards of origins (see HuffParallel); straight-line runs without
+    # uncertainty then return no impedance matrix. 'outputformat' "long"
+    # writes the probabilities, sales and impedances as one row per origin and
+    # store to <outpath without extension>_pairs.zip (see HuffOutput) in place
+    # of the per-store output fields.
+    import numpy
+    import HuffDistance, HuffEngine, HuffInstrument
+    if stages is None:
+        stages = HuffInstrument.StageRecorder()
+    surfacemarkets = marketareas.lower() in ("surfaces", "both")
+    if surfacemarkets and (network or not marketpath):
+        raise HuffBackends.BackendError("Market areas from surfaces need straight-line distances and an output path for the market areas.")
+    if blocksize and (surfacemarkets or uncertainty or scenarios or int(points) > 1 or not outpath.lower().endswith(".csv")):
+        raise HuffBackends.BackendError("Streamed runs write a .csv output and cannot use surface market areas, uncertainty, demand scenarios or representative points.")
+    processes = int(processes or 1)
+    if processes > 1 and (blocksize or int(points) > 1):
+        raise HuffBackends.BackendError("Parallel runs cannot be streamed or use representative points.")
+    longoutput = outputformat.lower() == "long"
+    if longoutput and blocksize:
+        raise HuffBackends.BackendError("Streamed runs write the per-store fields; they cannot use the long output format.")
+
+    backend.SetProgressor("step", "Checking inputs against parameter requirements...", 0, 5, 1)
+
+    # Process: Read stores (and potential stores with NAME and ATTRACTIVENESS fields)...
+    stages.Begin("read")
+    st = backend.ReadPoints(stores, (store_name, store_attr))
+    names = list(st.Field(store_name))
+    attr = list(st.Field(store_attr))
+    xy = list(st.xy)
+    ids = list(st.ids)
+    potential = [False] * len(names)
+    if potential_st:
+        pt = backend.ReadPoints(potential_st, ("NAME", "ATTRACTIVENESS"))
+        names += list(pt.Field("NAME"))
+        attr += list(pt.Field("ATTRACTIVENESS"))
+        xy += list(pt.xy)
+        ids += list(pt.ids)
+        potential += [True] * len(pt.ids)
+    table = HuffStores.StoreTable(ids, names, attr, xy)
+    if len(table) < 2:
+        raise HuffBackends.BackendError("There are an insufficient number of stores to perform modeling. There must be at least two total records between the Store Locations dataset and the Potential Stores feature set.")
+    if table.Duplicate() is not None:
+        raise HuffBackends.BackendError("Field values in field '" + str(store_name) + "' are not unique. Use a different field.")
+    collision = table.Collision()
+    if collision is not None:
+        raise HuffBackends.BackendError("Store names '" + str(collision[0]) + "' and '" + str(collision[1]) + "' both become '" + collision[2] + "' in output field names. Rename one of them.")
+
+    # Warn that stores with an attribute value of 0 or less will be dropped from analysis
+    for k in table.Excluded():
+        backend.AddWarning("Feature " + str(table.sourceids[k]) + " in dataset: " + str(stores) + " has an attractiveness value of less than or equal to zero. This store location will be excluded from modeling.")
+    potential = numpy.array(potential, dtype=bool)[table.attractiveness > 0]
+    table = table.Modeled()
+    storenames = table.names
+    storeattr = table.attractiveness
+    storexy = table.xy
+    backend.SetProgressorPosition()
+
+    # Process: Read origins (polygons are represented by their centroids)...
+    if sample:
+        import HuffSampler
+        if sales or scenarios:
+            raise HuffBackends.BackendError("Sales fields cannot be used with sampled origins.")
+        sa = backend.ReadPoints(origins)
+        if sa.rings is None:
+            raise HuffBackends.BackendError("Sampling origins needs a polygon study area.")
+        index = HuffSampler.PolygonIndex(sa.rings)
+        if str(sample).lower() == "auto":
+            count = HuffSampler.AdaptiveCount(storexy, index.Area())
+        else:
+            count = int(sample)
+        # Store locations are origins too, as in the tool
+        originxy = numpy.vstack((storexy, HuffSampler.SampleOrigins(index, count)))
+        bg = HuffBackends.PointTable(range(1, len(originxy) + 1), originxy.tolist())
+        originsales = None
+    elif sales:
+        bg = backend.ReadPoints(origins, (sales,) + tuple([name for name in scenarios if name != sales]))
+        originsales = numpy.array([v or 0 for v in bg.Field(sales)], dtype=numpy.float64)
+    elif scenarios:
+        bg = backend.ReadPoints(origins, tuple(scenarios))
+        originsales = None
+    else:
+        bg = backend.ReadPoints(origins)
+        originsales = None
+    scenariosales = None
+    if scenarios:
+        demand = numpy.array([[v or 0 for v in bg.Field(name)] for name in scenarios], dtype=numpy.float64).T
+    if not sample:
+        originxy = numpy.array(bg.xy, dtype=numpy.float64)
+    owner = None
+    if int(points) > 1 and bg.rings is not None:
+        import HuffOrigins
+        originxy, owner, shares = HuffOrigins.RepresentativePoints(bg.rings, originxy, int(points))
+    backend.SetProgressorPosition()
+    stages.End(stores=len(storenames), origins=len(originxy))
+    backend.AddMessage("Finished checking inputs against parameter requirements.")
+
+    stages.Begin("impedance")
+    if network:
+        # Process: Network travel costs (minimum cost 0.1, unreachable pairs get no share)...
+        import HuffNetwork, HuffSnap
+        graph, cost, restrictions = HuffNetwork.ReadEdgesCSV(network)
+        backend.AddMessage("Using cost attribute '" + cost + "' and restrictions " + str(restrictions) + ".")
+        edgeindex = HuffSnap.GraphEdgeIndex(graph)
+        if cache:
+            import HuffCache
+            snapcache = HuffCache.ImpedanceCache(cache)
+            edgeindex.LoadCache(snapcache)
+        impedance = HuffNetwork.TravelCostMatrix(graph, HuffSnap.SnapLocations(graph, edgeindex, originxy),
+                                                 HuffSnap.SnapLocations(graph, edgeindex, storexy, destination=True))
+        if cache:
+            edgeindex.SaveCache(snapcache)
+        impedance[impedance == 0] = HuffDistance.MIN_DISTANCE
+    elif blocksize or (processes > 1 and not uncertainty):
+        # Straight-line distances are computed block by block (or shard by shard in the workers)
+        impedance = None
+    else:
+        # Process: Straight-line distances (minimum distance 0.1)...
+        impedance = HuffDistance.DistanceMatrix(originxy, storexy)
+    backend.SetProgressorPosition()
+    stages.End(pairs=len(originxy) * len(storenames))
+
+    if blocksize:
+        # Process: Stream blocks of origins through probabilities (and markets), appending each to the output...
+        import HuffStream
+        stages.Begin("stream")
+        withmarkets = marketareas.lower() in ("origins", "both")
+        writer = HuffStream.CSVBlockWriter(outpath, storenames, originsales is not None, withmarkets)
+        try:
+            totals = HuffStream.RunStream(HuffStream.OriginBlocks(bg.ids, originxy, originsales, int(blocksize)), storeattr, x,
+                                          storexy, impedance, writer, withmarkets, kernel)
+        finally:
+            writer.Close()
+        backend.SetProgressorPosition()
+        stages.End(pairs=len(originxy) * len(storenames), rows=len(originxy))
+        stages.Close()
+        backend.AddMessage(" -- Process Complete -- ")
+        return {"storenames": storenames, "attractiveness": storeattr, "origin_ids": bg.ids, "totals": totals}
+
+    bands = None
+    if uncertainty:
+        # Process: Monte Carlo bands of store shares and sales over the same impedance...
+        import HuffUncertainty
+        stages.Begin("uncertainty")
+        mcoptions = dict(uncertainty)
+        mcoptions.setdefault("x", x)
+        mcoptions.setdefault("kernel", kernel or None)
+        if potential.any():
+            mcoptions.setdefault("vary", potential)
+        mcsales = originsales
+        if mcsales is not None and owner is not None:
+            mcsales = originsales[owner] * shares
+        bands = HuffUncertainty.MonteCarlo(impedance, storeattr, mcsales, **mcoptions)
+        for j in range(len(storenames)):
+            backend.AddMessage(storenames[j] + ": sales " + " / ".join(["%.6g" % v for v in bands["sales"][:, j]]) +
+                               ", share " + " / ".join(["%.4f" % v for v in bands["share"][:, j]]) +
+                               " (percentiles " + ", ".join(["%g" % p for p in bands["percentiles"]]) + ")")
+        stages.End(pairs=impedance.size, realizations=len(bands["x_samples"]))
+
+    # Process: Probabilities and sales...
+    stages.Begin("probabilities")
+    if processes > 1:
+        # Shards of origins across a process pool; a computed impedance matrix is handed over as a .npy file
+        import os, tempfile
+        import HuffParallel
+        impedancepath = None
+        if impedance is not None:
+            handle, impedancepath = tempfile.mkstemp(".npy", "huffimpedance")
+            os.close(handle)
+            numpy.save(impedancepath, impedance)
+        try:
+            prob, storesales, expectedorigins, storetotals = HuffParallel.ParallelHuff(
+                storeattr, x, originxy, storexy, impedancepath, originsales, processes, kernel=kernel)
+        finally:
+            if impedancepath:
+                os.remove(impedancepath)
+        pointprob = prob
+    elif owner is None:
+        tt_x_att, sum_tt_x_att, prob, storesales = HuffEngine.HuffProbabilities(impedance, storeattr, x, originsales, kernel)
+        pointprob = prob
+    else:
+        # Each polygon's probabilities are the share-weighted mean over its points; sales add up
+        pointsales = None
+        if originsales is not None:
+            pointsales = originsales[owner] * shares
+        tt_x_att, sum_tt_x_att, pointprob, storesales = HuffEngine.HuffProbabilities(impedance, storeattr, x, pointsales, kernel)
+        prob = HuffOrigins.Aggregate(owner, pointprob, shares, len(bg))
+        if storesales is not None:
+            storesales = HuffOrigins.Aggregate(owner, storesales, numpolygons=len(bg), mean=False)
+        impedance = HuffOrigins.Aggregate(owner, impedance, shares, len(bg))
+    if scenarios:
+        # Process: Store totals of every demand scenario from the one probability matrix...
+        scenariosales = HuffEngine.ScenarioSales(pointprob, demand if owner is None else demand[owner] * shares[:, numpy.newaxis])
+    backend.SetProgressorPosition()
+    stages.End(pairs=prob.size)
+    backend.AddMessage("Finished calculating probabilities.")
+
+    # Process: Write the output origins with one _prob (and _sales) field per store (or the long table)...
+    stages.Begin("output")
+    fields = {}
+    fieldorder = []
+    fieldstores = storenames
+    if longoutput:
+        import os
+        import HuffOutput
+        fieldstores = []
+        pairpath = os.path.splitext(outpath)[0] + "_pairs.zip"
+        HuffOutput.WriteLongTable(pairpath, bg.ids, table.sourceids, prob, impedance, storesales)
+        backend.AddMessage("Wrote the origin-store results to the long table '" + pairpath + "'.")
+    for j in range(len(fieldstores)):
+        fields[storenames[j] + "_prob"] = prob[:, j].tolist()
+        fieldorder.append(storenames[j] + "_prob")
+        if storesales is not None:
+            fields[storenames[j] + "_sales"] = storesales[:, j].tolist()
+            fieldorder.append(storenames[j] + "_sales")
+    if sales:
+        fields[sales] = originsales.tolist()
+        fieldorder.insert(0, sales)
+    if scenarios and breakdown:
+        for s, scenario in HuffEngine.IterScenarioSales(prob, demand):
+            for j in range(len(storenames)):
+                fields[storenames[j] + "_" + scenarios[s]] = scenario[:, j].tolist()
+                fieldorder.append(storenames[j] + "_" + scenarios[s])
+    if marketareas.lower() in ("origins", "both"):
+        import HuffMarkets
+        dominant, runnerup, margin = HuffMarkets.DominantStores(prob)
+        labels = storenames + [None]
+        fields["Market"] = [labels[j] for j in dominant]
+        fields["Runner_Up"] = [labels[j] for j in runnerup]
+        fields["Margin"] = margin.tolist()
+        fields["HHI"] = HuffMarkets.ConcentrationIndex(prob).tolist()
+        fieldorder += ["Market", "Runner_Up", "Margin", "HHI"]
+    backend.WritePoints(outpath, HuffBackends.PointTable(bg.ids, bg.xy, fields), fieldorder)
+    backend.SetProgressorPosition()
+    stages.End(rows=len(originxy))
+
+    markets = None
+    if surfacemarkets:
+        # Process: Probability surfaces at every cell of the study area, then their market-area polygons...
+        import os, shutil, tempfile
+        import HuffSampler, HuffSurface, HuffMarketAreas
+        stages.Begin("surface_markets")
+        rings = bg.rings
+        if sample:
+            rings = sa.rings
+        mask = None
+        if rings is not None:
+            areaindex = HuffSampler.PolygonIndex(rings)
+            mask = areaindex.Contains
+            extent = (areaindex.xmin, areaindex.ymin, areaindex.xmax, areaindex.ymax)
+        else:
+            allxy = numpy.vstack((numpy.array(bg.xy, dtype=numpy.float64), storexy))
+            extent = tuple(allxy.min(axis=0)) + tuple(allxy.max(axis=0))
+        grid = HuffSurface.RasterGrid(extent[0], extent[1], extent[2], extent[3], cellsize)
+        folder = tempfile.mkdtemp(prefix="huffsurfaces")
+        try:
+            surfaces = HuffSurface.HuffSurfaces(storexy, storeattr, grid, os.path.join(folder, "surfaces.bsq"), x, kernel, mask)
+            markets = HuffMarketAreas.MarketAreas(surfaces, grid, len(storenames), storenames, table.sourceids,
+                                                  numpy.array(bg.xy, dtype=numpy.float64), prob, originsales)
+            del surfaces
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        backend.WritePoints(marketpath, markets, ["Market", "STORE_ID", "CELLS", "AREA", "DEMAND", "CAPTURED"])
+        backend.AddMessage("Created " + str(len(markets)) + " market areas in '" + marketpath + "'.")
+        stages.End(rows=len(markets), cells=grid.nrows * grid.ncols)
+    stages.Close()
+    backend.AddMessage(" -- Process Complete -- ")
+
+    return {"storenames": storenames, "attractiveness": storeattr, "origin_ids": bg.ids,
+            "impedance": impedance, "prob": prob, "sales": storesales, "scenario_sales": scenariosales,
+            "uncertainty": bands, "markets": markets}
+
+
+def Main(argv=None):
+    parser = optparse.OptionParser(usage="%prog stores store_name store_attr origins output [options]")
+    parser.add_option("-s", "--sales", default="", help="sales/demand field of the origins")
+    parser.add_option("-x", "--exponent", default="", help="distance-decay exponent (default 2)")
+    parser.add_option("-m", "--marketareas", default="none", help="'origins' to add Market fields, 'surfaces' for market-area polygons (-a), 'both'")
+    parser.add_option("-a", "--market-areas", default="", help="write market-area polygons from the probability surfaces to this file")
+    parser.add_option("--cellsize", default="", help="surface cell size (default 1/250th of the shorter side of the extent)")
+    parser.add_option("-p", "--potential", default="", help="potential stores with NAME and ATTRACTIVENESS fields")
+    parser.add_option("-n", "--network", default="", help="street network edge table (.csv) for travel costs")
+    parser.add_option("--cache", default="", help="folder keeping network snaps between runs")
+    parser.add_option("--block-size", type="int", default=0, help="stream the origins this many at a time into a .csv output")
+    parser.add_option("-f", "--format", default="wide", help="'wide' (default) for per-store output fields, 'long' for a <output>_pairs.zip long table")
+    parser.add_option("-j", "--processes", type="int", default=1, help="worker processes computing the probabilities")
+    parser.add_option("-r", "--random", default="", help="sample this many origins ('auto' to match store density) in the study area given as origins")
+    parser.add_option("-k", "--points", type="int", default=1, help="representative points per polygon origin")
+    parser.add_option("-c", "--scenarios", default="", help="comma-separated demand fields projected from the same probabilities")
+    parser.add_option("--breakdown", action="store_true", default=False, help="add per-origin <store>_<field> sales for every scenario")
+    parser.add_option("--kernel", default="", help="distance-decay kernel, e.g. exponential:0.001 or tanner:2,0.0005 (default power with -x)")
+    parser.add_option("-u", "--uncertainty", type="int", default=0, help="Monte Carlo realizations for sales/share percentile bands")
+    parser.add_option("--x-dist", default="", help="distribution of x, e.g. normal:2,0.25 (default: the exponent)")
+    parser.add_option("--attr-dist", default="", help="distribution of attractiveness multipliers, e.g. lognormal:0,0.2")
+    parser.add_option("--demand-dist", default="", help="distribution of demand multipliers, e.g. uniform:0.9,1.1")
+    parser.add_option("--stages", default="", help="append stage timings to this JSON lines file")
+    parser.add_option("--profile", default="", help="write a cProfile of the slowest stage to this file")
+    parser.add_option("-b", "--backend", default="local", help="'local' (default) or 'gp'")
+    options, args = parser.parse_args(argv)
+    if len(args) != 5:
+        parser.error("stores, store_name, store_attr, origins and output are required")
+    if options.kernel:
+        import HuffKernels
+        try:
+            HuffKernels.ParseKernel(options.kernel)
+        except ValueError:
+            parser.error(str(sys.exc_info()[1]))
+    if options.format not in ("wide", "long"):
+        parser.error("the output format must be 'wide' or 'long'")
+    if options.kernel and options.x_dist:
+        parser.error("--x-dist draws the power decay's x; it cannot be used with --kernel")
+    backend = HuffBackends.GetBackend(options.backend)
+    import HuffInstrument
+    sinks = []
+    if options.stages:
+        sinks.append(HuffInstrument.JSONLinesSink(options.stages))
+    stages = HuffInstrument.StageRecorder(sinks, backend, profile=options.profile or None)
+    scenarios = [name for name in options.scenarios.split(",") if name]
+    uncertainty = None
+    if options.uncertainty > 0:
+        uncertainty = {"realizations": options.uncertainty, "attrdist": options.attr_dist or None,
+                       "demanddist": options.demand_dist or None}
+        if options.x_dist:
+            uncertainty["x"] = options.x_dist
+    try:
+        Run(backend, args[0], args[1], args[2], args[3], args[4], sales=options.sales, x=options.exponent,
+            marketareas=options.marketareas, potential_st=options.potential, network=options.network,
+            stages=stages, sample=options.random, points=options.points, scenarios=scenarios,
+            breakdown=options.breakdown, uncertainty=uncertainty, kernel=options.kernel,
+            marketpath=options.market_areas, cellsize=options.cellsize, cache=options.cache,
+            blocksize=options.block_size, processes=options.processes,
+            outputformat=options.format)
+    except HuffBackends.BackendError:
+        backend.AddError(str(sys.exc_info()[1]))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
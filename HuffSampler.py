@@ -0,0 +1,272 @@
+# ---------------------------------------------------------------------------
+# HuffSampler.py
+# Usage: Quasi-random (Halton) or stratified origin points inside a study
+#        area, with a prepared polygon index for batch point-in-polygon tests
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+
+# Bounds on the number of origins chosen from store density
+MIN_ORIGINS = 100
+MAX_ORIGINS = 100000
+
+# Origins per square of side the mean nearest-store distance
+DEFAULT_PER_STORE_SQUARE = 25.0
+
+# Number of point x edge crossing tests per batch
+BLOCK_PAIRS = 1 << 22
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+
+def _Edges(polygons):
+    # All ring edges of a list of polygons (each a list of rings of (x, y))
+    # as an n x 4 array of x0, y0, x1, y1
+    edges = []
+    for rings in polygons:
+        for ring in rings:
+            ring = numpy.asarray(ring, dtype=numpy.float64)[:, :2]
+            if len(ring) < 2:
+                continue
+            if (ring[0] != ring[-1]).any():
+                ring = numpy.vstack((ring, ring[:1]))
+            edges.append(numpy.hstack((ring[:-1], ring[1:])))
+    if not edges:
+        raise ValueError("The study area has no polygon rings.")
+    # Horizontal edges never cross a horizontal ray (_Crossings skips them)
+    # but still mark the grid cells they pass through as boundary cells
+    return numpy.vstack(edges)
+
+
+def _Crossings(px, py, edges):
+    # Even-odd test pieces: whether a ray from (px, py) towards +x crosses
+    # each edge (all arrays of the same length)
+    x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    straddle = (y0 > py) != (y1 > py)
+    xcross = x0 + (py - y0) * (x1 - x0) / numpy.where(y1 != y0, y1 - y0, 1.0)
+    return straddle & (px < xcross)
+
+
+class PolygonIndex(object):
+    # Prepared study area: a grid whose cells are classified once as inside,
+    # outside or on the boundary, with the edges listed per cell. Points in
+    # inside/outside cells are settled by a lookup. A point in a boundary
+    # cell takes the status of the next non-boundary cell to its right,
+    # flipped once per edge crossed on the way there, so it is only tested
+    # against the edges of the few boundary cells in between.
+
+    def __init__(self, polygons, cellsize=None):
+        self.edges = _Edges(polygons)
+        xs = self.edges[:, [0, 2]]
+        ys = self.edges[:, [1, 3]]
+        self.xmin, self.xmax = xs.min(), xs.max()
+        self.ymin, self.ymax = ys.min(), ys.max()
+        if cellsize is None:
+            # About as many cells as edges
+            cellsize = numpy.sqrt(max((self.xmax - self.xmin) * (self.ymax - self.ymin), 1e-12) / len(self.edges))
+        self.cellsize = float(cellsize)
+        self.ncols = max(1, int(numpy.ceil((self.xmax - self.xmin) / self.cellsize)))
+        self.nrows = max(1, int(numpy.ceil((self.ymax - self.ymin) / self.cellsize)))
+
+        # Process: Group edges by the grid rows their y range covers...
+        r0 = self._Row(ys.min(axis=1))
+        r1 = self._Row(ys.max(axis=1))
+        counts = r1 - r0 + 1
+        edge = numpy.repeat(numpy.arange(len(self.edges)), counts)
+        row = r0[edge] + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        order = numpy.argsort(row, kind="mergesort")
+        self.rowedges = edge[order]
+        self.rowptr = numpy.zeros(self.nrows + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(row, minlength=self.nrows), out=self.rowptr[1:])
+
+        # Process: Mark the cells each edge passes through as boundary...
+        self.status = numpy.zeros((self.nrows, self.ncols), dtype=numpy.int8)
+        c0 = self._Col(xs.min(axis=1))
+        c1 = self._Col(xs.max(axis=1))
+        spanc = c1 - c0 + 1
+        cells = spanc * counts
+        edge = numpy.repeat(numpy.arange(len(self.edges)), cells)
+        offset = numpy.arange(cells.sum()) - numpy.repeat(numpy.cumsum(cells) - cells, cells)
+        cellrow = r0[edge] + offset // spanc[edge]
+        cellcol = c0[edge] + offset % spanc[edge]
+        self.status[cellrow, cellcol] = BOUNDARY
+        keys = cellrow * self.ncols + cellcol
+        order = numpy.argsort(keys, kind="mergesort")
+        self.celledges = edge[order]
+        self.cellcols = cellcol[order]
+        self.cellptr = numpy.zeros(self.nrows * self.ncols + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(keys, minlength=self.nrows * self.ncols), out=self.cellptr[1:])
+
+        # Process: Classify the remaining cells by testing their centres...
+        free = numpy.nonzero(self.status.ravel() != BOUNDARY)[0]
+        centres = numpy.column_stack((self.xmin + (free % self.ncols + 0.5) * self.cellsize,
+                                      self.ymin + (free // self.ncols + 0.5) * self.cellsize))
+        self.status.ravel()[free] = numpy.where(self._Exact(centres), INSIDE, OUTSIDE)
+
+        # Process: Find the next non-boundary cell to the right of every cell...
+        self.nextfree = numpy.empty((self.nrows, self.ncols), dtype=numpy.int64)
+        following = numpy.zeros(self.nrows, dtype=numpy.int64) + self.ncols
+        for col in range(self.ncols - 1, -1, -1):
+            following = numpy.where(self.status[:, col] != BOUNDARY, col, following)
+            self.nextfree[:, col] = following
+
+    def _Row(self, y):
+        return numpy.clip(numpy.floor((y - self.ymin) / self.cellsize).astype(numpy.int64), 0, self.nrows - 1)
+
+    def _Col(self, x):
+        return numpy.clip(numpy.floor((x - self.xmin) / self.cellsize).astype(numpy.int64), 0, self.ncols - 1)
+
+    def _Boundary(self, xy, blockpairs=BLOCK_PAIRS):
+        # Points in boundary cells: status of the next non-boundary cell to
+        # the right (outside past the last column), flipped by every edge
+        # crossing between the point and that cell. A crossing is counted
+        # only in the cell it falls in, as an edge is listed in every cell
+        # its bounding box overlaps.
+        inside = numpy.zeros(len(xy), dtype=bool)
+        if len(xy) == 0:
+            return inside
+        rows = self._Row(xy[:, 1])
+        cols = self._Col(xy[:, 0])
+        nextcol = self.nextfree[rows, cols]
+        final = numpy.zeros(len(xy), dtype=bool)
+        free = nextcol < self.ncols
+        final[free] = self.status[rows[free], nextcol[free]] == INSIDE
+        first = self.cellptr[rows * self.ncols + cols]
+        counts = self.cellptr[rows * self.ncols + nextcol] - first
+        batch = max(1, int(blockpairs // max(1, counts.max())))
+        for start in range(0, len(xy), batch):
+            stop = min(len(xy), start + batch)
+            c = counts[start:stop]
+            point = numpy.repeat(numpy.arange(start, stop), c)
+            entry = numpy.repeat(first[start:stop] - (numpy.cumsum(c) - c), c) + numpy.arange(c.sum())
+            e = self.edges[self.celledges[entry]]
+            px = xy[point, 0]
+            py = xy[point, 1]
+            x0, y0, x1, y1 = e[:, 0], e[:, 1], e[:, 2], e[:, 3]
+            straddle = (y0 > py) != (y1 > py)
+            xcross = x0 + (py - y0) * (x1 - x0) / numpy.where(y1 != y0, y1 - y0, 1.0)
+            crossed = straddle & (px < xcross) & (self._Col(xcross) == self.cellcols[entry])
+            flips = numpy.bincount(point[crossed] - start, minlength=stop - start) % 2 == 1
+            inside[start:stop] = final[start:stop] != flips
+        return inside
+
+    def _Exact(self, xy, blockpairs=BLOCK_PAIRS):
+        # Even-odd test against all the edges in each point's grid row
+        inside = numpy.zeros(len(xy), dtype=bool)
+        if len(xy) == 0:
+            return inside
+        rows = self._Row(xy[:, 1])
+        counts = self.rowptr[rows + 1] - self.rowptr[rows]
+        # Batches of points keep the number of point x edge pairs bounded
+        batch = max(1, int(blockpairs // max(1, counts.max())))
+        for start in range(0, len(xy), batch):
+            stop = min(len(xy), start + batch)
+            c = counts[start:stop]
+            point = numpy.repeat(numpy.arange(start, stop), c)
+            first = numpy.repeat(self.rowptr[rows[start:stop]] - (numpy.cumsum(c) - c), c)
+            edge = self.rowedges[first + numpy.arange(c.sum())]
+            crossed = _Crossings(xy[point, 0], xy[point, 1], self.edges[edge])
+            inside[start:stop] = numpy.bincount(point[crossed] - start, minlength=stop - start) % 2 == 1
+        return inside
+
+    def Contains(self, xy):
+        # Boolean per point: inside the study area (even-odd rule, so holes
+        # and separate parts of a multi-polygon are handled)
+        xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+        result = numpy.zeros(len(xy), dtype=bool)
+        within = (xy[:, 0] >= self.xmin) & (xy[:, 0] <= self.xmax) & (xy[:, 1] >= self.ymin) & (xy[:, 1] <= self.ymax)
+        points = numpy.nonzero(within)[0]
+        status = self.status[self._Row(xy[points, 1]), self._Col(xy[points, 0])]
+        result[points[status == INSIDE]] = True
+        boundary = points[status == BOUNDARY]
+        result[boundary] = self._Boundary(xy[boundary])
+        return result
+
+    def Area(self, samples=1 << 14):
+        # Study area estimated from the share of Halton points inside its
+        # bounding box (ring orientation conventions do not matter)
+        unit = Halton(samples)
+        xy = numpy.column_stack((self.xmin + unit[:, 0] * (self.xmax - self.xmin),
+                                 self.ymin + unit[:, 1] * (self.ymax - self.ymin)))
+        return self.Contains(xy).mean() * (self.xmax - self.xmin) * (self.ymax - self.ymin)
+
+
+def Halton(count, start=0, bases=(2, 3)):
+    # Points start .. start+count-1 of the Halton sequence in the unit square
+    index = numpy.arange(start + 1, start + count + 1, dtype=numpy.int64)
+    result = numpy.zeros((count, len(bases)))
+    for d, base in enumerate(bases):
+        n = index.copy()
+        scale = 1.0
+        while n.any():
+            scale /= base
+            result[:, d] += (n % base) * scale
+            n //= base
+    return result
+
+
+def Stratified(count, rng=None):
+    # Jittered grid: about 'count' points, one uniformly placed in each cell
+    # of a square grid over the unit square
+    if rng is None:
+        rng = numpy.random.RandomState(0)
+    side = max(1, int(numpy.ceil(numpy.sqrt(count))))
+    cells = numpy.arange(side * side)
+    xy = numpy.column_stack((cells % side, cells // side)).astype(numpy.float64)
+    return (xy + rng.uniform(0, 1, xy.shape)) / side
+
+
+def SampleOrigins(index, count, method="halton", seed=0):
+    # 'count' origins inside the study area. Halton points are drawn in the
+    # study area's bounding box and kept when inside; more are drawn (the
+    # sequence continues, staying low-discrepancy) until there are enough.
+    # Stratified points use a jittered grid sized for the inside fraction.
+    width = index.xmax - index.xmin
+    height = index.ymax - index.ymin
+    fraction = max(index.Area() / max(width * height, 1e-12), 1e-6)
+    rng = numpy.random.RandomState(seed)
+    found = []
+    total = 0
+    drawn = seed
+    attempts = 0
+    while total < count:
+        need = int((count - total) / fraction * 1.1) + 16
+        if method == "halton":
+            unit = Halton(need, drawn)
+            drawn += need
+        elif method == "stratified":
+            unit = Stratified(need, rng)
+        else:
+            raise ValueError("Unknown sampling method '" + str(method) + "'. Use 'halton' or 'stratified'.")
+        xy = numpy.column_stack((index.xmin + unit[:, 0] * width, index.ymin + unit[:, 1] * height))
+        xy = xy[index.Contains(xy)]
+        found.append(xy)
+        total += len(xy)
+        attempts += 1
+        if attempts > 50 and total == 0:
+            raise ValueError("No points could be placed inside the study area.")
+    xy = numpy.vstack(found)
+    if method == "stratified" and len(xy) > count:
+        # Thin evenly, keeping the spatial balance of the grid
+        xy = xy[numpy.linspace(0, len(xy) - 1, count).astype(numpy.int64)]
+    return xy[:count]
+
+
+def AdaptiveCount(store_xy, area, persquare=DEFAULT_PER_STORE_SQUARE, minimum=MIN_ORIGINS, maximum=MAX_ORIGINS):
+    # Number of origins so that a square the size of the mean nearest-store
+    # distance holds about 'persquare' origins: dense store networks get a
+    # denser origin sample, bounded by minimum and maximum
+    import HuffDistance
+    store_xy = numpy.asarray(store_xy, dtype=numpy.float64)
+    if len(store_xy) < 2 or area <= 0:
+        return minimum
+    dist = HuffDistance.DistanceMatrix(store_xy, store_xy, 0.0)
+    numpy.fill_diagonal(dist, numpy.inf)
+    spacing = dist.min(axis=1)
+    spacing = spacing[numpy.isfinite(spacing) & (spacing > 0)].mean() if (spacing > 0).any() else 0.0
+    if not spacing > 0:
+        return minimum
+    return int(min(maximum, max(minimum, round(persquare * area / (spacing * spacing)))))
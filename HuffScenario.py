@@ -0,0 +1,197 @@
+# ---------------------------------------------------------------------------
+# HuffScenario.py
+# Usage: What-if store scenarios (add, remove, re-weight stores) with the
+#        per-origin SUM_tt_x_att denominator kept resident
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+import HuffEngine
+
+# Spare store columns allocated past the initial stores; appending beyond
+# them grows the columns by half again
+SPARE_STORES = 4
+
+
+def DecayColumns(impedance, x=HuffEngine.DEFAULT_EXPONENT):
+    # 1 / (impedance ^ x), with unreachable (infinite) pairs set to 0
+    if x is None or x == "":
+        x = HuffEngine.DEFAULT_EXPONENT
+    old = numpy.seterr(divide="ignore", over="ignore", invalid="ignore")
+    try:
+        decay = numpy.power(numpy.asarray(impedance, dtype=numpy.float64), -float(x))
+        decay[~numpy.isfinite(decay)] = 0.0
+    finally:
+        numpy.seterr(**old)
+    return decay
+
+
+def _Divide(a, b):
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        result = a / b
+        result[~numpy.isfinite(result)] = 0.0
+    finally:
+        numpy.seterr(**old)
+    return result
+
+
+class HuffScenario(object):
+    # Keeps the origins x stores decay matrix (1 / impedance^x), the store
+    # attractiveness values and the per-origin SUM_tt_x_att. Adding, removing
+    # or re-weighting a store changes SUM_tt_x_att by one column, so no store
+    # change ever recomputes the full tt_x_att matrix.
+
+    def __init__(self, impedance, attractiveness, x=HuffEngine.DEFAULT_EXPONENT, sales=None, names=None):
+        decay = DecayColumns(impedance, x)
+        if decay.ndim != 2:
+            raise ValueError("Impedance must be an origins x stores matrix.")
+        attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+        if attractiveness.shape != (decay.shape[1],):
+            raise ValueError("There must be one attractiveness value per store.")
+        if x is None or x == "":
+            x = HuffEngine.DEFAULT_EXPONENT
+        self.x = float(x)
+        numorigins, numstores = decay.shape
+        if sales is None:
+            self.sales = numpy.ones(numorigins)
+        else:
+            self.sales = numpy.asarray(sales, dtype=numpy.float64)
+            if self.sales.shape != (numorigins,):
+                raise ValueError("There must be one sales value per origin.")
+
+        # Columns are stored with a few spare slots so stores can be appended
+        capacity = numstores + SPARE_STORES
+        self._decay = numpy.zeros((numorigins, capacity))
+        self._decay[:, :numstores] = decay
+        self._attr = numpy.zeros(capacity)
+        self._attr[:numstores] = attractiveness
+        self._active = numpy.zeros(capacity, dtype=bool)
+        self._active[:numstores] = True
+        self._numstores = numstores
+        if names is None:
+            names = [str(j) for j in range(numstores)]
+        if len(names) != numstores:
+            raise ValueError("There must be one name per store.")
+        self.names = list(names)
+
+        # Process: SUM of tt_x_att for every origin
+        self.sum_tt_x_att = numpy.dot(decay, attractiveness)
+
+    # -- Store changes -------------------------------------------------------
+
+    def AddStore(self, impedance, attractiveness, name=None):
+        # impedance - one impedance value per origin for the new store
+        # Returns the index of the new store
+        column = DecayColumns(numpy.asarray(impedance, dtype=numpy.float64).reshape(-1), self.x)
+        if column.shape != (self.NumOrigins(),):
+            raise ValueError("There must be one impedance value per origin.")
+        if self._numstores == len(self._attr):
+            self._Grow()
+        j = self._numstores
+        self._decay[:, j] = column
+        self._attr[j] = float(attractiveness)
+        self._active[j] = True
+        self._numstores += 1
+        if name is None:
+            name = str(j)
+        self.names.append(name)
+        self.sum_tt_x_att += column * self._attr[j]
+        return j
+
+    def RemoveStore(self, store):
+        # The column is kept (so store indexes stay valid) but no longer counts
+        j = self._Index(store)
+        if self._active[j]:
+            self.sum_tt_x_att -= self._decay[:, j] * self._attr[j]
+            self._active[j] = False
+        self._Clean()
+
+    def SetAttractiveness(self, store, attractiveness):
+        j = self._Index(store)
+        attractiveness = float(attractiveness)
+        if self._active[j]:
+            self.sum_tt_x_att += self._decay[:, j] * (attractiveness - self._attr[j])
+        self._attr[j] = attractiveness
+        self._Clean()
+
+    def RestoreStore(self, store):
+        j = self._Index(store)
+        if not self._active[j]:
+            self.sum_tt_x_att += self._decay[:, j] * self._attr[j]
+            self._active[j] = True
+
+    # -- Results -------------------------------------------------------------
+
+    def NumOrigins(self):
+        return self._decay.shape[0]
+
+    def NumStores(self):
+        return self._numstores
+
+    def Active(self):
+        return self._active[:self._numstores].copy()
+
+    def Attractiveness(self):
+        return self._attr[:self._numstores].copy()
+
+    def StoreTT(self, store):
+        # tt_x_att column of one store (0 once removed)
+        j = self._Index(store)
+        if not self._active[j]:
+            return numpy.zeros(self.NumOrigins())
+        return self._decay[:, j] * self._attr[j]
+
+    def StoreProbabilities(self, store):
+        # Probability of every origin going to one store (the store's _prob column)
+        j = self._Index(store)
+        if not self._active[j]:
+            return numpy.zeros(self.NumOrigins())
+        return _Divide(self._decay[:, j] * self._attr[j], self.sum_tt_x_att)
+
+    def Probabilities(self):
+        # Full origins x stores probability matrix (removed stores are 0)
+        n = self._numstores
+        weights = numpy.where(self._active[:n], self._attr[:n], 0.0)
+        return _Divide(self._decay[:, :n] * weights, self.sum_tt_x_att[:, numpy.newaxis])
+
+    def StoreSales(self, sum_tt_x_att=None):
+        # Expected sales of every store: one matrix-vector product over the
+        # resident decay matrix
+        if sum_tt_x_att is None:
+            sum_tt_x_att = self.sum_tt_x_att
+        n = self._numstores
+        weights = numpy.where(self._active[:n], self._attr[:n], 0.0)
+        share = _Divide(self.sales, sum_tt_x_att)
+        return numpy.dot(share, self._decay[:, :n]) * weights
+
+    def EvaluateStore(self, impedance, attractiveness):
+        # Evaluates a candidate store without adding it. Returns (the
+        # candidate's expected sales, the expected sales every existing store
+        # would have with the candidate open).
+        column = DecayColumns(numpy.asarray(impedance, dtype=numpy.float64).reshape(-1), self.x)
+        tt_x_att = column * float(attractiveness)
+        newsum = self.sum_tt_x_att + tt_x_att
+        captured = float(numpy.dot(_Divide(tt_x_att, newsum), self.sales))
+        return captured, self.StoreSales(newsum)
+
+    # -- Internals -----------------------------------------------------------
+
+    def _Index(self, store):
+        if not isinstance(store, (int, numpy.integer)):
+            store = self.names.index(store)
+        if store < 0 or store >= self._numstores:
+            raise IndexError("Store index " + str(store) + " is out of range.")
+        return int(store)
+
+    def _Grow(self):
+        capacity = len(self._attr) + max(SPARE_STORES, len(self._attr) // 2)
+        decay = numpy.zeros((self.NumOrigins(), capacity))
+        decay[:, :self._numstores] = self._decay[:, :self._numstores]
+        self._decay = decay
+        self._attr = numpy.concatenate((self._attr, numpy.zeros(capacity - len(self._attr))))
+        self._active = numpy.concatenate((self._active, numpy.zeros(capacity - len(self._active), dtype=bool)))
+
+    def _Clean(self):
+        # Repeated subtraction can leave tiny negative round-off
+        numpy.maximum(self.sum_tt_x_att, 0.0, self.sum_tt_x_att)
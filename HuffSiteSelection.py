@@ -0,0 +1,210 @@
+# ---------------------------------------------------------------------------
+# HuffSiteSelection.py
+# Usage: Picking the best N candidate sites by captured or net Huff sales, e.g.
+#        python HuffSiteSelection.py stores.csv NAME SQFT origins.csv candidates.csv 3 picks.csv -s POP
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import sys, heapq, optparse
+import numpy
+import HuffBackends, HuffDistance, HuffScenario, HuffStores
+
+# Number of origin x candidate cells evaluated per block in the first pass
+BLOCK_CELLS = 1 << 22
+
+
+def CoordinateCandidates(origin_xy, candidate_xy, mindist=HuffDistance.MIN_DISTANCE):
+    # Returns a function giving the straight-line impedance block for the
+    # candidates start:stop, so the full origins x candidates matrix is never built
+    origin_xy = numpy.asarray(origin_xy, dtype=numpy.float64)
+    candidate_xy = numpy.asarray(candidate_xy, dtype=numpy.float64)
+
+    def Columns(start, stop):
+        return HuffDistance.DistanceMatrix(origin_xy, candidate_xy[start:stop], mindist)
+    Columns.count = len(candidate_xy)
+    return Columns
+
+
+def _ColumnSource(candidates):
+    if callable(candidates):
+        return candidates, candidates.count
+    candidates = numpy.asarray(candidates)
+
+    def Columns(start, stop):
+        return numpy.asarray(candidates[:, start:stop], dtype=numpy.float64)
+    return Columns, candidates.shape[1]
+
+
+def _Gain(tt_x_att, total, weight):
+    # Sum over origins of sales * ((N + t) / (T + t) - N / T), written as
+    # sales * t * (T - N) / (T * (T + t)) = weight * t / (T + t)
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        share = tt_x_att / (total + tt_x_att)
+        share[~numpy.isfinite(share)] = 0.0
+    finally:
+        numpy.seterr(**old)
+    return numpy.dot(weight, share)
+
+
+def SelectSites(scenario, candidates, attractiveness, n, objective="captured", own=None, blockcells=BLOCK_CELLS):
+    # scenario       - HuffScenario holding the existing stores
+    # candidates     - origins x candidates impedance matrix (may be a
+    #                  numpy.memmap), or a function from CoordinateCandidates
+    # attractiveness - one attractiveness value per candidate
+    # n              - number of sites to pick
+    # objective      - "captured": sales captured by the new sites
+    #                  "net": new-site sales minus sales cannibalized from
+    #                  the existing stores flagged in 'own' (required; all
+    #                  False for a chain with no stores yet)
+    #
+    # Uses lazy-greedy selection: the gain objective is submodular, so a
+    # cached marginal gain is an upper bound on the current one and only the
+    # top of the queue needs to be re-evaluated after each pick.
+    #
+    # Returns a list of (candidate index, marginal gain) in the order picked.
+    if objective not in ("captured", "net"):
+        raise ValueError("The objective must be 'captured' or 'net'.")
+    if objective == "net" and own is None:
+        raise ValueError("The 'net' objective needs the 'own' flags of the existing stores.")
+    columns, count = _ColumnSource(candidates)
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    if attractiveness.shape != (count,):
+        raise ValueError("There must be one attractiveness value per candidate.")
+    n = min(int(n), count)
+
+    # N: tt_x_att that counts as ours, T: SUM_tt_x_att
+    total = scenario.sum_tt_x_att.copy()
+    numerator = numpy.zeros(scenario.NumOrigins())
+    if objective == "net":
+        own = numpy.asarray(own, dtype=bool)
+        if own.shape != (scenario.NumStores(),):
+            raise ValueError("There must be one 'own' flag per existing store.")
+        storeattr = numpy.where(scenario.Active() & own, scenario.Attractiveness(), 0.0)
+        for j in numpy.nonzero(storeattr)[0]:
+            numerator += scenario.StoreTT(j)
+
+    def Weight():
+        old = numpy.seterr(divide="ignore", invalid="ignore")
+        try:
+            weight = scenario.sales * (total - numerator) / total
+            weight[~numpy.isfinite(weight)] = 0.0
+        finally:
+            numpy.seterr(**old)
+        # Origins with no reachable store at all give everything to the candidate
+        weight[total <= 0] = scenario.sales[total <= 0]
+        return weight
+
+    def Column(c):
+        # tt_x_att of one candidate
+        return HuffScenario.DecayColumns(columns(c, c + 1)[:, 0], scenario.x) * attractiveness[c]
+
+    # Process: Evaluate every candidate's first marginal gain in blocks...
+    weight = Weight()
+    block = max(1, int(blockcells) // max(1, scenario.NumOrigins()))
+    heap = []
+    for start in range(0, count, block):
+        stop = min(count, start + block)
+        tt_x_att = HuffScenario.DecayColumns(columns(start, stop), scenario.x) * attractiveness[start:stop]
+        old = numpy.seterr(divide="ignore", invalid="ignore")
+        try:
+            share = tt_x_att / (total[:, numpy.newaxis] + tt_x_att)
+            share[~numpy.isfinite(share)] = 0.0
+        finally:
+            numpy.seterr(**old)
+        gains = numpy.dot(weight, share)
+        for c in range(start, stop):
+            heap.append((-gains[c - start], c, 0))
+    heapq.heapify(heap)
+
+    # Process: Lazy-greedy selection...
+    selected = []
+    while heap and len(selected) < n:
+        gain, c, evaluated = heapq.heappop(heap)
+        if evaluated == len(selected):
+            tt_x_att = Column(c)
+            selected.append((c, -gain))
+            total += tt_x_att
+            numerator += tt_x_att
+            weight = Weight()
+            continue
+        gain = _Gain(Column(c), total, weight)
+        heapq.heappush(heap, (-gain, c, len(selected)))
+    return selected
+
+
+def Run(backend, stores, store_name, store_attr, origins, candidates, n, outpath, sales="", x="", objective="captured",
+        ownfield="", candidate_name="NAME", candidate_attr="ATTRACTIVENESS"):
+    # Reads the existing stores, the origins and a candidate sites table
+    # (with name and attractiveness fields), picks the best n candidates and
+    # writes them in the order picked with their Rank and marginal Gain.
+    # With objective "net", 'ownfield' flags the chain's own existing stores
+    # (nonzero) whose cannibalized sales are subtracted. Returns the picks
+    # as (candidate index, gain).
+    if objective == "net" and not ownfield:
+        raise HuffBackends.BackendError("The net objective needs the field flagging your own stores.")
+    storefields = (store_name, store_attr) + ((ownfield,) if ownfield else ())
+    st = backend.ReadPoints(stores, storefields)
+    table = HuffStores.StoreTable(st.ids, st.Field(store_name), st.Field(store_attr), st.xy)
+    modeled = table.attractiveness > 0
+    own = None
+    if ownfield:
+        own = numpy.array([bool(v) for v in st.Field(ownfield)])[modeled]
+    table = table.Modeled()
+    if sales:
+        bg = backend.ReadPoints(origins, (sales,))
+        originsales = numpy.array([v or 0 for v in bg.Field(sales)], dtype=numpy.float64)
+    else:
+        bg = backend.ReadPoints(origins)
+        originsales = None
+    originxy = numpy.array(bg.xy, dtype=numpy.float64)
+    cs = backend.ReadPoints(candidates, (candidate_name, candidate_attr))
+    candidatexy = numpy.array(cs.xy, dtype=numpy.float64)
+    candidateattr = numpy.array([v or 0 for v in cs.Field(candidate_attr)], dtype=numpy.float64)
+
+    # Process: Existing stores held resident, candidates evaluated straight from their coordinates...
+    scenario = HuffScenario.HuffScenario(HuffDistance.DistanceMatrix(originxy, table.xy), table.attractiveness, x,
+                                         originsales, table.names)
+    try:
+        picks = SelectSites(scenario, CoordinateCandidates(originxy, candidatexy), candidateattr, n, objective, own)
+    except ValueError:
+        raise HuffBackends.BackendError(str(sys.exc_info()[1]))
+
+    names = list(cs.Field(candidate_name))
+    fields = {"NAME": [names[c] for c, gain in picks], "Rank": list(range(1, len(picks) + 1)),
+              "Gain": [float(gain) for c, gain in picks]}
+    backend.WritePoints(outpath, HuffBackends.PointTable([cs.ids[c] for c, gain in picks],
+                                                         [cs.xy[c] for c, gain in picks], fields),
+                        ["Rank", "NAME", "Gain"])
+    for rank, (c, gain) in enumerate(picks):
+        backend.AddMessage(str(rank + 1) + ". " + str(names[c]) + ": " + objective + " gain %.6g" % gain)
+    return picks
+
+
+def Main(argv=None):
+    parser = optparse.OptionParser(usage="%prog stores store_name store_attr origins candidates n output [options]")
+    parser.add_option("-s", "--sales", default="", help="sales/demand field of the origins")
+    parser.add_option("-x", "--exponent", default="", help="distance-decay exponent (default 2)")
+    parser.add_option("-o", "--objective", default="captured", help="'captured' (default) or 'net' (needs --own)")
+    parser.add_option("--own", default="", help="store field flagging your own stores (nonzero) for the net objective")
+    parser.add_option("--candidate-name", default="NAME", help="name field of the candidates (default NAME)")
+    parser.add_option("--candidate-attr", default="ATTRACTIVENESS", help="attractiveness field of the candidates (default ATTRACTIVENESS)")
+    parser.add_option("-b", "--backend", default="local", help="'local' (default) or 'gp'")
+    options, args = parser.parse_args(argv)
+    if len(args) != 7:
+        parser.error("stores, store_name, store_attr, origins, candidates, n and output are required")
+    if options.objective not in ("captured", "net"):
+        parser.error("the objective must be 'captured' or 'net'")
+    backend = HuffBackends.GetBackend(options.backend)
+    try:
+        Run(backend, args[0], args[1], args[2], args[3], args[4], int(args[5]), args[6], sales=options.sales,
+            x=options.exponent, objective=options.objective, ownfield=options.own,
+            candidate_name=options.candidate_name, candidate_attr=options.candidate_attr)
+    except HuffBackends.BackendError:
+        backend.AddError(str(sys.exc_info()[1]))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(Main())
@@ -0,0 +1,242 @@
+# ---------------------------------------------------------------------------
+# HuffSnap.py
+# Usage: Locating points on street network edges with a grid index over the
+#        edges, in vectorized batches, with a cache of located points
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+import HuffCache, HuffDistance, HuffNetwork
+
+# Search tolerance used by the tool when adding locations (meters)
+DEFAULT_TOLERANCE = 5000.0
+
+# Number of point x candidate edge pairs measured per batch
+BLOCK_PAIRS = 1 << 20
+
+
+def SegmentDistances(xy, a, b):
+    # Distance from points xy to segments a-b (all n x 2), and the position
+    # of the closest point along each segment (0 at a, 1 at b)
+    d = b - a
+    length2 = (d * d).sum(axis=1)
+    t = ((xy - a) * d).sum(axis=1) / numpy.where(length2 > 0, length2, 1.0)
+    numpy.clip(t, 0.0, 1.0, t)
+    closest = a + t[:, numpy.newaxis] * d
+    return numpy.hypot(xy[:, 0] - closest[:, 0], xy[:, 1] - closest[:, 1]), t
+
+
+class EdgeIndex(object):
+    # Uniform grid over network edges: every edge is listed in each cell its
+    # bounding box overlaps (cells in CSR form). Built once per network and
+    # reused for every batch of points. 'ids' are the edge numbers Snap
+    # returns (default 0..edges-1).
+
+    def __init__(self, from_xy, to_xy, cellsize=None, ids=None):
+        self.from_xy = HuffDistance._Coordinates(from_xy)
+        self.to_xy = HuffDistance._Coordinates(to_xy)
+        if ids is None:
+            ids = numpy.arange(len(self.from_xy))
+        self.ids = numpy.asarray(ids, dtype=numpy.int64)
+        lo = numpy.minimum(self.from_xy, self.to_xy)
+        hi = numpy.maximum(self.from_xy, self.to_xy)
+        if cellsize is None:
+            # About twice the typical edge length keeps each edge in a few cells
+            lengths = numpy.hypot(*(self.to_xy - self.from_xy).T)
+            cellsize = 2.0 * numpy.median(lengths) if len(lengths) else 1.0
+        self.cellsize = float(max(cellsize, 1e-9))
+        self.xmin, self.ymin = lo.min(axis=0) if len(lo) else (0.0, 0.0)
+        c0 = self._Cell(lo)
+        c1 = self._Cell(hi)
+        self.ncols = int(c1[:, 0].max()) + 1 if len(lo) else 1
+        self.nrows = int(c1[:, 1].max()) + 1 if len(lo) else 1
+
+        # Process: List every edge in each cell of its bounding box...
+        spanx = c1[:, 0] - c0[:, 0] + 1
+        spany = c1[:, 1] - c0[:, 1] + 1
+        counts = spanx * spany
+        edge = numpy.repeat(numpy.arange(len(lo)), counts)
+        offset = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        cx = c0[edge, 0] + offset // spany[edge]
+        cy = c0[edge, 1] + offset % spany[edge]
+        keys = cx * self.nrows + cy
+        order = numpy.argsort(keys, kind="mergesort")
+        self.edges = edge[order]
+        self.indptr = numpy.zeros(self.ncols * self.nrows + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(keys, minlength=self.ncols * self.nrows), out=self.indptr[1:])
+        self._cache = {}
+        self._saved = 0
+
+    def _Cell(self, xy):
+        return numpy.floor((xy - (self.xmin, self.ymin)) / self.cellsize).astype(numpy.int64)
+
+    def _Candidates(self, cells, ring):
+        # (point index, edge index) for the edges in the square of cells
+        # within 'ring' cells of each point's cell
+        points = []
+        edges = []
+        for dx in range(-ring, ring + 1):
+            for dy in range(-ring, ring + 1):
+                cx = cells[:, 0] + dx
+                cy = cells[:, 1] + dy
+                inside = numpy.nonzero((cx >= 0) & (cx < self.ncols) & (cy >= 0) & (cy < self.nrows))[0]
+                keys = cx[inside] * self.nrows + cy[inside]
+                start = self.indptr[keys]
+                counts = self.indptr[keys + 1] - start
+                total = counts.sum()
+                if total == 0:
+                    continue
+                first = numpy.repeat(start - (numpy.cumsum(counts) - counts), counts)
+                points.append(numpy.repeat(inside, counts))
+                edges.append(self.edges[first + numpy.arange(total)])
+        if not points:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(points), numpy.concatenate(edges)
+
+    def _Nearest(self, xy, ring):
+        # Nearest candidate edge of each point: (edge, position, distance),
+        # edge -1 when a point has no candidates
+        edge = numpy.zeros(len(xy), dtype=numpy.int64) - 1
+        position = numpy.zeros(len(xy))
+        distance = numpy.empty(len(xy))
+        distance.fill(numpy.inf)
+        o, e = self._Candidates(self._Cell(xy), ring)
+        if len(o) == 0:
+            return edge, position, distance
+        d, t = SegmentDistances(xy[o], self.from_xy[e], self.to_xy[e])
+        order = numpy.lexsort((e, d, o))
+        first = numpy.ones(len(order), dtype=bool)
+        first[1:] = o[order][1:] != o[order][:-1]
+        best = order[first]
+        edge[o[best]] = self.ids[e[best]]
+        position[o[best]] = t[best]
+        distance[o[best]] = d[best]
+        return edge, position, distance
+
+    def Snap(self, xy, tolerance=DEFAULT_TOLERANCE, blockpairs=BLOCK_PAIRS):
+        # Locates every point on its nearest edge within 'tolerance'.
+        # Returns (edge, position along the edge 0..1, offset distance);
+        # edge is -1 (and offset inf) for points with no edge in tolerance.
+        #
+        # Points are searched in widening squares of cells; a point is done
+        # once its nearest edge is closer than the square's inner radius, as
+        # no edge outside the square can then be nearer.
+        xy = HuffDistance._Coordinates(xy)
+        edge = numpy.zeros(len(xy), dtype=numpy.int64) - 1
+        position = numpy.zeros(len(xy))
+        distance = numpy.empty(len(xy))
+        distance.fill(numpy.inf)
+        pending = numpy.arange(len(xy))
+        ring = 1
+        # Rough number of candidates per point and cell, for batch sizes
+        percell = max(1.0, len(self.edges) / float(max(1, numpy.count_nonzero(numpy.diff(self.indptr)))))
+        while len(pending):
+            batch = max(1, int(blockpairs / (percell * (2 * ring + 1) ** 2)))
+            done = []
+            for start in range(0, len(pending), batch):
+                rows = pending[start:start + batch]
+                e, t, d = self._Nearest(xy[rows], ring)
+                found = d <= ring * self.cellsize
+                last = ring * self.cellsize >= tolerance
+                finished = found | last
+                keep = finished & (d <= tolerance)
+                edge[rows[keep]] = e[keep]
+                position[rows[keep]] = t[keep]
+                distance[rows[keep]] = d[keep]
+                done.append(rows[finished])
+            pending = numpy.setdiff1d(pending, numpy.concatenate(done))
+            ring = min(2 * ring, max(1, int(numpy.ceil(tolerance / self.cellsize))))
+        return edge, position, distance
+
+    def SnapCached(self, xy, tolerance=DEFAULT_TOLERANCE):
+        # Snap() remembering each located point by its coordinates (and the
+        # tolerance), so points seen before (e.g. the same stores or origins
+        # in another scenario) are not searched again
+        xy = HuffDistance._Coordinates(xy)
+        keys = [(x, y, tolerance) for x, y in xy.tolist()]
+        missing = [k for k in range(len(keys)) if keys[k] not in self._cache]
+        if missing:
+            e, t, d = self.Snap(xy[missing], tolerance)
+            for n, k in enumerate(missing):
+                self._cache[keys[k]] = (e[n], t[n], d[n])
+        found = [self._cache[key] for key in keys]
+        edge = numpy.array([f[0] for f in found], dtype=numpy.int64)
+        position = numpy.array([f[1] for f in found], dtype=numpy.float64)
+        distance = numpy.array([f[2] for f in found], dtype=numpy.float64)
+        return edge, position, distance
+
+    def CacheKey(self):
+        # Key of this index's edges (geometry and ids) in a HuffCache folder
+        return HuffCache.ImpedanceKey(numpy.column_stack((self.from_xy, self.to_xy)),
+                                      self.ids.reshape(-1, 1), "snap")
+
+    def LoadCache(self, cache):
+        # Adds the located points saved by SaveCache in a
+        # HuffCache.ImpedanceCache for the same edges, so a later run does
+        # not search them again
+        saved = cache.Get(self.CacheKey())
+        if saved is None:
+            return 0
+        for x, y, tolerance, e, t, d in saved.tolist():
+            self._cache.setdefault((x, y, tolerance), (int(e), t, d))
+        self._saved = len(self._cache)
+        return len(saved)
+
+    def SaveCache(self, cache):
+        # Saves every located point as rows of x, y, tolerance, edge,
+        # position and distance (evicted with the impedance matrices);
+        # nothing is written when no new point was located
+        if len(self._cache) == self._saved:
+            return
+        self._saved = len(self._cache)
+        rows = [key + value for key, value in self._cache.items()]
+        cache.Put(self.CacheKey(), numpy.array(rows, dtype=numpy.float64).reshape(-1, 6))
+
+
+def GraphEdgeIndex(graph, cellsize=None):
+    # EdgeIndex over the traversable edges of a HuffNetwork.NetworkGraph
+    # (restricted and closed edges are left out, so points snap past them)
+    edges = graph.edges
+    usable = numpy.nonzero(edges["forward"] | edges["backward"])[0]
+    return EdgeIndex(graph.node_xy[edges["from"][usable]], graph.node_xy[edges["to"][usable]], cellsize, usable)
+
+
+def EdgeLocations(graph, edge, position, destination=False):
+    # NetworkLocations for points located along graph edges. Origins leave
+    # the edge through whichever end they can travel to; destinations
+    # (stores) are reached from whichever end can travel to them. Points on
+    # no edge get node -1 (unreachable). The edge and position are kept so
+    # pairs on the same edge can travel along it directly.
+    edges = graph.edges
+    edge = numpy.asarray(edge, dtype=numpy.int64)
+    valid = edge >= 0
+    e = numpy.where(valid, edge, 0)
+    cost = edges["cost"][e]
+    tofrom = position * cost      # cost between the point and the from node
+    toto = (1.0 - position) * cost  # cost between the point and the to node
+    # An origin reaches the to node travelling forward, the from node backward;
+    # a destination is reached from the from node forward, the to node backward
+    usea = valid & edges["forward"][e]
+    useb = valid & edges["backward"][e]
+    if destination:
+        node_a = numpy.where(usea, edges["from"][e], -1)
+        node_b = numpy.where(useb, edges["to"][e], -1)
+        cost_a = tofrom
+        cost_b = toto
+    else:
+        node_a = numpy.where(usea, edges["to"][e], -1)
+        node_b = numpy.where(useb, edges["from"][e], -1)
+        cost_a = toto
+        cost_b = tofrom
+    # Keep node_a filled whenever the point has any way onto the network
+    swap = (node_a < 0) & (node_b >= 0)
+    node_a = numpy.where(swap, node_b, node_a)
+    cost_a = numpy.where(swap, cost_b, cost_a)
+    node_b = numpy.where(swap, -1, node_b)
+    return HuffNetwork.NetworkLocations(node_a, cost_a, node_b, cost_b, numpy.where(valid, edge, -1), position)
+
+
+def SnapLocations(graph, index, xy, tolerance=DEFAULT_TOLERANCE, destination=False):
+    # Locates points on the graph's edges (through the cached index)
+    edge, position, distance = index.SnapCached(xy, tolerance)
+    return EdgeLocations(graph, edge, position, destination)
@@ -0,0 +1,169 @@
+# ---------------------------------------------------------------------------
+# HuffSparse.py
+# Usage: Huff probabilities on distance-truncated (k nearest / cutoff) store sets
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+import HuffDistance, HuffEngine
+
+
+class SparseImpedance(object):
+    # Compressed sparse row origin x store impedance: the stores kept for
+    # origin i are indices[indptr[i]:indptr[i+1]] with impedance in data.
+    # threshold[i] is a lower bound on the impedance of every store that was
+    # dropped for origin i (numpy.inf when nothing was dropped).
+
+    def __init__(self, indptr, indices, data, threshold, numstores):
+        self.indptr = numpy.asarray(indptr, dtype=numpy.int64)
+        self.indices = numpy.asarray(indices, dtype=numpy.int64)
+        self.data = numpy.asarray(data, dtype=numpy.float64)
+        self.threshold = numpy.asarray(threshold, dtype=numpy.float64)
+        self.numstores = int(numstores)
+
+    def NumOrigins(self):
+        return len(self.indptr) - 1
+
+    def NumPairs(self):
+        return len(self.indices)
+
+    def Rows(self):
+        # Origin index of every stored pair
+        return numpy.repeat(numpy.arange(self.NumOrigins()), numpy.diff(self.indptr))
+
+    def ToDense(self):
+        dense = numpy.empty((self.NumOrigins(), self.numstores))
+        dense.fill(numpy.inf)
+        dense[self.Rows(), self.indices] = self.data
+        return dense
+
+
+def _Indptr(counts):
+    indptr = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=indptr[1:])
+    return indptr
+
+
+def _Truncate(block, k, cutoff):
+    # Keeps the k smallest (and/or <= cutoff) finite values of each row of a
+    # block; returns (row, column, value) of the kept pairs and the smallest
+    # finite dropped value per row
+    rows, cols = block.shape
+    if k is not None and k < cols:
+        part = numpy.argpartition(block, k, axis=1)
+        kept = part[:, :k]
+        order = numpy.argsort(numpy.take_along_axis(block, kept, 1), axis=1)
+        kept = numpy.take_along_axis(kept, order, 1)
+        rest = numpy.take_along_axis(block, part[:, k:], 1).min(axis=1)
+    else:
+        kept = numpy.argsort(block, axis=1)
+        rest = numpy.empty(rows)
+        rest.fill(numpy.inf)
+    values = numpy.take_along_axis(block, kept, 1)
+    keep = numpy.isfinite(values)
+    if cutoff is not None:
+        beyond = keep & (values > cutoff)
+        nearest = numpy.where(beyond, values, numpy.inf).min(axis=1)
+        rest = numpy.minimum(rest, nearest)
+        keep &= values <= cutoff
+    r = numpy.repeat(numpy.arange(rows), kept.shape[1]).reshape(kept.shape)
+    return r[keep], kept[keep], values[keep], rest
+
+
+def FromDense(impedance, k=None, cutoff=None):
+    # Truncates an existing origins x stores impedance matrix (for example a
+    # network travel-time matrix) to the k nearest stores and/or the stores
+    # within 'cutoff' of each origin
+    impedance = numpy.asarray(impedance, dtype=numpy.float64)
+    return FromBlocks([(0, impedance)], impedance.shape[0], impedance.shape[1], k, cutoff)
+
+
+def FromBlocks(blocks, numorigins, numstores, k=None, cutoff=None):
+    # Builds the truncated structure from (first origin row, block) pairs so
+    # that only one dense block is held in memory at a time
+    if k is None and cutoff is None:
+        raise ValueError("A number of nearest stores or an impedance cutoff is required.")
+    if k is not None and k < 1:
+        raise ValueError("The number of nearest stores must be at least 1.")
+    counts = numpy.zeros(numorigins, dtype=numpy.int64)
+    threshold = numpy.empty(numorigins)
+    indices = []
+    data = []
+    for start, block in blocks:
+        r, c, v, rest = _Truncate(block, k, cutoff)
+        counts[start:start + len(block)] = numpy.bincount(r, minlength=len(block))
+        threshold[start:start + len(block)] = rest
+        indices.append(c)
+        data.append(v)
+    if indices:
+        indices = numpy.concatenate(indices)
+        data = numpy.concatenate(data)
+    return SparseImpedance(_Indptr(counts), indices, data, threshold, numstores)
+
+
+def NearestStores(origin_xy, store_xy, k=None, cutoff=None, mindist=HuffDistance.MIN_DISTANCE, blockcells=HuffDistance.BLOCK_CELLS):
+    # Straight-line distances to the k nearest stores and/or the stores
+    # within 'cutoff' of each origin. A cutoff alone uses the grid index, so
+    # no dense block is ever built.
+    origin_xy = numpy.asarray(origin_xy, dtype=numpy.float64)
+    store_xy = numpy.asarray(store_xy, dtype=numpy.float64)
+    if k is None and cutoff is not None:
+        o, s, d = HuffDistance.DistancePairs(origin_xy, store_xy, cutoff, mindist, blockcells)
+        counts = numpy.bincount(o, minlength=len(origin_xy))
+        threshold = numpy.empty(len(origin_xy))
+        threshold.fill(float(cutoff))
+        threshold[counts == len(store_xy)] = numpy.inf
+        return SparseImpedance(_Indptr(counts), s, d, threshold, len(store_xy))
+    blocks = HuffDistance.IterDistanceBlocks(origin_xy, store_xy, mindist, blockcells)
+    return FromBlocks(blocks, len(origin_xy), len(store_xy), k, cutoff)
+
+
+def SparseHuffProbabilities(impedance, attractiveness, x=HuffEngine.DEFAULT_EXPONENT, sales=None):
+    # impedance - SparseImpedance structure
+    #
+    # Returns (tt_x_att, SUM_tt_x_att, prob, sales, lost) where tt_x_att,
+    # prob and sales are aligned with impedance.indices, SUM_tt_x_att has one
+    # value per origin, and lost is an upper bound on the probability mass
+    # each origin would have given to the dropped stores.
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    if attractiveness.shape != (impedance.numstores,):
+        raise ValueError("There must be one attractiveness value per store.")
+    if x is None or x == "":
+        x = HuffEngine.DEFAULT_EXPONENT
+    x = float(x)
+    numorigins = impedance.NumOrigins()
+    rows = impedance.Rows()
+
+    old = numpy.seterr(divide="ignore", over="ignore", invalid="ignore")
+    try:
+        tt_x_att = numpy.power(impedance.data, -x)
+        tt_x_att *= attractiveness[impedance.indices]
+        tt_x_att[~numpy.isfinite(tt_x_att)] = 0.0
+        sum_tt_x_att = numpy.bincount(rows, tt_x_att, minlength=numorigins)
+
+        prob = tt_x_att / sum_tt_x_att[rows]
+        prob[~numpy.isfinite(prob)] = 0.0
+
+        # Every dropped store is at least 'threshold' away, so the dropped
+        # tt_x_att is at most (dropped attractiveness) / threshold^x
+        keptattr = numpy.bincount(rows, attractiveness[impedance.indices], minlength=numorigins)
+        droppedattr = numpy.maximum(attractiveness.sum() - keptattr, 0.0)
+        bound = droppedattr * numpy.power(impedance.threshold, -x)
+        bound[~numpy.isfinite(bound)] = 0.0
+        lost = bound / (sum_tt_x_att + bound)
+        lost[~numpy.isfinite(lost)] = 0.0
+    finally:
+        numpy.seterr(**old)
+
+    if sales is None:
+        return tt_x_att, sum_tt_x_att, prob, None, lost
+
+    sales = numpy.asarray(sales, dtype=numpy.float64)
+    if sales.shape != (numorigins,):
+        raise ValueError("There must be one sales value per origin.")
+    return tt_x_att, sum_tt_x_att, prob, prob * sales[rows], lost
+
+
+def StoreTotals(impedance, values):
+    # Sums pair values (for example expected sales) for every store
+    return numpy.bincount(impedance.indices, values, minlength=impedance.numstores)
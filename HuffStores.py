@@ -0,0 +1,109 @@
+# ---------------------------------------------------------------------------
+# HuffStores.py
+# Usage: Stores loaded once into columnar arrays with dense integer IDs:
+#        name validation, sanitizing and lookups by ID
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import sys, re
+import numpy
+
+# Longest store name used in output field names
+MAX_NAME_LENGTH = 45
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern
+
+
+def SanitizeName(name, maxlength=MAX_NAME_LENGTH):
+    # Same rules as the tool: prefix names starting with a digit with an
+    # underscore, replace nonalphanumeric characters with underscores and
+    # truncate to 45 characters (or the name field's length, if shorter)
+    name = str(name)
+    if name[:1].isdigit():
+        name = "_" + name
+    return _intern(re.sub('[^a-zA-Z_0-9]', '_', name)[:min(maxlength, MAX_NAME_LENGTH)])
+
+
+def FindDuplicate(names):
+    # First name that occurs twice (None when all are unique), with a hash set
+    seen = set()
+    for name in names:
+        if name in seen:
+            return name
+        seen.add(name)
+    return None
+
+
+class StoreTable(object):
+    # sourceids      - the stores' ids in their source (e.g. object IDs)
+    # names          - store names (sanitized for use in field names)
+    # attractiveness - attractiveness values (None is treated as 0)
+    # xy             - store locations (optional)
+    #
+    # Store k has dense ID k: every per-store array (impedance columns,
+    # probabilities, fields) is indexed by it, and Index() maps source ids
+    # or names to it.
+
+    def __init__(self, sourceids, names, attractiveness, xy=None, maxlength=MAX_NAME_LENGTH):
+        self.sourceids = list(sourceids)
+        self.rawnames = list(names)
+        self.names = [SanitizeName(name, maxlength) for name in self.rawnames]
+        self.attractiveness = numpy.array([v or 0 for v in attractiveness], dtype=numpy.float64)
+        if xy is None:
+            xy = numpy.zeros((len(self.names), 2))
+        self.xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+        self._bysource = dict([(sid, k) for k, sid in enumerate(self.sourceids)])
+        self._byname = dict([(name, k) for k, name in enumerate(self.names)])
+
+    def __len__(self):
+        return len(self.names)
+
+    def Duplicate(self):
+        # First repeated source name (None when they are all unique)
+        return FindDuplicate(self.rawnames)
+
+    def Collision(self):
+        # First two different source names that sanitize to the same name
+        # (e.g. "A-1" and "A 1", or long names sharing their first 45
+        # characters), as (name, other name, sanitized name); None when the
+        # sanitized names are unique
+        if FindDuplicate(self.names) is None:
+            return None
+        first = {}
+        for raw, name in zip(self.rawnames, self.names):
+            if name in first and first[name] != raw:
+                return first[name], raw, name
+            first.setdefault(name, raw)
+        return None
+
+    def Excluded(self):
+        # Dense IDs of stores with an attractiveness of 0 or less
+        return numpy.nonzero(self.attractiveness <= 0)[0]
+
+    def Select(self, ids):
+        # New table of the given stores (dense IDs renumbered from 0)
+        ids = list(ids)
+        table = StoreTable.__new__(StoreTable)
+        table.sourceids = [self.sourceids[k] for k in ids]
+        table.rawnames = [self.rawnames[k] for k in ids]
+        table.names = [self.names[k] for k in ids]
+        table.attractiveness = self.attractiveness[ids]
+        table.xy = self.xy[ids]
+        table._bysource = dict([(sid, k) for k, sid in enumerate(table.sourceids)])
+        table._byname = dict([(name, k) for k, name in enumerate(table.names)])
+        return table
+
+    def Modeled(self):
+        # The stores taking part in modeling (attractiveness > 0)
+        return self.Select(numpy.nonzero(self.attractiveness > 0)[0])
+
+    def Index(self, sourceids):
+        # Dense IDs of a sequence of source ids
+        return numpy.array([self._bysource[sid] for sid in sourceids], dtype=numpy.int64)
+
+    def NameIndex(self, name):
+        return self._byname[name]
+
@@ -0,0 +1,137 @@
+# ---------------------------------------------------------------------------
+# HuffStream.py
+# Usage: Streaming the Huff model over fixed-size blocks of origins so peak
+#        memory is bounded by block size x stores
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import csv
+import numpy
+import HuffDistance, HuffEngine, HuffMarkets
+
+# Default number of origins per block
+DEFAULT_BLOCK = 4096
+
+
+def OriginBlocks(origin_ids, origin_xy, sales=None, blocksize=DEFAULT_BLOCK):
+    # Yields one dictionary per block of origins with 'start', 'ids', 'xy'
+    # and 'sales' (None without sales). The inputs may be memory-mapped.
+    for start in range(0, len(origin_ids), blocksize):
+        block = {
+            "start": start,
+            "ids": numpy.asarray(origin_ids[start:start + blocksize]),
+            "xy": numpy.asarray(origin_xy[start:start + blocksize], dtype=numpy.float64),
+            "sales": None,
+        }
+        if sales is not None:
+            block["sales"] = numpy.asarray(sales[start:start + blocksize], dtype=numpy.float64)
+        yield block
+
+
+def ImpedanceStage(blocks, store_xy=None, impedance=None, mindist=HuffDistance.MIN_DISTANCE):
+    # Adds 'impedance' (block x stores): rows of a precomputed (possibly
+    # memory-mapped) matrix, or straight-line distances to store_xy
+    if impedance is None and store_xy is None:
+        raise ValueError("Either store locations or an impedance matrix is required.")
+    for block in blocks:
+        if impedance is not None:
+            block["impedance"] = numpy.asarray(impedance[block["start"]:block["start"] + len(block["ids"])], dtype=numpy.float64)
+        else:
+            block["impedance"] = HuffDistance.DistanceMatrix(block["xy"], store_xy, mindist)
+        yield block
+
+
+def ProbabilityStage(blocks, attractiveness, x=HuffEngine.DEFAULT_EXPONENT, kernel=None):
+    # Adds 'prob' and (with sales) 'storesales'; drops the intermediate tt_x_att
+    for block in blocks:
+        tt_x_att, sum_tt_x_att, prob, storesales = HuffEngine.HuffProbabilities(block["impedance"], attractiveness, x, block["sales"], kernel)
+        del tt_x_att
+        block["sum_tt_x_att"] = sum_tt_x_att
+        block["prob"] = prob
+        block["storesales"] = storesales
+        yield block
+
+
+def MarketStage(blocks):
+    # Adds 'dominant', 'runnerup', 'margin' and 'hhi'
+    for block in blocks:
+        block["dominant"], block["runnerup"], block["margin"] = HuffMarkets.DominantStores(block["prob"])
+        block["hhi"] = HuffMarkets.ConcentrationIndex(block["prob"])
+        yield block
+
+
+class StoreTotals(object):
+    # Per-store totals accumulated as blocks go by
+
+    def __init__(self, numstores):
+        self.origins = 0
+        self.expectedorigins = numpy.zeros(numstores)
+        self.sales = numpy.zeros(numstores)
+        self.dominated = numpy.zeros(numstores, dtype=numpy.int64)
+
+    def Add(self, block):
+        self.origins += len(block["ids"])
+        self.expectedorigins += block["prob"].sum(axis=0)
+        if block.get("storesales") is not None:
+            self.sales += block["storesales"].sum(axis=0)
+        if "dominant" in block:
+            won = block["dominant"][block["dominant"] >= 0]
+            self.dominated += numpy.bincount(won, minlength=len(self.dominated))
+
+
+class CSVBlockWriter(object):
+    # Appends each block's origins to a CSV file, one row per origin with the
+    # same fields the tool adds to its output (<store>_prob, <store>_sales,
+    # Market)
+
+    def __init__(self, path, storenames, sales=True, markets=True):
+        self.storenames = list(storenames)
+        self.sales = sales
+        self.markets = markets
+        self._file = open(path, "w")
+        self._writer = csv.writer(self._file, lineterminator="\n")
+        header = ["ID"]
+        for name in self.storenames:
+            header.append(name + "_prob")
+            if sales:
+                header.append(name + "_sales")
+        if markets:
+            header += ["Market", "Runner_Up", "Margin", "HHI"]
+        self._writer.writerow(header)
+
+    def Write(self, block):
+        numstores = len(self.storenames)
+        columns = [block["ids"][:, numpy.newaxis].astype(object)]
+        if self.sales and block.get("storesales") is not None:
+            values = numpy.empty((len(block["ids"]), 2 * numstores))
+            values[:, 0::2] = block["prob"]
+            values[:, 1::2] = block["storesales"]
+        else:
+            values = block["prob"]
+        columns.append(values.astype(object))
+        if self.markets:
+            names = numpy.array(self.storenames + [""], dtype=object)
+            columns.append(numpy.column_stack((names[block["dominant"]], names[block["runnerup"]],
+                                               block["margin"].astype(object), block["hhi"].astype(object))))
+        self._writer.writerows(numpy.hstack(columns).tolist())
+
+    def Close(self):
+        self._file.close()
+
+
+def RunStream(blocks, attractiveness, x=HuffEngine.DEFAULT_EXPONENT, store_xy=None, impedance=None, writer=None, markets=True, kernel=None):
+    # Chains the stages over a block generator (see OriginBlocks), hands every
+    # finished block to writer (a function or an object with a Write method)
+    # and returns the StoreTotals. Only one block's arrays are alive at a time.
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    pipeline = ProbabilityStage(ImpedanceStage(blocks, store_xy, impedance), attractiveness, x, kernel)
+    if markets:
+        pipeline = MarketStage(pipeline)
+    totals = StoreTotals(len(attractiveness))
+    if writer is not None and hasattr(writer, "Write"):
+        writer = writer.Write
+    for block in pipeline:
+        totals.Add(block)
+        if writer is not None:
+            writer(block)
+    return totals
@@ -0,0 +1,241 @@
+# ---------------------------------------------------------------------------
+# HuffSurface.py
+# Usage: Probability and sales surfaces for all stores in one tiled pass,
+#        interpolated from the origins or evaluated directly at every cell,
+#        written as a multi-band memory-mapped raster
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import os
+import numpy
+import HuffDistance, HuffEngine, HuffKernels
+
+# Default number of neighbouring origins used for each cell
+DEFAULT_NEIGHBOURS = 12
+
+# Default number of cells along each side of a tile
+DEFAULT_TILE = 64
+
+NODATA = -9999.0
+
+# Largest number of cell x store pairs evaluated at once per tile
+BLOCK_CELLS = 1 << 20
+
+
+def DefaultCellSize(xmin, ymin, xmax, ymax):
+    # 1/250th of the shorter side of the study area extent, at most 400
+    if xmax - xmin > ymax - ymin:
+        side = ymax - ymin
+    else:
+        side = xmax - xmin
+    if side / 250.0 > 400:
+        return 400
+    return side / 250.0
+
+
+def ExpectedMeanDistance(numorigins, area):
+    # Expected mean distance between origin locations spread over the study area
+    return 1.0 / (2.0 * ((numorigins / float(area)) ** 0.5))
+
+
+class RasterGrid(object):
+    # Cell layout of an output raster: rows run from the top (ymax) down
+
+    def __init__(self, xmin, ymin, xmax, ymax, cellsize=None):
+        if cellsize is None or cellsize == "":
+            cellsize = DefaultCellSize(xmin, ymin, xmax, ymax)
+        self.cellsize = float(cellsize)
+        self.xmin = float(xmin)
+        self.ymax = float(ymax)
+        self.ncols = max(1, int(numpy.ceil((xmax - xmin) / self.cellsize)))
+        self.nrows = max(1, int(numpy.ceil((ymax - ymin) / self.cellsize)))
+
+    def CellCenters(self, row0, row1, col0, col1):
+        # x, y of the centres of cells [row0:row1, col0:col1], flattened row by row
+        xs = self.xmin + (numpy.arange(col0, col1) + 0.5) * self.cellsize
+        ys = self.ymax - (numpy.arange(row0, row1) + 0.5) * self.cellsize
+        gx, gy = numpy.meshgrid(xs, ys)
+        return numpy.column_stack((gx.ravel(), gy.ravel()))
+
+    def Tiles(self, tilesize=DEFAULT_TILE):
+        for row0 in range(0, self.nrows, tilesize):
+            for col0 in range(0, self.ncols, tilesize):
+                yield row0, min(self.nrows, row0 + tilesize), col0, min(self.ncols, col0 + tilesize)
+
+
+def CreateBandFile(path, grid, bands, dtype=numpy.float32):
+    # Band-sequential (BSQ) raster: a raw memory-mapped (bands, rows, cols)
+    # array plus an ESRI .hdr header so ArcGIS can read every band
+    base = os.path.splitext(path)[0]
+    header = open(base + ".hdr", "w")
+    try:
+        header.write("BYTEORDER I\n")
+        header.write("LAYOUT BSQ\n")
+        header.write("NROWS " + str(grid.nrows) + "\n")
+        header.write("NCOLS " + str(grid.ncols) + "\n")
+        header.write("NBANDS " + str(bands) + "\n")
+        header.write("NBITS " + str(8 * numpy.dtype(dtype).itemsize) + "\n")
+        if numpy.dtype(dtype).kind == "f":
+            header.write("PIXELTYPE FLOAT\n")
+        elif numpy.dtype(dtype).kind == "i":
+            header.write("PIXELTYPE SIGNEDINT\n")
+        header.write("ULXMAP " + repr(grid.xmin + grid.cellsize / 2.0) + "\n")
+        header.write("ULYMAP " + repr(grid.ymax - grid.cellsize / 2.0) + "\n")
+        header.write("XDIM " + repr(grid.cellsize) + "\n")
+        header.write("YDIM " + repr(grid.cellsize) + "\n")
+        header.write("NODATA " + repr(NODATA) + "\n")
+    finally:
+        header.close()
+    return numpy.memmap(path, dtype=numpy.dtype(dtype).newbyteorder("<"), mode="w+", shape=(bands, grid.nrows, grid.ncols))
+
+
+def _NearestOrigins(cells, origin_xy, order, sortedx, k, radius):
+    # k nearest origins of every cell in a tile, searching only the origins
+    # whose x lies within the tile's x range widened by 'radius'; the radius
+    # grows until the k-th neighbour is provably inside the search window
+    xmin, ymin = cells.min(axis=0)
+    xmax, ymax = cells.max(axis=0)
+    k = min(k, len(origin_xy))
+    while True:
+        first = numpy.searchsorted(sortedx, xmin - radius, "left")
+        last = numpy.searchsorted(sortedx, xmax + radius, "right")
+        candidates = order[first:last]
+        inside = (origin_xy[candidates, 1] >= ymin - radius) & (origin_xy[candidates, 1] <= ymax + radius)
+        candidates = candidates[inside]
+        if len(candidates) >= k:
+            dist = numpy.hypot(cells[:, 0][:, numpy.newaxis] - origin_xy[candidates, 0],
+                               cells[:, 1][:, numpy.newaxis] - origin_xy[candidates, 1])
+            if k < len(candidates):
+                nearest = numpy.argpartition(dist, k - 1, axis=1)[:, :k]
+            else:
+                nearest = numpy.tile(numpy.arange(len(candidates)), (len(cells), 1))
+            kdist = numpy.take_along_axis(dist, nearest, 1)
+            if len(candidates) == len(origin_xy) or kdist.max() <= radius:
+                return candidates[nearest], kdist
+        radius *= 2.0
+
+
+def IDWSurfaces(origin_xy, values, grid, path, neighbours=DEFAULT_NEIGHBOURS, power=2.0, tilesize=DEFAULT_TILE, mask=None, radius=None):
+    # origin_xy - origin point coordinates
+    # values    - origins x bands array (for example every store's _prob
+    #             column followed by every store's _sales column)
+    # grid      - RasterGrid of the output (the defcell / extent logic)
+    # mask      - optional rows x cols boolean array; cells outside are NODATA
+    #
+    # Interpolates every band by inverse distance weighting from the
+    # 'neighbours' nearest origins, tile by tile, and writes them to a
+    # multi-band BSQ file. Returns the memory-mapped (bands, rows, cols) array.
+    origin_xy = numpy.asarray(origin_xy, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if values.ndim == 1:
+        values = values[:, numpy.newaxis]
+    if values.shape[0] != len(origin_xy):
+        raise ValueError("There must be one row of values per origin.")
+    if len(origin_xy) == 0:
+        raise ValueError("At least one origin location is required.")
+
+    # Process: Index the origins by x once for the whole grid...
+    order = numpy.argsort(origin_xy[:, 0], kind="mergesort")
+    sortedx = origin_xy[order, 0]
+    if radius is None:
+        width = grid.ncols * grid.cellsize
+        height = grid.nrows * grid.cellsize
+        radius = 2.0 * ExpectedMeanDistance(len(origin_xy), width * height) * numpy.sqrt(neighbours)
+
+    surfaces = CreateBandFile(path, grid, values.shape[1])
+    for row0, row1, col0, col1 in grid.Tiles(tilesize):
+        tile = numpy.empty((values.shape[1], row1 - row0, col1 - col0), dtype=numpy.float32)
+        tile.fill(NODATA)
+        if mask is None:
+            inside = numpy.ones((row1 - row0) * (col1 - col0), dtype=bool)
+        else:
+            inside = numpy.asarray(mask[row0:row1, col0:col1], dtype=bool).ravel()
+        if inside.any():
+            cells = grid.CellCenters(row0, row1, col0, col1)[inside]
+            nearest, dist = _NearestOrigins(cells, origin_xy, order, sortedx, neighbours, radius)
+            weights = numpy.power(numpy.maximum(dist, 1e-12), -power)
+            weights /= weights.sum(axis=1)[:, numpy.newaxis]
+
+            # All bands at once, one neighbour rank at a time so memory stays cells x bands
+            estimate = numpy.zeros((len(cells), values.shape[1]))
+            for rank in range(nearest.shape[1]):
+                estimate += weights[:, rank][:, numpy.newaxis] * values[nearest[:, rank]]
+            flat = tile.reshape(values.shape[1], -1)
+            flat[:, inside] = estimate.T
+        surfaces[:, row0:row1, col0:col1] = tile
+    surfaces.flush()
+    return surfaces
+
+
+def _TileMask(mask, grid, row0, row1, col0, col1):
+    # Cells of a tile inside the mask: a rows x cols array, or a function
+    # taking cell centres (e.g. HuffSampler.PolygonIndex.Contains)
+    if mask is None:
+        return numpy.ones((row1 - row0) * (col1 - col0), dtype=bool)
+    if callable(mask):
+        return numpy.asarray(mask(grid.CellCenters(row0, row1, col0, col1)), dtype=bool)
+    return numpy.asarray(mask[row0:row1, col0:col1], dtype=bool).ravel()
+
+
+def HuffSurfaces(store_xy, attractiveness, grid, path, x=HuffEngine.DEFAULT_EXPONENT, kernel=None, mask=None,
+                 tilesize=DEFAULT_TILE, threads=None, mindist=HuffDistance.MIN_DISTANCE, blockcells=BLOCK_CELLS):
+    # store_xy       - store locations
+    # attractiveness - one attractiveness value per store
+    # grid           - RasterGrid of the output (the defcell / extent logic)
+    # x, kernel      - distance decay, as in HuffEngine.HuffProbabilities
+    # mask           - optional rows x cols boolean array, or a function of
+    #                  an n x 2 array of cell centres; cells outside are NODATA
+    # threads        - number of tiles evaluated at once (default: one per CPU)
+    #
+    # Straight-line mode only: the Huff probability of every store is
+    # evaluated exactly at every cell centre, with no interpolation. Bands
+    # 1..stores hold the probabilities and the last band the dominant store
+    # (1-based store number). Tiles are shrunk so no more than 'blockcells'
+    # cell x store pairs are held per tile. Returns the memory-mapped
+    # (stores + 1, rows, cols) array.
+    store_xy = numpy.asarray(store_xy, dtype=numpy.float64).reshape(-1, 2)
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    numstores = len(store_xy)
+    if attractiveness.shape != (numstores,):
+        raise ValueError("There must be one attractiveness value per store.")
+    if numstores == 0:
+        raise ValueError("At least one store location is required.")
+    if kernel is None or kernel == "":
+        if x is None or x == "":
+            x = HuffEngine.DEFAULT_EXPONENT
+        kernel = ("power", (float(x),))
+    kernel = HuffKernels.ParseKernel(kernel)
+    tilesize = max(1, min(int(tilesize), int(numpy.sqrt(max(1, blockcells // numstores)))))
+
+    surfaces = CreateBandFile(path, grid, numstores + 1)
+
+    def RunTile(tile):
+        row0, row1, col0, col1 = tile
+        values = numpy.empty((numstores + 1, (row1 - row0) * (col1 - col0)), dtype=numpy.float32)
+        values.fill(NODATA)
+        inside = _TileMask(mask, grid, row0, row1, col0, col1)
+        if inside.any():
+            cells = grid.CellCenters(row0, row1, col0, col1)[inside]
+            impedance = HuffDistance.DistanceMatrix(cells, store_xy, mindist)
+            prob = HuffKernels.KernelProbabilities(kernel, HuffKernels.LogImpedance(impedance), attractiveness)[2]
+            values[:numstores, inside] = prob.T
+            values[numstores, inside] = prob.argmax(axis=1) + 1
+        # Tiles never overlap, so threads write to the memory map independently
+        surfaces[:, row0:row1, col0:col1] = values.reshape(numstores + 1, row1 - row0, col1 - col0)
+
+    # Process: Evaluate the tiles across a thread pool (numpy releases the GIL)...
+    tiles = list(grid.Tiles(tilesize))
+    if threads == 1 or len(tiles) == 1:
+        for tile in tiles:
+            RunTile(tile)
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            for result in pool.imap_unordered(RunTile, tiles):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    surfaces.flush()
+    return surfaces
@@ -0,0 +1,245 @@
+# ---------------------------------------------------------------------------
+# HuffUncertainty.py
+# Usage: Monte Carlo uncertainty of store shares and sales: x, store
+#        attractiveness and demand drawn from distributions, realizations
+#        evaluated in batches over a cached log-impedance matrix
+# ---------------------------------------------------------------------------
+
+# Import system modules
+import numpy
+import HuffEngine, HuffKernels
+
+# Number of realization x origin x store cells evaluated per batch
+BLOCK_CELLS = 1 << 22
+
+DEFAULT_REALIZATIONS = 1000
+
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+# Distribution names and their number of parameters
+DISTRIBUTIONS = {"fixed": 1, "normal": 2, "lognormal": 2, "uniform": 2, "triangular": 3}
+
+
+def ParseDistribution(text):
+    # "normal:2,0.25" (mean, standard deviation), "lognormal:0,0.2" (of the
+    # log), "uniform:1.5,2.5", "triangular:1.5,2,2.5" (low, mode, high) or a
+    # plain number (fixed). Returns (name, parameters).
+    if isinstance(text, tuple):
+        return text
+    text = str(text).strip()
+    try:
+        return ("fixed", (float(text),))
+    except ValueError:
+        pass
+    kind, sep, params = text.partition(":")
+    kind = kind.strip().lower()
+    if kind not in DISTRIBUTIONS:
+        raise ValueError("Unknown distribution '" + kind + "'. Use one of " + ", ".join(sorted(DISTRIBUTIONS)) + ".")
+    try:
+        params = tuple([float(v) for v in params.split(",")])
+    except ValueError:
+        raise ValueError("Distribution parameters must be numbers: '" + text + "'.")
+    if len(params) != DISTRIBUTIONS[kind]:
+        raise ValueError("The " + kind + " distribution takes " + str(DISTRIBUTIONS[kind]) + " parameters.")
+    return kind, params
+
+
+def Sample(distribution, size, rng):
+    # 'size' draws from a distribution given as text or (name, parameters)
+    kind, params = ParseDistribution(distribution)
+    if kind == "fixed":
+        return numpy.zeros(size) + params[0]
+    if kind == "normal":
+        return rng.normal(params[0], params[1], size)
+    if kind == "lognormal":
+        return rng.lognormal(params[0], params[1], size)
+    if kind == "uniform":
+        return rng.uniform(params[0], params[1], size)
+    return rng.triangular(params[0], params[1], params[2], size)
+
+
+def _Fixed(distribution):
+    return distribution is None or distribution == "" or ParseDistribution(distribution)[0] == "fixed"
+
+
+def _Prepare(impedance, attractiveness, shift=True):
+    # Log-impedance relative to each origin's nearest usable store (so the
+    # decay never overflows whatever x is drawn; left as is without 'shift')
+    # and the usable-pair mask
+    impedance = numpy.asarray(impedance, dtype=numpy.float64)
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    if impedance.ndim != 2:
+        raise ValueError("Impedance must be an origins x stores matrix.")
+    if attractiveness.shape != (impedance.shape[1],):
+        raise ValueError("There must be one attractiveness value per store.")
+    logimp = HuffKernels.LogImpedance(impedance)
+    valid = numpy.isfinite(logimp) & (attractiveness > 0)
+    logimp[~valid] = numpy.inf
+    if shift:
+        nearest = logimp.min(axis=1)
+        nearest[~numpy.isfinite(nearest)] = 0.0
+        logimp -= nearest[:, numpy.newaxis]
+    return logimp, valid
+
+
+def _KernelDecay(kernel, logimp, valid):
+    # Decay matrix of a HuffKernels kernel, each row divided by its largest
+    # usable value (which leaves the probabilities unchanged)
+    logdecay = HuffKernels.LogDecay(kernel, logimp)
+    logdecay[~valid] = -numpy.inf
+    top = logdecay.max(axis=1)
+    top[~numpy.isfinite(top)] = 0.0
+    logdecay -= top[:, numpy.newaxis]
+    return numpy.exp(logdecay, out=logdecay)
+
+
+def _FixedDecaySales(decay, attr, demand):
+    # decay  - origins x stores exp(-x * logimp) (0 for unusable pairs)
+    # attr   - realizations x stores attractiveness
+    # demand - realizations x origins demand
+    # Sales of every store in every realization, as two matrix products:
+    # SUM_tt_x_att = decay . attr, sales = attr * ((demand / SUM) . decay)
+    total = numpy.dot(attr, decay.T)
+    old = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        share = demand / total
+        share[~numpy.isfinite(share)] = 0.0
+    finally:
+        numpy.seterr(**old)
+    return numpy.dot(share, decay) * attr
+
+
+def _BatchSales(logimp, valid, x, attr, demand, blockcells):
+    # Sales of every store for a batch of realizations with different x:
+    # realizations x origin rows x stores blocks of at most blockcells cells
+    numrealizations = len(x)
+    numorigins, numstores = logimp.shape
+    sales = numpy.zeros((numrealizations, numstores))
+    rows = max(1, min(numorigins, int(blockcells) // max(1, numrealizations * numstores)))
+    for start in range(0, numorigins, rows):
+        L = logimp[start:start + rows]
+        V = valid[start:start + rows]
+        # tt_x_att = exp(-x * log(impedance)) * attractiveness
+        tt = numpy.exp(-x[:, numpy.newaxis, numpy.newaxis] * numpy.where(V, L, 0.0))
+        tt *= V
+        tt *= attr[:, numpy.newaxis, :]
+        total = tt.sum(axis=2)
+        old = numpy.seterr(divide="ignore", invalid="ignore")
+        try:
+            share = demand[:, start:start + rows] / total
+            share[~numpy.isfinite(share)] = 0.0
+        finally:
+            numpy.seterr(**old)
+        sales += numpy.einsum("ri,rij->rj", share, tt)
+    return sales
+
+
+def MonteCarlo(impedance, attractiveness, sales=None, x=HuffEngine.DEFAULT_EXPONENT, attrdist=None, demanddist=None,
+               vary=None, perorigin=False, realizations=DEFAULT_REALIZATIONS, percentiles=DEFAULT_PERCENTILES,
+               seed=None, blockcells=BLOCK_CELLS, kernel=None):
+    # impedance      - origins x stores impedance (may be a cached memmap)
+    # attractiveness - one attractiveness value per store
+    # sales          - optional sales/demand value per origin (1 when None)
+    # x              - distance-decay exponent: a number or a distribution
+    #                  such as "normal:2,0.25" (see ParseDistribution)
+    # attrdist       - distribution of attractiveness multipliers, drawn for
+    #                  every store in 'vary' (default: all) in every realization
+    # demanddist     - distribution of demand multipliers, drawn once per
+    #                  realization, or per origin with 'perorigin'
+    # kernel         - optional HuffKernels kernel replacing the power decay
+    #                  (x must then be fixed; powerattr raises the drawn
+    #                  attractiveness to its alpha)
+    #
+    # Negative draws are clipped to 0. With a fixed x the decay matrix is
+    # computed once and every batch of realizations is two matrix products;
+    # otherwise batches are bounded to 'blockcells' cells.
+    #
+    # Returns a dictionary with 'percentiles', per-store percentile bands of
+    # 'sales' and 'share' (share of all captured sales) as percentiles x
+    # stores arrays, their means ('mean_sales', 'mean_share') and the raw
+    # realizations x stores 'sales_samples' and drawn 'x_samples'.
+    kind = None
+    if kernel is not None and kernel != "":
+        kind, params = HuffKernels.ParseKernel(kernel)
+    logimp, valid = _Prepare(impedance, attractiveness, kind is None)
+    numorigins, numstores = logimp.shape
+    attractiveness = numpy.asarray(attractiveness, dtype=numpy.float64)
+    if sales is None:
+        sales = numpy.ones(numorigins)
+    sales = numpy.asarray(sales, dtype=numpy.float64)
+    if sales.shape != (numorigins,):
+        raise ValueError("There must be one sales value per origin.")
+    if vary is None:
+        vary = numpy.ones(numstores, dtype=bool)
+    vary = numpy.asarray(vary, dtype=bool)
+    if x is None or x == "":
+        x = HuffEngine.DEFAULT_EXPONENT
+    realizations = int(realizations)
+    if realizations < 1:
+        raise ValueError("There must be at least one realization.")
+    rng = numpy.random.RandomState(seed)
+
+    fixedx = _Fixed(x)
+    if kind is not None and not fixedx:
+        raise ValueError("x can only be drawn from a distribution with the power decay.")
+    decay = None
+    if kind is not None:
+        # Process: Kernel decay matrix computed once, shared by every realization...
+        old = numpy.seterr(under="ignore", over="ignore")
+        try:
+            decay = _KernelDecay(kernel, logimp, valid)
+        finally:
+            numpy.seterr(**old)
+        batch = max(1, int(blockcells) // max(1, numorigins + numstores))
+    elif fixedx:
+        # Process: Decay matrix computed once, shared by every realization...
+        old = numpy.seterr(under="ignore")
+        try:
+            decay = numpy.where(valid, numpy.exp(-max(0.0, Sample(x, 1, rng)[0]) * numpy.where(valid, logimp, 0.0)), 0.0)
+        finally:
+            numpy.seterr(**old)
+        batch = max(1, int(blockcells) // max(1, numorigins + numstores))
+    else:
+        batch = max(1, int(blockcells) // max(1, numorigins * numstores))
+
+    # Process: Realizations in batches...
+    samples = numpy.zeros((realizations, numstores))
+    xs = numpy.zeros(realizations)
+    old = numpy.seterr(under="ignore")
+    try:
+        for start in range(0, realizations, batch):
+            count = min(batch, realizations - start)
+            xs[start:start + count] = numpy.maximum(Sample(x, count, rng), 0.0)
+            attr = numpy.tile(attractiveness, (count, 1))
+            if not _Fixed(attrdist):
+                attr[:, vary] *= numpy.maximum(Sample(attrdist, (count, int(vary.sum())), rng), 0.0)
+            if kind == "powerattr":
+                attr = numpy.where(attr > 0, numpy.abs(attr) ** params[1], 0.0)
+            if _Fixed(demanddist):
+                factor = numpy.zeros((count, 1)) + (1.0 if demanddist in (None, "") else ParseDistribution(demanddist)[1][0])
+            elif perorigin:
+                factor = numpy.maximum(Sample(demanddist, (count, numorigins), rng), 0.0)
+            else:
+                factor = numpy.maximum(Sample(demanddist, (count, 1), rng), 0.0)
+            demand = sales[numpy.newaxis, :] * factor
+            if decay is not None:
+                samples[start:start + count] = _FixedDecaySales(decay, attr, demand)
+            else:
+                samples[start:start + count] = _BatchSales(logimp, valid, xs[start:start + count], attr, demand, blockcells)
+    finally:
+        numpy.seterr(**old)
+
+    # Process: Percentile bands...
+    total = samples.sum(axis=1)
+    total[total == 0] = 1.0
+    shares = samples / total[:, numpy.newaxis]
+    percentiles = [float(p) for p in percentiles]
+    return {
+        "percentiles": percentiles,
+        "sales": numpy.percentile(samples, percentiles, axis=0),
+        "share": numpy.percentile(shares, percentiles, axis=0),
+        "mean_sales": samples.mean(axis=0),
+        "mean_share": shares.mean(axis=0),
+        "sales_samples": samples,
+        "x_samples": xs,
+    }